@@ -32,6 +32,49 @@
 ******************************************************************************/
 #include "DEV_Config.h"
 
+#if USE_MOCK_LIB
+/**
+ * Mock backend, for running without a panel attached.  GPIO and SPI go nowhere,
+ * but are counted, and the BUSY pin reads as busy for EPD_MOCK_REFRESH_MS
+ * milliseconds after each display refresh (DRF) command.  Set EPD_MOCK_NO_DELAY
+ * to skip all the fixed delays, and EPD_MOCK_SPI_LOG to a file name to record
+ * every byte sent over SPI.
+**/
+#include <stdlib.h>
+#include <time.h>
+
+static unsigned long Mock_SPI_Bytes = 0;
+static unsigned long Mock_GPIO_Writes = 0;
+static unsigned long Mock_Refreshes = 0;
+static int Mock_Command_Pending = 0;
+static int Mock_Refresh_Pending = 0;
+static double Mock_Busy_Until = 0;
+static FILE *Mock_SPI_Log = NULL;
+
+static double Mock_Now_ms(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000.0 + ts.tv_nsec / 1000000.0;
+}
+
+static void Mock_SPI_Byte(UBYTE Value)
+{
+    Mock_SPI_Bytes++;
+    if (Mock_SPI_Log != NULL) {
+        fputc(Value, Mock_SPI_Log);
+    }
+    // The first byte after chip select goes low is a command
+    if (Mock_Command_Pending) {
+        Mock_Command_Pending = 0;
+        if (Value == 0x12) {
+            Mock_Refresh_Pending = 1;
+            Mock_Refreshes++;
+        }
+    }
+}
+#endif
+
 /******************************************************************************
 function:	Write GPIO
 parameter:
@@ -43,6 +86,11 @@ void DEV_Digital_Write(UWORD Pin, UBYTE Value)
     bcm2835_gpio_write(Pin, Value);
 #elif USE_WIRINGPI_LIB
 	digitalWrite(Pin, Value);
+#elif USE_MOCK_LIB
+    Mock_GPIO_Writes++;
+    if ((Pin == EPD_CS_M_PIN || Pin == EPD_CS_S_PIN) && Value == 0) {
+        Mock_Command_Pending = 1;
+    }
 #endif
     
 }
@@ -59,6 +107,16 @@ UBYTE DEV_Digital_Read(UWORD Pin)
     Read_value = bcm2835_gpio_lev(Pin);
 #elif USE_WIRINGPI_LIB
 	Read_value = digitalRead(Pin);
+#elif USE_MOCK_LIB
+    if (Pin == EPD_BUSY_PIN) {
+        if (Mock_Refresh_Pending) {
+            const char *refresh_ms = getenv("EPD_MOCK_REFRESH_MS");
+            Mock_Busy_Until = Mock_Now_ms() + (refresh_ms ? atof(refresh_ms) : 0);
+            Mock_Refresh_Pending = 0;
+        }
+        // LOW: busy, HIGH: idle
+        Read_value = Mock_Now_ms() < Mock_Busy_Until ? 0 : 1;
+    }
 #endif
 	return Read_value;
 }
@@ -128,6 +186,9 @@ void DEV_GPIO_Mode(UWORD Pin, UWORD Mode)
 void DEV_SPI_SendData(UBYTE Reg)
 {
 	UBYTE i,j=Reg;
+#if USE_MOCK_LIB
+    Mock_SPI_Byte(Reg);
+#endif
 	DEV_GPIO_Mode(EPD_SI0_PIN, 1);
 	for(i = 0; i<8; i++)
     {
@@ -242,6 +303,13 @@ UBYTE DEV_ModuleInit(void)
 	// wiringPiSPISetupMode(0, 32000000, 0);
     // wiringPiSPISetup(1,10000000);
 	// wiringPiSPISetupMode(1, 32000000, 0);
+#elif USE_MOCK_LIB
+    const char *log_path = getenv("EPD_MOCK_SPI_LOG");
+    if (log_path != NULL && Mock_SPI_Log == NULL) {
+        Mock_SPI_Log = fopen(log_path, "wb");
+    }
+    printf("mock init success !!! \r\n");
+    DEV_GPIOConfig();
 #endif
 	
     return 0;
@@ -270,6 +338,10 @@ void DEV_Delay_ms(UDOUBLE xms)
     bcm2835_delay(xms);
 #elif USE_WIRINGPI_LIB
 	delay(xms);
+#elif USE_MOCK_LIB
+    if (getenv("EPD_MOCK_NO_DELAY") == NULL) {
+        usleep(xms * 1000);
+    }
 #endif
 }
 
@@ -296,5 +368,11 @@ void DEV_ModuleExit(void)
 #if USE_BCM2835_LIB
     // bcm2835_spi_end();
 	// bcm2835_close();
+#elif USE_MOCK_LIB
+    if (Mock_SPI_Log != NULL) {
+        fclose(Mock_SPI_Log);
+        Mock_SPI_Log = NULL;
+    }
+    printf("mock: %lu SPI bytes, %lu GPIO writes, %lu refreshes\r\n", Mock_SPI_Bytes, Mock_GPIO_Writes, Mock_Refreshes);
 #endif
 }
@@ -2,6 +2,8 @@
 #include <signal.h>     //signal()
 #include <stdbool.h>
 #include <time.h>
+#include <string.h>
+#include <unistd.h>     //dup(), dup2()
 #include "lib/e-Paper/EPD_13in3e.h"
 #include "lib/GUI/GUI_Paint.h"
 #include "lib/GUI/GUI_BMPfile.h"
@@ -12,6 +14,156 @@ int Version;
 bool display_message = false;
 char *message_ptr;
 
+// Longest command line accepted in serve mode: a verb, a path, and a message
+#define SERVE_LINE_MAX 4352
+
+// Returns true if the given path names a packed display buffer rather than a BMP
+bool is_frame_file(const char *path)
+{
+    size_t len = strlen(path);
+    return len > 6 && strcmp(path + len - 6, ".frame") == 0;
+}
+
+// Returns true if the given path means a packed display buffer sent on stdin
+bool is_stdin_frame(const char *path)
+{
+    return strcmp(path, "-") == 0;
+}
+
+// Read a packed display buffer (two pixels per byte, already in panel orientation)
+// straight into the image memory from an open file or pipe.
+int ReadPackedFrameFrom(FILE *fp, UBYTE *Image, UDOUBLE Imagesize)
+{
+    size_t got = fread(Image, 1, Imagesize, fp);
+    if (got != Imagesize) {
+        printf("Frame is %u bytes, expected %u\r\n", (unsigned)got, (unsigned)Imagesize);
+        return -2;
+    }
+    return 0;
+}
+
+// Read a packed display buffer from a file.  These are written by render_cache.py.
+int ReadPackedFrame(const char *path, UBYTE *Image, UDOUBLE Imagesize)
+{
+    FILE *fp = fopen(path, "rb");
+    if (fp == NULL) {
+        printf("Could not open frame file %s\r\n", path);
+        return -1;
+    }
+    int result = ReadPackedFrameFrom(fp, Image, Imagesize);
+    fclose(fp);
+    return result;
+}
+
+// Fill the image memory from a packed frame on stdin, a packed frame file, or a BMP file.
+// Returns nonzero if the image couldn't be read, in which case the panel shouldn't be refreshed.
+int LoadImage(const char *Pathname, UBYTE *Image, UDOUBLE Imagesize)
+{
+    if (is_stdin_frame(Pathname)) {
+        printf("epd: ReadPackedFrameFrom stdin\r\n");
+        return ReadPackedFrameFrom(stdin, Image, Imagesize);
+    } else if (is_frame_file(Pathname)) {
+        printf("epd: ReadPackedFrame\r\n");
+        return ReadPackedFrame(Pathname, Image, Imagesize);
+    } else {
+        // printf("show bmp------------------------\r\n");
+        printf("epd: Paint_Clear\r\n");
+        Paint_Clear(WHITE);   
+        printf("epd: GUI_ReadBmp\r\n");
+        if (GUI_ReadBmp(Pathname, 0, 0) != 0) {
+            printf("Could not read BMP file %s\r\n", Pathname);
+            return -1;
+        }
+        return 0;
+    }
+}
+
+// Draw the overlay message, if any, and send the image to the panel
+void ShowImage(UBYTE *Image, const char *message)
+{
+    printf("epd: Paint_DrawString_EN\r\n");
+    if (message != NULL && message[0] != '\0') {
+        Paint_DrawString_EN(10, 10, message, &Font24, EPD_13IN3E_WHITE, EPD_13IN3E_BLACK);
+    }
+    printf("epd: EPD_13IN3E_Display\r\n");
+    EPD_13IN3E_Display(Image);
+    DEV_Delay_ms(1000);
+
+    printf("epd: EPD_13IN3E_Sleep\r\n");
+    EPD_13IN3E_Sleep();
+}
+
+/******************************************************************************
+Serve mode: stay running with the module initialized and the image memory
+allocated, and take commands on stdin, one per line, fields separated by tabs:
+
+    SHOW <tab> path <tab> message       show a BMP file or packed .frame file
+    FRAME <tab> length <tab> message    followed by exactly length bytes of packed frame
+    QUIT
+
+The message may be left empty.  Each SHOW or FRAME is answered on stdout, once the
+refresh is done, with a line of "OK" or "ERR reason".  If the image can't be read, the
+panel isn't refreshed at all.  All other output goes to stderr.
+The panel is put back to sleep after every refresh, and woken with EPD_13IN3E_Init
+before the next one, since it shouldn't be left powered between refreshes.
+******************************************************************************/
+int Serve(FILE *replies, UBYTE *Image, UDOUBLE Imagesize)
+{
+    char line[SERVE_LINE_MAX];
+    while (fgets(line, sizeof(line), stdin) != NULL) {
+        line[strcspn(line, "\r\n")] = '\0';
+        char *verb = line;
+        char *arg = strchr(verb, '\t');
+        char *message = NULL;
+        if (arg != NULL) {
+            *arg++ = '\0';
+            message = strchr(arg, '\t');
+            if (message != NULL) {
+                *message++ = '\0';
+            }
+        }
+
+        if (strcmp(verb, "QUIT") == 0) {
+            break;
+        }
+
+        if (strcmp(verb, "SHOW") == 0 && arg != NULL) {
+            if (LoadImage(arg, Image, Imagesize) != 0) {
+                // The panel keeps showing what it had
+                fprintf(replies, "ERR could not read %s\n", arg);
+                fflush(replies);
+                continue;
+            }
+        } else if (strcmp(verb, "FRAME") == 0 && arg != NULL) {
+            UDOUBLE length = strtoul(arg, NULL, 10);
+            if (length != Imagesize) {
+                // Can't tell where the next command starts, so give up
+                fprintf(replies, "ERR frame is %u bytes, expected %u\n", (unsigned)length, (unsigned)Imagesize);
+                fflush(replies);
+                return -2;
+            }
+            if (ReadPackedFrameFrom(stdin, Image, Imagesize) != 0) {
+                fprintf(replies, "ERR short frame\n");
+                fflush(replies);
+                return -2;
+            }
+        } else {
+            fprintf(replies, "ERR unknown command\n");
+            fflush(replies);
+            continue;
+        }
+
+        printf("epd: EPD_13IN3E_Init\r\n");
+        EPD_13IN3E_Init();
+        ShowImage(Image, message);
+
+        fprintf(replies, "OK\n");
+        fflush(replies);
+    }
+    fclose(replies);
+    return 0;
+}
+
 void Handler(int signo)
 {
     //System Exit
@@ -26,13 +178,25 @@ int main(int argc, char *argv[])
     signal(SIGINT, Handler);
 
 	if (argc < 2) {
-		printf("Please provide a path to a BMP image!\r\n");
+		printf("Please provide a path to a BMP image or packed frame, - for a packed frame on stdin, or --serve!\r\n");
 		exit(1);
     }
 
-	if (argc == 3) {
+    bool serve = strcmp(argv[1], "--serve") == 0;
+
+    // In serve mode, stdout is kept for replies and everything else goes to stderr
+    FILE *replies = NULL;
+    if (serve) {
+        replies = fdopen(dup(STDOUT_FILENO), "w");
+        if (replies == NULL) {
+            exit(1);
+        }
+        dup2(STDERR_FILENO, STDOUT_FILENO);
+    }
+
+	if (argc == 3 && !serve) {
         display_message = true;
-        message_ptr = argv[4];
+        message_ptr = argv[2];
     }
 
     char *Pathname = argv[1];
@@ -41,8 +205,11 @@ int main(int argc, char *argv[])
     DEV_ModuleInit();
     DEV_Delay_ms(500);
 
-    printf("epd: EPD_13IN3E_Init\r\n");
-    EPD_13IN3E_Init();
+    // In serve mode the panel is woken for each refresh instead
+    if (!serve) {
+        printf("epd: EPD_13IN3E_Init\r\n");
+        EPD_13IN3E_Init();
+    }
     //printf("epd: EPD_13IN3E_Clear\r\n");
     //EPD_13IN3E_Clear(EPD_13IN3E_WHITE);
     //DEV_Delay_ms(500);
@@ -61,24 +228,21 @@ int main(int argc, char *argv[])
     Paint_NewImage(Image, EPD_13IN3E_WIDTH, EPD_13IN3E_HEIGHT, 0, WHITE);
     Paint_SetScale(6);
 
-    // printf("show bmp------------------------\r\n");
-    printf("epd: Paint_Clear\r\n");
-    Paint_Clear(WHITE);   
-    printf("epd: GUI_ReadBmp\r\n");
-    GUI_ReadBmp(Pathname, 0, 0);
-    printf("epd: Paint_DrawString_EN\r\n");
-    if (display_message) {
-        Paint_DrawString_EN(10, 10, message_ptr, &Font24, EPD_13IN3E_WHITE, EPD_13IN3E_BLACK);
+    int result = 0;
+    if (serve) {
+        result = Serve(replies, Image, Imagesize);
+    } else if (LoadImage(Pathname, Image, Imagesize) != 0) {
+        // Leave the panel showing what it had, rather than refreshing it to blank
+        printf("epd: EPD_13IN3E_Sleep\r\n");
+        EPD_13IN3E_Sleep();
+        result = 1;
+    } else {
+        ShowImage(Image, display_message ? message_ptr : NULL);
     }
-    printf("epd: EPD_13IN3E_Display\r\n");
-    EPD_13IN3E_Display(Image);
-    DEV_Delay_ms(1000);
 
-    printf("epd: EPD_13IN3E_Sleep\r\n");
-    EPD_13IN3E_Sleep();
     printf("epd: Freeing image memory\r\n");
     free(Image);
     Image = NULL;
     DEV_ModuleExit();
-    return 0; 
+    return result; 
 }
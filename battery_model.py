@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# battery_model.py - estimate how much charge each refresh and each idle hour costs,
+# predict how long the battery will last, and stretch the wake interval to make it last longer.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+
+import argparse, os, sys, logging
+from common_utils import *
+from image_database import *
+
+
+# Older observations fade by this factor each time a new one is added,
+# so the model follows the battery as it ages.
+DECAY = 0.98
+
+# Gaps between displays longer than this are probably not a single sleep cycle
+# (e.g. the frame was switched off), so they're left out.
+MAX_CYCLE_HOURS = 72
+
+# Observations needed before the model will make predictions
+MIN_WEIGHT = 3
+
+# If the sleep intervals barely vary, the per-refresh and per-hour costs can't be told
+# apart, and all the drain is put down to refreshing.  Measured in hours squared.
+MIN_HOURS_VARIANCE = 0.01
+
+# The PiSugar alarm is a time of day, so the interval can't reach a full day.
+MAX_ALARM_INTERVAL = 86200
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class DrainModel:
+    """ Fits charge used per sleep cycle as  drop = per_refresh + per_hour * hours,
+    by least squares over consecutive displays made on battery power.
+
+    Only the running sums are kept, in the battery_model table, so each wake
+    folds in its own history entry and nothing else.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+
+    def add_history(self, rows):
+        """ fold display history entries into the model
+        :param rows: list of (id, display_time, charging, charge_level), oldest first
+        """
+        s = self.state
+        for history_id, display_time, charging, charge_level in rows:
+            charging = bool(charging)
+            if (not charging and s['last_charging'] == False and
+                    charge_level is not None and s['last_level'] is not None):
+                hours = (display_time - s['last_time']) / 3600.0
+                drop = s['last_level'] - charge_level
+                # A rise in charge means it was plugged in at some point in between
+                if 0 < hours <= MAX_CYCLE_HOURS and drop >= 0:
+                    for key in ['weight', 'sum_hours', 'sum_hours_squared', 'sum_drop', 'sum_hours_drop']:
+                        s[key] *= DECAY
+                    s['weight'] += 1
+                    s['sum_hours'] += hours
+                    s['sum_hours_squared'] += hours * hours
+                    s['sum_drop'] += drop
+                    s['sum_hours_drop'] += hours * drop
+            if not charging and (s['last_charging'] != False or s['unplugged_time'] is None):
+                s['unplugged_time'] = display_time
+            s['last_history_id'] = history_id
+            s['last_time'] = display_time
+            s['last_level'] = charge_level
+            s['last_charging'] = charging
+
+
+    def ready(self):
+        return self.state['weight'] >= MIN_WEIGHT
+
+
+    def coefficients(self):
+        """ :return: (percent per refresh, percent per idle hour), or None if there isn't enough data """
+        if not self.ready():
+            return None
+        s = self.state
+        w = s['weight']
+        mean_hours = s['sum_hours'] / w
+        variance = s['sum_hours_squared'] / w - mean_hours * mean_hours
+        if variance < MIN_HOURS_VARIANCE:
+            return (s['sum_drop'] / w, 0.0)
+        per_hour = (s['sum_hours_drop'] / w - mean_hours * s['sum_drop'] / w) / variance
+        per_refresh = s['sum_drop'] / w - per_hour * mean_hours
+        if per_hour < 0:
+            return (s['sum_drop'] / w, 0.0)
+        if per_refresh < 0:
+            return (0.0, s['sum_hours_drop'] / s['sum_hours_squared'])
+        return (per_refresh, per_hour)
+
+
+    def predicted_days(self, level, interval):
+        """ how long the battery should last from the given level
+        :param level: charge level in percent
+        :param interval: seconds between wakes
+        :return: days, or None if the model can't say yet
+        """
+        coefficients = self.coefficients()
+        if coefficients is None or level is None:
+            return None
+        per_refresh, per_hour = coefficients
+        hours = interval / 3600.0
+        per_cycle = per_refresh + per_hour * hours
+        if per_cycle <= 0:
+            return None
+        return (level / per_cycle) * hours / 24.0
+
+
+    def interval_for_target(self, level, interval, target_days, now):
+        """ stretch the wake interval if needed so the battery lasts target_days
+        after it was last unplugged.  The interval is never shortened.
+        :param level: charge level in percent
+        :param interval: configured seconds between wakes
+        :param target_days: desired runtime on one charge
+        :param now: current time, in seconds since the epoch
+        :return: seconds until the next wake
+        """
+        coefficients = self.coefficients()
+        if coefficients is None or level is None or self.state['unplugged_time'] is None:
+            return interval
+        remaining_days = target_days - (now - self.state['unplugged_time']) / 86400.0
+        if remaining_days <= 0:
+            return interval
+        per_refresh, per_hour = coefficients
+        # Solve  (level / (per_refresh + per_hour * hours)) * hours / 24 = remaining_days  for hours
+        denominator = level / 24.0 - remaining_days * per_hour
+        if denominator <= 0:
+            return max(interval, MAX_ALARM_INTERVAL)
+        needed = int(remaining_days * per_refresh / denominator * 3600)
+        return max(interval, min(needed, MAX_ALARM_INTERVAL))
+
+
+def update_battery_model(cur):
+    """ fold any new display history into the stored drain model
+    :param cur: database cursor
+    :return: the updated DrainModel
+    """
+    model = DrainModel(get_battery_model_state_or_defaults(cur))
+    rows = get_display_history_since(cur, model.state['last_history_id'])
+    if rows:
+        model.add_history(rows)
+        set_battery_model_state(cur, model.state)
+    return model
+
+
+def rebuild_battery_model(cur):
+    """ discard the stored drain model and rebuild it from the whole display history
+    :param cur: database cursor
+    :return: the rebuilt DrainModel
+    """
+    get_battery_model_state_or_defaults(cur)
+    set_battery_model_state(cur, empty_battery_model_state())
+    return update_battery_model(cur)
+
+
+def report_battery_model(model, config):
+    coefficients = model.coefficients()
+    if coefficients is None:
+        logger.info("Not enough battery-powered displays recorded yet (%.1f of %s)." % (model.state['weight'], MIN_WEIGHT))
+        return
+    per_refresh, per_hour = coefficients
+    logger.info("Charge used per refresh: %.3f%%" % (per_refresh))
+    logger.info("Charge used per idle hour: %.4f%%" % (per_hour))
+    level = model.state['last_level']
+    interval = int(config['interval'])
+    if level is None:
+        return
+    days = model.predicted_days(level, interval)
+    if days is not None:
+        logger.info("At %s%% with a %s second interval, about %.1f days remaining." % (level, interval, days))
+    if 'targetdays' in config and model.state['last_charging'] == False:
+        stretched = model.interval_for_target(level, interval, float(config['targetdays']), model.state['last_time'])
+        logger.info("To last %s days on this charge, the next interval would be %s seconds." % (config['targetdays'], stretched))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Show the battery drain model built from the display history")
+    args.add_argument('--rebuild', action='store_true',
+                      help='Rebuild the model from the entire display history')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    database_file = os.path.join(config['installpath'], 'images.db')
+    conn = connect_to_local_db(database_file)
+    if not conn:
+        logger.error("Database could not be opened")
+        os._exit(os.EX_IOERR)
+    create_tables_if_missing(conn)
+    cur = conn.cursor()
+    if args.rebuild:
+        model = rebuild_battery_model(cur)
+    else:
+        model = update_battery_model(cur)
+    finish_with_database(conn, cur)
+
+    report_battery_model(model, config)
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# check_import_budget.py - make sure the wake path stays quick to import.
+# Runs "python -X importtime -c 'import cycle_image'" and fails if a heavy module
+# sneaks into the wake path, or if the total import time goes over budget.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, re, sys, logging
+import subprocess
+from common_utils import *
+
+
+# Modules that must only ever be loaded on demand during a wake.
+# (Any submodule of these counts too.)
+FORBIDDEN_MODULES = ['PIL', 'numpy', 'xml.dom.minidom', 'smbus', 'panel_frame', 'dither', 'png_to_bmp']
+
+# Default budget for importing cycle_image, in milliseconds.  This is for a Pi Zero 2W;
+# a desktop machine will come in well under it.
+DEFAULT_BUDGET_MS = 400
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def measure_imports(module_name):
+    """ import a module in a fresh interpreter with -X importtime
+    :param module_name: module to import
+    :return: list of (module, self microseconds, cumulative microseconds, depth)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+        cwd=here, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing %s failed:\n%s" % (module_name, result.stderr))
+    imports = []
+    for line in result.stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if m:
+            imports.append((m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2))
+    return imports
+
+
+def check_import_budget(module_name='cycle_image', budget_ms=DEFAULT_BUDGET_MS, runs=5):
+    """ check the import cost of a module against a budget
+    :return: True if the module is within budget and imports nothing forbidden
+    """
+    logger = logging.getLogger("epaper_frame")
+
+    best_total = None
+    imports = None
+    for _ in range(runs):
+        measured = measure_imports(module_name)
+        # The interpreter's own startup imports come first, so only look at what
+        # was imported on behalf of the module itself.  Each module is listed after
+        # everything it imported, so that's the run of lines ending with its own.
+        end = [i for i, m in enumerate(measured) if m[3] == 0 and m[0] == module_name][0]
+        start = end
+        while start > 0 and measured[start - 1][3] > 0:
+            start -= 1
+        measured = measured[start:end + 1]
+        total = measured[-1][2]
+        if best_total is None or total < best_total:
+            best_total = total
+            imports = measured
+
+    ok = True
+    for name, _, cumulative, _ in imports:
+        for forbidden in FORBIDDEN_MODULES:
+            if name == forbidden or name.startswith(forbidden + '.'):
+                logger.error("%s is imported on the wake path (%.1f ms)." % (name, cumulative / 1000))
+                ok = False
+
+    logger.info("Slowest imports:")
+    for name, self_us, cumulative, _ in sorted(imports, key=lambda m: m[1], reverse=True)[:10]:
+        logger.info("  %-30s %7.1f ms self, %7.1f ms cumulative" % (name, self_us / 1000, cumulative / 1000))
+
+    total_ms = best_total / 1000
+    if total_ms > budget_ms:
+        logger.error("Importing %s took %.1f ms, over the budget of %.1f ms." % (module_name, total_ms, budget_ms))
+        ok = False
+    else:
+        logger.info("Importing %s took %.1f ms, within the budget of %.1f ms." % (module_name, total_ms, budget_ms))
+    return ok
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Check that the wake path stays within its import budget")
+    args.add_argument('--module', type=str, default='cycle_image',
+                      help='Module to check')
+    args.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS, dest='budget_ms',
+                      help='Import time budget in milliseconds')
+    args.add_argument('--runs', type=int, default=5,
+                      help='Number of measurements, the fastest is used')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    if not check_import_budget(args.module, args.budget_ms, args.runs):
+        sys.exit(1)
@@ -1,16 +1,25 @@
 import os, sys, logging
-import xml.dom.minidom
 from datetime import datetime, tzinfo, timedelta
 
 
+# Parsed config.xml, kept so it's only read once per process
+_config = None
+
+
 # Read in the standard configuration file and return its parsed contents
 def read_config():
-	config = {}
+	global _config
+	if _config is not None:
+		return _config
 	if os.access("config.xml", os.F_OK):
+		# Imported here since it's slow to load and only needed once
+		import xml.dom.minidom
+		config = {}
 		config_xml = xml.dom.minidom.parse("config.xml")
 		for item in config_xml.documentElement.childNodes:
 			if item.nodeType == item.ELEMENT_NODE:
 				config[item.tagName] = item.firstChild.data
+		_config = config
 		return config
 	else:
 		return None
@@ -30,126 +30,478 @@
 # sudo ln -s ~/Documents/epaper_frame-color/cycle_image.service /etc/systemd/system/
 # sudo systemctl enable cycle_image.service
 
-import argparse, os, re, sys, random, logging
+import argparse, os, re, sys, logging
 import subprocess
-from send_png_to_display import send_png_to_display
+import threading
+from send_png_to_display import start_frame_data_display
+from display_client import DisplayClient
 from datetime import *
 from common_utils import *
 from image_database import *
 from pisugar_battery import PiSugarBattery
+from render_cache import RenderCache, frame_for_image
+from overlay import Overlay, battery_message, MESSAGE_X, MESSAGE_Y
+from wake_timeline import WakeTimeline, process_start_phases
+from battery_model import update_battery_model
+from time import monotonic, sleep
 
 
-def cycle_image(verbose=False, specific_id=None):
+# How often to check whether the frame has been unplugged, while staying resident
+CHARGING_POLL_SECONDS = 60
 
-    logger = logging.getLogger("epaper_frame")
-
-    # Instantiate the battery reader and do a first measurement
-    piSugarBattery = PiSugarBattery()
-    battery_charging_status = piSugarBattery.charging_status()
-    if battery_charging_status is not None:
-        initial_reading = piSugarBattery.refine_capacity()
-        logger.debug("PiSugar 3 battery initial reading: %2i%%." % (initial_reading))
-
-    real_time_clock = piSugarBattery.get_real_time_clock()
-    if real_time_clock is None:
-        logger.error("Error reading real time clock.")
-    else:
-        logger.info("PiSugar 3 clock time: %s" % (real_time_clock.isoformat()))
+# Shortest alarm to set when unplugged just before a refresh was due
+MIN_ALARM_SECONDS = 60
 
-    alarm_setting = piSugarBattery.get_alarm_timer()
-    if alarm_setting is None:
-        logger.error("Error reading alarm time.")
-    else:
-        d = datetime.fromtimestamp(alarm_setting, UTC)
-        tz_utc = fancytzutc()
-        d = d.replace(tzinfo=tz_utc)
-        logger.info("PiSugar 3 last alarm time: %s" % (d.isoformat()))
+# Images to try in one wake when they can't be rendered, before giving up until the next
+MAX_RENDER_ATTEMPTS = 3
 
-    config = read_config()
-    if config is None:
-        logger.error('Error reading your config.xml file!')
-        sys.exit(2)
+# What to draw over the image, used when config.xml doesn't set <overlay>.
+# Fields are {battery}, {group}, {filename}, and {date}.
+DEFAULT_OVERLAY = '{battery}'
 
-    conn = None
-    cur = None
 
-    # create a database connection
-    database_file = os.path.join(config['installpath'], 'images.db')
-    conn = connect_to_local_db(database_file)
-    if not conn:
-        logger.error("Database could not be opened")
-        os._exit(os.EX_IOERR)
-    create_tables_if_missing(conn)
-    cur = conn.cursor()
+def stage_frame(render_cache, image, image_path, failed):
+    """ render the next image into the cache.  Runs in the background,
+    and a failure here must never spoil the current wake.
+    :param failed: list the image is added to if it couldn't be rendered
+    """
+    logger = logging.getLogger("epaper_frame")
+    try:
+        frame_for_image(render_cache, image, image_path)
+    except Exception as e:
+        logger.error("Could not stage %s: %s" % (image_path, e))
+        failed.append(image)
 
-    status = get_status_or_defaults(cur, None, None)
 
-    images = get_all_images(cur)
-    if verbose:
-        logger.info("%s images in library." % (len(images)))
-        if status['last_display'] is not None:
-            last_display_datetime = datetime.fromtimestamp(status['last_display'], UTC)
-            logger.info("Last run at %s." % (pretty_datetime(last_display_datetime)))
+def overlay_message(config, image, capacity):
+    """ fill in the overlay text for an image
+    :return: the text, or None if there's nothing to show
+    """
+    logger = logging.getLogger("epaper_frame")
+    fields = {
+        'battery': battery_message(capacity) if capacity is not None else '',
+        'group': image.group_name,
+        'filename': image.filename,
+        'date': datetime.now().strftime('%Y-%m-%d'),
+    }
+    try:
+        message = config.get('overlay', DEFAULT_OVERLAY).format(**fields)
+    except (KeyError, IndexError, ValueError) as e:
+        logger.error("Could not use the overlay from config.xml: %s" % (e))
+        message = DEFAULT_OVERLAY.format(**fields)
+    if message.strip() == '':
+        return None
+    return message
 
-    chosen_image = None
-    if len(images) > 0:
-        chosen_index = random.randint(0, int(len(images) / 2))
-        chosen_image = images[chosen_index]
 
-    if verbose:
-        logger.info("Chose image %s/%s." % (chosen_image['group_name'], chosen_image['filename']))
-        if chosen_image['last_display'] is None:
-            logger.info("First time displaying this image.")
-        else:
-            last_display_datetime = datetime.fromtimestamp(chosen_image['last_display'], UTC)
-            logger.info("Display count %s, last displayed %s." % (chosen_image['display_count'], last_display_datetime))
+def open_database(config, read_only=False):
+    """ open the database, bringing its schema up to date if it's opened for writing.
+    If it can't be opened read-only (say it needs a migration), it's opened for writing instead.
+    :return: connection and cursor
+    """
+    logger = logging.getLogger("epaper_frame")
+    database_file = os.path.join(config['installpath'], 'images.db')
+    conn = connect_to_local_db(database_file, read_only=True) if read_only else None
+    if conn is None:
+        conn = connect_to_local_db(database_file)
+        if not conn:
+            logger.error("Database could not be opened")
+            os._exit(os.EX_IOERR)
+        create_tables_if_missing(conn)
+    return conn, conn.cursor()
 
-    image_path = os.path.join(config['library'], chosen_image['group_name'], chosen_image['filename'])
 
-    capacity = None
-    message = None
-    if battery_charging_status is not None:
-        capacity = piSugarBattery.refine_capacity()
-        message = "%2i%%" % capacity
-        if verbose:
-            logger.info("PiSugar 3 battery second reading: %2i%%." % (capacity))
+def reopen_for_writing(config, conn, cur):
+    """ swap a read-only connection for one that can write
+    :return: connection and cursor
+    """
+    finish_with_database(conn, cur)
+    return open_database(config)
 
-    send_png_to_display(verbose, image_path, message)
-    report_image_as_displayed(cur, chosen_image['id'], battery_charging_status, capacity)
 
-    current_date = calendar.timegm(datetime.now(UTC).utctimetuple())
-    status['last_display'] = current_date
-    set_status(cur, status)
+def set_power_state(verbose, piSugarBattery, battery_charging_status, interval, timeline):
+    """ switch the wifi to suit the power source, and on battery, set the alarm for the next wake """
 
-    finish_with_database(conn, cur)
+    logger = logging.getLogger("epaper_frame")
 
     if battery_charging_status is None:
         if verbose:
             logger.warning("PiSugar 3 battery status is undetermined.  Will remain powered on and enable wifi.")
-        subprocess.check_call("sudo iwconfig wlan0 txpower on", shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT)
+        with timeline.phase('wifi'):
+            subprocess.check_call(["sudo", "iwconfig", "wlan0", "txpower", "on"], stdout=sys.stdout, stderr=subprocess.STDOUT)
 
     elif battery_charging_status == True:
         if verbose:
             logger.info("PiSugar 3 battery is charging.  Will remain powered on and enable wifi.")
-        subprocess.check_call("sudo iwconfig wlan0 txpower on", shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT)
+        with timeline.phase('wifi'):
+            subprocess.check_call(["sudo", "iwconfig", "wlan0", "txpower", "on"], stdout=sys.stdout, stderr=subprocess.STDOUT)
 
     else:
         if verbose:
-            logger.info("On battery power.  Will disable wifi and power down automatically.")
-        subprocess.check_call("sudo iwconfig wlan0 txpower off", shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT)
+            logger.info("On battery power.  Will disable wifi and power down.")
+        with timeline.phase('wifi'):
+            subprocess.check_call(["sudo", "iwconfig", "wlan0", "txpower", "off"], stdout=sys.stdout, stderr=subprocess.STDOUT)
+
+        # Set even if the refresh fails, so the frame still wakes up again.
+        with timeline.phase('alarm'):
+            if piSugarBattery.set_alarm_for_seconds_from_now(interval) == False:
+                logger.error("Failed to set new wakeup time in PiSugar 3!")
+
+
+def show_image(verbose, config, conn, cur, piSugarBattery, battery_charging_status, capacity, timeline, specific_id=None, display=None):
+    """ choose an image, send it to the panel, and record it.  Housekeeping for the
+    next refresh happens while the panel is busy, and is committed before waiting for it.
+    If display is a DisplayClient, the image is sent to it rather than to a new process.
+    If conn is read-only, it's swapped for one that can write once there's something to write.
+    :return: the connection and cursor in use at the end, for the caller to finish with
+    """
+
+    logger = logging.getLogger("epaper_frame")
+
+    read_only = connection_is_read_only(conn)
+
+    with timeline.phase('selection'):
+        if verbose:
+            logger.info("%s images in library." % (count_displayable_images(cur)))
+            status = get_status(cur)
+            if status is not None and status['last_display'] is not None:
+                last_display_datetime = datetime.fromtimestamp(status['last_display'], UTC)
+                logger.info("Last run at %s." % (pretty_datetime(last_display_datetime)))
+
+        # The last wake usually chose and rendered this one already
+        chosen_image = None
+        if specific_id is None:
+            chosen_image = get_staged_image(cur)
+            if verbose and chosen_image is not None:
+                logger.info("Using the image staged by the last wake.")
+        if chosen_image is None:
+            # Choosing takes the image off the selection queue
+            if read_only and specific_id is None:
+                conn, cur = reopen_for_writing(config, conn, cur)
+                read_only = False
+            chosen_image = choose_image_to_display(cur, specific_id, **selection_options(config))
+
+    if chosen_image is None:
+        if specific_id is not None:
+            logger.error("No image with id %s in the library." % (specific_id))
+            finish_with_database(conn, cur)
+            sys.exit(2)
+        logger.error("No images in the library.  Run png_inventory.py first.")
+
+    if capacity is not None and verbose:
+        logger.info("PiSugar 3 battery reading: %2i%%." % (capacity))
+
+    # Use the cached display-ready frame if there is one, otherwise render it in memory.
+    # Either way nothing is written to the card just to show it.  An image that can't be
+    # rendered is skipped, and that's committed right away, so that one bad file can't
+    # stop every wake that follows.
+    render_cache = RenderCache.from_config(config)
+    clean_frame = None
+    failures = 0
+    with timeline.phase('render'):
+        while chosen_image is not None and failures < MAX_RENDER_ATTEMPTS:
+            if verbose:
+                logger.info("Chose image %s/%s." % (chosen_image.group_name, chosen_image.filename))
+                if chosen_image.last_display is None:
+                    logger.info("First time displaying this image.")
+                else:
+                    last_display_datetime = datetime.fromtimestamp(chosen_image.last_display, UTC)
+                    logger.info("Display count %s, last displayed %s." % (chosen_image.display_count, last_display_datetime))
+            image_path = os.path.join(config['library'], chosen_image.group_name, chosen_image.filename)
+            try:
+                clean_frame = render_cache.load(chosen_image)
+                cached = clean_frame is not None
+                if not cached:
+                    from panel_frame import render_frame
+                    clean_frame = render_frame(image_path)
+                elif verbose:
+                    logger.info("Using cached frame.")
+                break
+            except Exception as e:
+                logger.error("Could not render %s, skipping it: %s" % (image_path, e))
+            failures += 1
+            if read_only:
+                conn, cur = reopen_for_writing(config, conn, cur)
+                read_only = False
+            # It's already off the selection queue, so it won't come up again this pass
+            clear_staged_image(cur, chosen_image.id)
+            chosen_image = None if specific_id is not None else choose_image_to_display(cur, **selection_options(config))
+            conn.commit()
+
+    if clean_frame is None:
+        if failures > 0:
+            logger.error("Could not render %s images, giving up until the next refresh." % (failures))
+        # Still set the alarm, so the frame wakes up again to try something else
+        set_power_state(verbose, piSugarBattery, battery_charging_status, int(config['interval']), timeline)
+        conn.commit()
+        return conn, cur
+
+    # The overlay is drawn onto a copy, touching only the bytes under it,
+    # so the clean frame can still be cached.
+    with timeline.phase('overlay'):
+        frame = bytearray(clean_frame)
+        message = overlay_message(config, chosen_image, capacity)
+        if message is not None:
+            Overlay().add_text(MESSAGE_X, MESSAGE_Y, message).apply(frame)
+
+    # Start the refresh, and do everything that doesn't depend on it while the panel is busy.
+    with timeline.phase('panel_start'):
+        refresh = start_frame_data_display(verbose, frame, None, display)
+
+    # This image won't come up again until the rest of the library has been shown,
+    # so only keep its frame if that doesn't push out one that's needed sooner.
+    if not cached and render_cache.has_room():
+        with timeline.phase('cache_store'):
+            render_cache.store(chosen_image, clean_frame)
+
+    with timeline.phase('db_update'):
+        if read_only:
+            conn, cur = reopen_for_writing(config, conn, cur)
+        history_id = report_image_as_displayed(cur, chosen_image.id, battery_charging_status, capacity)
+
+        # Read the status again, since a library sync may have recorded itself since the wake started
+        status = get_status_or_defaults(cur, None, None)
+        current_date = calendar.timegm(datetime.now(UTC).utctimetuple())
+        status['last_display'] = current_date
+        set_status(cur, status)
+
+    # Fold this display into the battery drain model, and stretch the interval
+    # if that's what it takes to reach the target runtime.
+    interval = int(config['interval'])
+    with timeline.phase('drain_model'):
+        drain_model = update_battery_model(cur)
+        if battery_charging_status == False and 'targetdays' in config:
+            interval = drain_model.interval_for_target(capacity, interval, float(config['targetdays']), current_date)
+    if verbose and battery_charging_status == False:
+        days = drain_model.predicted_days(capacity, interval)
+        if days is not None:
+            logger.info("Predicted battery life remaining: %.1f days." % (days))
+        if interval != int(config['interval']):
+            logger.info("Stretching the wake interval to %s seconds." % (interval))
+
+    # Choose the next image now, using the counts we just updated, and render it
+    # in the background.  The CPU is otherwise idle while the panel refreshes.
+    stager = None
+    with timeline.phase('stage_next'):
+        # An image asked for with --id doesn't use up the staged one, so that's still next
+        next_image = None
+        if specific_id is not None:
+            next_image = get_staged_image(cur)
+            if next_image is not None and next_image.id == chosen_image.id:
+                next_image = None
+        if next_image is None:
+            next_image = choose_image_to_display(cur, **selection_options(config))
+            if next_image is not None:
+                set_staged_image(cur, next_image.id)
+        if next_image is not None:
+            next_path = os.path.join(config['library'], next_image.group_name, next_image.filename)
+            stage_failed = []
+            stager = threading.Thread(target=stage_frame, args=(render_cache, next_image, next_path, stage_failed))
+            stager.start()
+
+    # Commit before waiting on the panel, so the web server and library sync, which run
+    # alongside while charging, aren't locked out of the database for the whole refresh.
+    # If the refresh then fails, this wake is still recorded as a display.
+    with timeline.phase('db_commit'):
+        conn.commit()
+
+    set_power_state(verbose, piSugarBattery, battery_charging_status, interval, timeline)
 
-        if piSugarBattery.set_alarm_for_seconds_from_now(int(config['interval'])) == False:
-            logger.error("Failed to set new wakeup time in PiSugar 3!")
+    with timeline.phase('panel_wait'):
+        refresh.finish()
+
+    if stager is not None:
+        with timeline.phase('stage_wait'):
+            stager.join()
+        if stage_failed:
+            # Otherwise the next wake would start by trying it again
+            clear_staged_image(cur, next_image.id)
+        elif verbose:
+            logger.info("Staged %s/%s for the next wake." % (next_image.group_name, next_image.filename))
+
+    record_wake_phases(cur, history_id, timeline.phases)
+    if verbose:
+        logger.debug("Wake phase timings:")
+        timeline.log()
+
+    conn.commit()
+    return conn, cur
+
+
+def start_background_script(verbose, script_name, arguments=[]):
+    """ start one of the other scripts alongside this one
+    :return: the process
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script_name)] + arguments
+    if not verbose:
+        command.append('--quiet')
+    return subprocess.Popen(command)
+
+
+def start_background_work(verbose, config):
+    """ start the management server and the library sync, if config.xml asks for them.
+    The wifi is on while charging, so this is when they're useful.
+    :return: list of processes
+    """
+    logger = logging.getLogger("epaper_frame")
+    processes = []
+    if 'webport' in config:
+        logger.info("Starting the management server on port %s." % (config['webport']))
+        processes.append(start_background_script(verbose, 'web_server.py', ['--port', config['webport']]))
+    if 'syncurl' in config:
+        logger.info("Starting a library sync from %s." % (config['syncurl']))
+        processes.append(start_background_script(verbose, 'library_sync.py'))
+    return processes
+
+
+def stop_background_work(processes):
+    """ stop any background scripts that are still running.  An interrupted sync
+    picks up where it left off next time.
+    """
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def stay_resident(verbose, config, conn, cur, piSugarBattery, display, background=[]):
+    """ while charging, keep running and refresh the frame every interval, with the
+    database open, everything already loaded, and the display helper running.  As soon as charging stops, set the
+    alarm for when the next refresh was due and power down, as a battery wake would.
+    """
+
+    logger = logging.getLogger("epaper_frame")
+
+    interval = int(config['interval'])
+    logger.info("Charging.  Staying resident and refreshing every %s seconds." % (interval))
+    next_refresh = monotonic() + interval
+    while True:
+        sleep(max(0, min(CHARGING_POLL_SECONDS, next_refresh - monotonic())))
+
+        piSugarBattery.snapshot()
+        battery_charging_status = piSugarBattery.charging_status()
+
+        if battery_charging_status == False:
+            remaining = max(int(next_refresh - monotonic()), MIN_ALARM_SECONDS)
+            logger.info("No longer charging.  Will wake up in %s seconds and power down now." % (remaining))
+            set_power_state(verbose, piSugarBattery, False, remaining, WakeTimeline())
+            stop_background_work(background)
+            display.close()
+            finish_with_database(conn, cur)
+            subprocess.check_call(["sudo", "shutdown", "-P", "now"], stdout=sys.stdout, stderr=subprocess.STDOUT)
+            return
+
+        if monotonic() >= next_refresh:
+            # A failed bus read counts as still charging, since we're still running.
+            timeline = WakeTimeline()
+            capacity = piSugarBattery.refine_capacity() if battery_charging_status else None
+            try:
+                conn, cur = show_image(verbose, config, conn, cur, piSugarBattery, True, capacity, timeline, display=display)
+            except sqlite3.OperationalError as e:
+                # The web server or a library sync held the database for longer than the busy
+                # timeout.  Drop whatever wasn't committed and try again at the next check.
+                # Closing the display helper waits for a refresh that was already started.
+                logger.error("Database is busy, could not refresh: %s" % (e))
+                conn.rollback()
+                display.close()
+                next_refresh = monotonic() + CHARGING_POLL_SECONDS
+                continue
+            except (RuntimeError, OSError) as e:
+                # The display helper reported an error or went away.  It's started
+                # again for the next refresh, which comes after a full interval.
+                logger.error("Refresh failed: %s" % (e))
+                conn.rollback()
+                display.close()
+            next_refresh = monotonic() + interval
+
+
+def cycle_image(verbose=False, specific_id=None, resident=True):
+
+    logger = logging.getLogger("epaper_frame")
+
+    # Time each phase of the wake, starting with how long it took to get here
+    timeline = WakeTimeline()
+    for name, seconds in process_start_phases():
+        timeline.add(name, seconds)
+
+    # Instantiate the battery reader and take a snapshot of its registers,
+    # which everything else in this wake reads from
+    capacity = None
+    with timeline.phase('battery_probe'):
+        piSugarBattery = PiSugarBattery()
+        piSugarBattery.snapshot()
+        battery_charging_status = piSugarBattery.charging_status()
+        if battery_charging_status is not None:
+            capacity = piSugarBattery.refine_capacity()
+
+    with timeline.phase('rtc_read'):
+        real_time_clock = piSugarBattery.get_real_time_clock()
+        alarm_setting = piSugarBattery.get_alarm_timer()
+
+    if real_time_clock is None:
+        logger.error("Error reading real time clock.")
+    else:
+        logger.info("PiSugar 3 clock time: %s" % (real_time_clock.isoformat()))
+
+    if alarm_setting is None:
+        logger.error("Error reading alarm time.")
+    else:
+        d = datetime.fromtimestamp(alarm_setting, UTC)
+        tz_utc = fancytzutc()
+        d = d.replace(tzinfo=tz_utc)
+        logger.info("PiSugar 3 last alarm time: %s" % (d.isoformat()))
+
+    with timeline.phase('config'):
+        config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    staying_resident = battery_charging_status == True and resident
+
+    # create a database connection.  For a single refresh, the image was usually chosen by
+    # the last wake, so nothing needs writing until the panel has started.
+    with timeline.phase('db_open'):
+        conn, cur = open_database(config, read_only=not staying_resident)
+
+    if staying_resident:
+        # There will be more than one refresh, so keep the display utility running between them
+        display = DisplayClient.from_config(config, verbose)
+        background = []
+        try:
+            conn, cur = show_image(verbose, config, conn, cur, piSugarBattery, battery_charging_status, capacity, timeline, specific_id, display)
+            # Started after the first refresh, so they don't slow that down
+            background = start_background_work(verbose, config)
+            # Deleting old history means writes to the card, so only do it while charging
+            from display_stats import compact_old_history
+            compact_old_history(config, cur)
+            conn.commit()
+            stay_resident(verbose, config, conn, cur, piSugarBattery, display, background)
+        finally:
+            stop_background_work(background)
+            display.close()
+        return
+
+    conn, cur = show_image(verbose, config, conn, cur, piSugarBattery, battery_charging_status, capacity, timeline, specific_id)
+
+    finish_with_database(conn, cur)
 
-        subprocess.check_call("sudo shutdown -P now", shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT)
+    if battery_charging_status == False:
+        subprocess.check_call(["sudo", "shutdown", "-P", "now"], stdout=sys.stdout, stderr=subprocess.STDOUT)
 
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser(description="Choose an image from the library and display it")
     args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
                       help="reduce log output")
-    args.add_argument('--id', type=str, default=None, dest='specific_id',
+    args.add_argument('--id', type=int, default=None, dest='specific_id',
                       help='Specific image ID to display', required=False)
+    args.add_argument('--single', action='store_false', dest='resident',
+                      help='Exit after one refresh even when charging, instead of staying resident')
     args = args.parse_args()
 
     set_up_logger()
@@ -157,4 +509,5 @@ if __name__ == "__main__":
     cycle_image(
         verbose=args.verbose,
         specific_id=args.specific_id,
+        resident=args.resident,
     )
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# database_benchmark.py - count the bytes written and the syncs SQLite asks for on each wake,
+# under the old way of opening the database and under each storage profile.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, sys, logging
+import ctypes
+import ctypes.util
+import shutil
+import tempfile
+from collections import Counter
+from time import monotonic
+from common_utils import *
+from image_database import *
+from battery_model import update_battery_model
+from wake_timeline import WAKE_PHASES
+
+
+# Images per group in the synthetic database
+IMAGES_PER_GROUP = 500
+
+# SQLite's flags for the kind of file being opened
+SQLITE_OPEN_FILE_KINDS = [
+    (0x00000100, 'database'),
+    (0x00000800, 'journal'),
+    (0x00080000, 'wal'),
+]
+
+VOID = ctypes.c_void_p
+X_OPEN = ctypes.CFUNCTYPE(ctypes.c_int, VOID, VOID, VOID, ctypes.c_int, ctypes.POINTER(ctypes.c_int))
+X_DELETE = ctypes.CFUNCTYPE(ctypes.c_int, VOID, ctypes.c_char_p, ctypes.c_int)
+X_WRITE = ctypes.CFUNCTYPE(ctypes.c_int, VOID, VOID, ctypes.c_int, ctypes.c_int64)
+X_SYNC = ctypes.CFUNCTYPE(ctypes.c_int, VOID, ctypes.c_int)
+
+
+class SqliteVfs(ctypes.Structure):
+    """ struct sqlite3_vfs, version 3 """
+    _fields_ = [
+        ('iVersion', ctypes.c_int),
+        ('szOsFile', ctypes.c_int),
+        ('mxPathname', ctypes.c_int),
+        ('pNext', VOID),
+        ('zName', ctypes.c_char_p),
+        ('pAppData', VOID),
+        ('xOpen', X_OPEN),
+        ('xDelete', X_DELETE)] + [(name, VOID) for name in [
+        'xAccess', 'xFullPathname', 'xDlOpen', 'xDlError', 'xDlSym', 'xDlClose', 'xRandomness',
+        'xSleep', 'xCurrentTime', 'xGetLastError', 'xCurrentTimeInt64',
+        'xSetSystemCall', 'xGetSystemCall', 'xNextSystemCall']]
+
+
+class SqliteIoMethods(ctypes.Structure):
+    """ struct sqlite3_io_methods, version 3 """
+    _fields_ = [
+        ('iVersion', ctypes.c_int),
+        ('xClose', VOID),
+        ('xRead', VOID),
+        ('xWrite', X_WRITE),
+        ('xTruncate', VOID),
+        ('xSync', X_SYNC)] + [(name, VOID) for name in [
+        'xFileSize', 'xLock', 'xUnlock', 'xCheckReservedLock', 'xFileControl', 'xSectorSize',
+        'xDeviceCharacteristics', 'xShmMap', 'xShmLock', 'xShmBarrier', 'xShmUnmap', 'xFetch', 'xUnfetch']]
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class CountingVfs:
+    """ Wraps SQLite's default VFS, counting the bytes written to each kind of file and the
+    syncs asked for, and registers itself as the new default.  Only writes and syncs go
+    through Python: each open file keeps the real VFS's methods for everything else, so the
+    counting costs little.  Syncs include the ones SQLite asks for on a directory after
+    creating or deleting a journal.  This relies on Python's sqlite3 module using the
+    shared SQLite library, as it does on Raspberry Pi OS.
+    """
+
+    def __init__(self):
+        library_name = ctypes.util.find_library('sqlite3')
+        if library_name is None:
+            raise RuntimeError("Could not find the SQLite library")
+        self.library = ctypes.CDLL(library_name)
+        self.library.sqlite3_vfs_find.restype = ctypes.POINTER(SqliteVfs)
+        self.library.sqlite3_vfs_find.argtypes = [ctypes.c_char_p]
+        self.library.sqlite3_vfs_register.argtypes = [ctypes.POINTER(SqliteVfs), ctypes.c_int]
+
+        self.counts = Counter()
+        self.file_kinds = {}
+        # Original method table address -> our copy, plus the callbacks it points to
+        self.methods = {}
+
+        self.real_pointer = self.library.sqlite3_vfs_find(None)
+        self.real = self.real_pointer.contents
+        self.vfs = SqliteVfs()
+        ctypes.pointer(self.vfs)[0] = self.real
+        self.vfs.zName = b'counting'
+        self.vfs.pNext = None
+        self.vfs.xOpen = X_OPEN(self.x_open)
+        self.vfs.xDelete = X_DELETE(self.x_delete)
+        self.library.sqlite3_vfs_register(ctypes.byref(self.vfs), 1)
+
+
+    def x_open(self, vfs, name, file, flags, out_flags):
+        result = self.real.xOpen(ctypes.cast(self.real_pointer, VOID), name, file, flags, out_flags)
+        methods_pointer = ctypes.cast(file, ctypes.POINTER(VOID))
+        if result == 0 and methods_pointer[0]:
+            kind = 'other'
+            for flag, name in SQLITE_OPEN_FILE_KINDS:
+                if flags & flag:
+                    kind = name
+                    break
+            self.file_kinds[file] = kind
+            self.counts['opens'] += 1
+            methods_pointer[0] = self.counting_methods(methods_pointer[0])
+        return result
+
+
+    def x_delete(self, vfs, name, sync_directory):
+        self.counts['deletes'] += 1
+        if sync_directory:
+            self.counts['syncs'] += 1
+        return self.real.xDelete(ctypes.cast(self.real_pointer, VOID), name, sync_directory)
+
+
+    def counting_methods(self, original_address):
+        """ a copy of a file's method table, with writes and syncs counted
+        :return: address of the copy
+        """
+        if original_address not in self.methods:
+            original = ctypes.cast(original_address, ctypes.POINTER(SqliteIoMethods)).contents
+            real_write = original.xWrite
+            real_sync = original.xSync
+
+            def x_write(file, buffer, amount, offset):
+                kind = self.file_kinds.get(file, 'other')
+                self.counts[kind + '_bytes'] += amount
+                self.counts['writes'] += 1
+                return real_write(file, buffer, amount, offset)
+
+            def x_sync(file, flags):
+                self.counts['syncs'] += 1
+                return real_sync(file, flags)
+
+            methods = SqliteIoMethods()
+            ctypes.pointer(methods)[0] = original
+            methods.xWrite = X_WRITE(x_write)
+            methods.xSync = X_SYNC(x_sync)
+            self.methods[original_address] = methods
+        return ctypes.addressof(self.methods[original_address])
+
+
+def make_synthetic_database(database_file, image_count, wake_count, legacy, profile):
+    """ fill a new database with image_count images and wake_count wakes of history
+    :param legacy: leave it as the code before schema versions would have
+    """
+    conn = connect_to_local_db(database_file, profile=profile)
+    if legacy:
+        migrate_to_version_1(conn)
+    else:
+        create_tables_if_missing(conn)
+    cur = conn.cursor()
+    images = []
+    for i in range(image_count):
+        if i % IMAGES_PER_GROUP == 0:
+            group_id = get_or_insert_image_group(cur, 'group%04d' % (i // IMAGES_PER_GROUP))['id']
+        images.append({'group_id': group_id, 'filename': 'image%06d.png' % i, 'size': 500000, 'file_modified_time': 1.0})
+    insert_images(cur, images)
+    for _ in range(wake_count):
+        image = choose_image_to_display(cur)
+        history_id = report_image_as_displayed(cur, image.id, False, 80)
+        record_wake_phases(cur, history_id, [(phase, 0.1) for phase in WAKE_PHASES])
+    get_status_or_defaults(cur, None, None)
+    update_battery_model(cur)
+    set_staged_image(cur, choose_image_to_display(cur).id)
+    finish_with_database(conn, cur)
+
+
+def database_wake(database_file, legacy, profile):
+    """ make the database calls that cycle_image makes on a battery wake
+    :param legacy: open the database the way the code did before schema versions
+    :return: seconds until the image was chosen, and seconds for the whole wake
+    """
+    start = monotonic()
+    if legacy:
+        conn = connect_to_local_db(database_file, profile=profile)
+        migrate_to_version_1(conn)
+    else:
+        conn = connect_to_local_db(database_file, read_only=True, profile=profile)
+        if conn is None:
+            raise RuntimeError("Could not open the database read-only")
+    cur = conn.cursor()
+    image = get_staged_image(cur)
+    chosen = monotonic() - start
+
+    # The panel would start here
+    if not legacy:
+        finish_with_database(conn, cur)
+        conn = connect_to_local_db(database_file, profile=profile)
+        create_tables_if_missing(conn)
+        cur = conn.cursor()
+    history_id = report_image_as_displayed(cur, image.id, False, 80)
+    status = get_status_or_defaults(cur, None, None)
+    status['last_display'] = image.last_display
+    set_status(cur, status)
+    update_battery_model(cur)
+    set_staged_image(cur, choose_image_to_display(cur).id)
+    record_wake_phases(cur, history_id, [(phase, 0.1) for phase in WAKE_PHASES])
+    finish_with_database(conn, cur)
+    return chosen, monotonic() - start
+
+
+def benchmark_storage(image_counts, wake_count, history_count):
+    """ run wakes against synthetic databases under the old way of opening the database
+    and under each storage profile, and log what each wake wrote
+    """
+    counter = CountingVfs()
+    # Each configuration: (name, open the old way, storage profile)
+    configurations = [('old', True, 'default')] + [(profile, False, profile) for profile in STORAGE_PROFILES]
+    logger.setLevel("INFO")
+    root = tempfile.mkdtemp(prefix='epaper_db_')
+    try:
+        for image_count in image_counts:
+            logger.info("%s images, %s wakes of history, per wake:" % (image_count, history_count))
+            for name, legacy, profile in configurations:
+                database_file = os.path.join(root, '%s-%d.db' % (name, image_count))
+                make_synthetic_database(database_file, image_count, history_count, legacy, profile)
+                counter.counts.clear()
+                chosen = []
+                total = []
+                for _ in range(wake_count):
+                    c, t = database_wake(database_file, legacy, profile)
+                    chosen.append(c)
+                    total.append(t)
+                if counter.counts['opens'] == 0:
+                    raise RuntimeError("Python's sqlite3 module isn't using the shared SQLite library, so nothing was counted")
+                counts = dict((k, v / wake_count) for k, v in counter.counts.items())
+                logger.info("  %-8s %6.1f KB to the database, %6.1f KB to the journal, %5.1f KB to the WAL, "
+                            "%4.1f syncs, %4.1f files opened, %4.1f deleted, image chosen in %5.2f ms, wake %5.2f ms" % (
+                    name, counts.get('database_bytes', 0) / 1024, counts.get('journal_bytes', 0) / 1024,
+                    counts.get('wal_bytes', 0) / 1024, counts.get('syncs', 0), counts.get('opens', 0),
+                    counts.get('deletes', 0), min(chosen) * 1000, min(total) * 1000))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Count what each wake writes to the database, under each storage profile")
+    args.add_argument('--images', type=int, nargs='+', default=[1000, 10000],
+                      help='Library sizes to simulate')
+    args.add_argument('--wakes', type=int, default=20,
+                      help='Wakes to measure for each library size and profile')
+    args.add_argument('--history', type=int, default=365,
+                      help='Wakes of display history to start with')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    benchmark_storage(args.images, args.wakes, args.history)
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# display_client.py - keep the display utility running in serve mode and send it images,
+# so refreshes after the first skip its start-up cost.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+
+import argparse, os, re, sys, logging
+import subprocess
+from time import monotonic
+from common_utils import *
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+def clean_message(message):
+    """ make an overlay message safe to pass to the display utility, on the
+    command line or in a serve mode command
+    """
+    message = message[0:80]
+    return re.sub(r'[\t\r\n]', " ", message)
+
+
+class DisplayRequest:
+    """ An image sent to the display helper.  Like DisplayRefresh in send_png_to_display,
+    other work can be done until finish() is called.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+
+    def finish(self):
+        """ wait for the panel to finish refreshing
+        :raises RuntimeError: if the helper reported an error or went away
+        """
+        reply = self.client.process.stdout.readline().decode('utf-8', 'replace').strip()
+        if reply != 'OK':
+            raise RuntimeError("Display helper failed: %s" % (reply or 'no reply'))
+
+
+class DisplayClient:
+    """ Runs the display utility with --serve and sends it one image per refresh.
+    The utility initializes the module and allocates its image memory once, and
+    only wakes the panel for each refresh.
+    """
+
+    def __init__(self, command_path, verbose=False, stderr=None):
+        self.command_path = command_path
+        self.verbose = verbose
+        self.stderr = stderr
+        self.process = None
+
+
+    @classmethod
+    def from_config(cls, config, verbose=False):
+        return cls(os.path.join(config['installpath'], "EPD_13in3e_Utility/eps13in3eutility"), verbose)
+
+
+    def start(self):
+        if self.process is None or self.process.poll() is not None:
+            if self.verbose:
+                logger.debug("Starting display helper %s" % (self.command_path))
+            self.process = subprocess.Popen([self.command_path, '--serve'],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr)
+        return self
+
+
+    def _send(self, header, payload=None):
+        self.start()
+        self.process.stdin.write(header.encode('utf-8'))
+        if payload is not None:
+            self.process.stdin.write(payload)
+        self.process.stdin.flush()
+        return DisplayRequest(self)
+
+
+    def start_file(self, path, message=None):
+        """ start showing a BMP or packed .frame file
+        :return: DisplayRequest
+        """
+        if '\t' in path or '\n' in path:
+            raise ValueError("Can't send a path containing tabs or newlines: %r" % (path))
+        return self._send("SHOW\t%s\t%s\n" % (path, clean_message(message or '')))
+
+
+    def start_frame(self, frame, message=None):
+        """ start showing a packed display buffer held in memory
+        :return: DisplayRequest
+        """
+        return self._send("FRAME\t%d\t%s\n" % (len(frame), clean_message(message or '')), frame)
+
+
+    def show_file(self, path, message=None):
+        self.start_file(path, message).finish()
+
+
+    def show_frame(self, frame, message=None):
+        self.start_frame(frame, message).finish()
+
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"QUIT\n")
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def benchmark_display_client(command_path, frame_file, refresh_count):
+    """ compare starting the utility for each refresh with sending every refresh to one helper.
+    Meant to be run against the mock build (make mock), or on the frame itself.
+    """
+    start = monotonic()
+    for _ in range(refresh_count):
+        subprocess.check_call([command_path, frame_file, '50%'], stdout=subprocess.DEVNULL)
+    spawned = monotonic() - start
+
+    start = monotonic()
+    with DisplayClient(command_path, stderr=subprocess.DEVNULL) as client:
+        for _ in range(refresh_count):
+            client.show_file(frame_file, '50%')
+    served = monotonic() - start
+
+    logger.info("One process per refresh: %.2f seconds per refresh" % (spawned / refresh_count))
+    logger.info("One helper for all:      %.2f seconds per refresh" % (served / refresh_count))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Time refreshes through the display helper against one process per refresh")
+    args.add_argument('--utility', type=str, dest='command_path',
+                      default='EPD_13in3e_Utility/eps13in3eutility-mock',
+                      help='Display utility to run, e.g. the mock build')
+    args.add_argument('--in', type=str, dest='frame_file', required=True,
+                      help='BMP or packed .frame file to show')
+    args.add_argument('--refreshes', type=int, default=5,
+                      help='Number of refreshes to time each way')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    benchmark_display_client(args.command_path, args.frame_file, args.refreshes)
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# display_stats.py - summaries of the display history, read from its rollups,
+# and compaction of the raw history once it is older than <historydays>.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, sys, logging
+import calendar
+from common_utils import *
+from image_database import *
+
+
+# Days of daily rollups shown by default
+DEFAULT_REPORT_DAYS = 14
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+def history_cutoff(config, now):
+    """ the time before which raw display history can be compacted away
+    :param config: config dictionary
+    :param now: current time, in seconds since the epoch
+    :return: the cutoff time, or None if config.xml doesn't set <historydays>
+    """
+    if 'historydays' not in config:
+        return None
+    return now - float(config['historydays']) * 86400
+
+
+def compact_old_history(config, cur):
+    """ drop raw display history older than <historydays>.  The rollups already count it.
+    :param config: config dictionary
+    :param cur: database cursor
+    :return: number of history entries deleted
+    """
+    now = calendar.timegm(datetime.now(UTC).utctimetuple())
+    cutoff = history_cutoff(config, now)
+    if cutoff is None:
+        return 0
+    deleted = compact_display_history(cur, cutoff)
+    if deleted:
+        logger.info("Compacted %s display history entries older than %s days." % (deleted, config['historydays']))
+    return deleted
+
+
+def format_time(t):
+    if t is None:
+        return 'never'
+    return datetime.fromtimestamp(t, UTC).strftime('%Y-%m-%d %H:%M')
+
+
+def report_display_stats(cur, days=DEFAULT_REPORT_DAYS, image_id=None):
+    """ log the daily and per group rollups, and optionally one image's """
+    today = calendar.timegm(datetime.now(UTC).utctimetuple()) // 86400
+    logger.info("Displays per day, last %s days:" % (days))
+    for day, displays, on_battery, charge_min, charge_max, charge_average in get_daily_rollups(cur, today - days + 1, today):
+        date = datetime.fromtimestamp(day * 86400, UTC).strftime('%Y-%m-%d')
+        if charge_average is None:
+            logger.info("  %s  %4d shown, %4d on battery" % (date, displays, on_battery))
+        else:
+            logger.info("  %s  %4d shown, %4d on battery, charge %d%% to %d%%, average %.1f%%" % (
+                date, displays, on_battery, charge_min, charge_max, charge_average))
+
+    logger.info("Displays per group:")
+    for _, name, displays, first_display, last_display in get_group_rollups(cur):
+        logger.info("  %-30s %6d shown, first %s, last %s" % (name, displays, format_time(first_display), format_time(last_display)))
+
+    if image_id is not None:
+        rollup = get_image_rollup(cur, image_id)
+        if rollup is None:
+            logger.info("Image %s has never been displayed." % (image_id))
+            return
+        displays, first_display, last_display, average_gap, max_gap = rollup
+        logger.info("Image %s shown %s times, first %s, last %s." % (image_id, displays, format_time(first_display), format_time(last_display)))
+        if average_gap is not None:
+            logger.info("Average gap between showings %.1f days, longest %.1f days." % (average_gap / 86400, max_gap / 86400))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Show display history stats, and compact old history")
+    args.add_argument('--days', type=int, default=DEFAULT_REPORT_DAYS,
+                      help='Number of days of daily stats to show')
+    args.add_argument('--id', type=int, default=None, dest='image_id',
+                      help='Also show the stats for this image ID')
+    args.add_argument('--compact', action='store_true',
+                      help='Delete raw history older than <historydays> first')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    database_file = os.path.join(config['installpath'], 'images.db')
+    conn = connect_to_local_db(database_file)
+    if not conn:
+        logger.error("Database could not be opened")
+        os._exit(os.EX_IOERR)
+    create_tables_if_missing(conn)
+    cur = conn.cursor()
+    if args.compact:
+        if 'historydays' not in config:
+            logger.error('Set <historydays> in config.xml to compact the display history.')
+        else:
+            compact_old_history(config, cur)
+    report_display_stats(cur, args.days, args.image_id)
+    finish_with_database(conn, cur)
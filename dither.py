@@ -0,0 +1,400 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# dither.py - error-diffusion dithering to a small fixed palette, using NumPy.
+# With the default kernel and palette the output is identical to what
+# PIL's quantize(palette=..., dither=Image.FLOYDSTEINBERG) produces.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+# Error diffusion is sequential along a row, so we can't vectorize along rows directly.
+# Instead we walk "wavefronts":  A pixel only receives error from pixels to its left
+# and from a few rows above, at most a couple of columns to the right.  If we give each
+# pixel a time step of x + slope * y, with the slope large enough, every pixel a given pixel
+# depends on has an earlier time step.  So all the pixels sharing a time step can be done
+# at once, as one NumPy operation.  A 1600x1200 image takes about 4000 steps instead of
+# almost two million.
+#
+# Errors are kept as integer numerators and truncated once per pixel, the same way
+# PIL's Convert.c does it, and nearest colors are found through the same 64x64x64
+# lookup PIL builds, so the default settings reproduce PIL exactly.
+#
+# Nearest colors can also be matched in CIELAB, which follows what the eye sees more
+# closely than RGB distance, especially with a measured palette.  Each lookup table is
+# built once and kept in a file that every process memory-maps.
+
+import argparse, os, sys, time, logging
+import hashlib
+import numpy as np
+from common_utils import *
+
+
+# The six colors the panel can show, in the order used for palette indexes
+# in prepared images:  black, white, red, green, blue, yellow
+PANEL_PALETTE = [(0,0,0), (255,255,255), (255,0,0), (0,255,0), (0,0,255), (255,255,0)]
+
+
+# Each kernel is a divisor and a list of (dx, dy, weight) pushing error
+# from the current pixel to a neighbor to the right or below.
+KERNELS = {
+    'floyd-steinberg': (16, [
+        (1, 0, 7),
+        (-1, 1, 3), (0, 1, 5), (1, 1, 1),
+    ]),
+    'atkinson': (8, [
+        (1, 0, 1), (2, 0, 1),
+        (-1, 1, 1), (0, 1, 1), (1, 1, 1),
+        (0, 2, 1),
+    ]),
+    'stucki': (42, [
+        (1, 0, 8), (2, 0, 4),
+        (-2, 1, 2), (-1, 1, 4), (0, 1, 8), (1, 1, 4), (2, 1, 2),
+        (-2, 2, 1), (-1, 2, 2), (0, 2, 4), (1, 2, 2), (2, 2, 1),
+    ]),
+    'jarvis': (48, [
+        (1, 0, 7), (2, 0, 5),
+        (-2, 1, 3), (-1, 1, 5), (0, 1, 7), (1, 1, 5), (2, 1, 3),
+        (-2, 2, 1), (-1, 2, 3), (0, 2, 5), (1, 2, 3), (2, 2, 1),
+    ]),
+}
+
+DEFAULT_KERNEL = 'floyd-steinberg'
+
+# How nearest palette colors are found:  'rgb' is plain RGB distance, the same as PIL.
+# 'lab' is distance in CIELAB, closer to how different the colors look.
+MATCH_METHODS = ('rgb', 'lab')
+DEFAULT_MATCH = 'rgb'
+
+# Built lookup tables are kept here, one file per palette and match method
+TABLE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'color_tables')
+
+TABLE_SHAPE = (64, 64, 64)
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+def parse_palette(text):
+    """ parse a palette written as "r,g,b r,g,b ..." (semicolons also work as separators)
+    :param text: palette string
+    :return: list of (r, g, b) tuples
+    """
+    palette = []
+    for entry in text.replace(';', ' ').split():
+        r, g, b = [int(v) for v in entry.split(',')]
+        palette.append((r, g, b))
+    return palette
+
+
+def srgb_to_lab(rgb):
+    """ convert sRGB colors to CIELAB, with a D65 white point
+    :param rgb: array of shape (..., 3), values 0 to 255
+    :return: float array of the same shape, holding L, a, b
+    """
+    c = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ np.array([
+        [0.4124564, 0.2126729, 0.0193339],
+        [0.3575761, 0.7151522, 0.1191920],
+        [0.1804375, 0.0721750, 0.9503041]])
+    xyz /= np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([
+        116 * f[..., 1] - 16,
+        500 * (f[..., 0] - f[..., 1]),
+        200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def nearest_color_table(palette, match=DEFAULT_MATCH):
+    """ build a 64x64x64 table of nearest palette indexes, indexed by color >> 2.
+    Like PIL, with 'rgb' matching each cell takes the color nearest its lowest corner,
+    with ties going to the earliest palette entry.  With 'lab' matching each cell takes
+    the color that looks nearest to its center.
+    :param palette: list of (r, g, b) tuples
+    :param match: one of MATCH_METHODS
+    :return: uint8 array shaped (64, 64, 64)
+    """
+    if match == 'lab':
+        p = srgb_to_lab(palette)
+        centers = np.arange(64) * 4 + 1.5
+        table = np.zeros(TABLE_SHAPE, dtype=np.uint8)
+        for r in range(64):
+            cells = np.stack(np.broadcast_arrays(centers[r], centers[:, None], centers[None, :]), axis=-1)
+            d = ((srgb_to_lab(cells)[:, :, None, :] - p[None, None, :, :]) ** 2).sum(axis=-1)
+            table[r] = d.argmin(axis=2)
+        return table
+    if match != 'rgb':
+        raise ValueError("Unknown color matching method '%s'" % match)
+
+    p = np.array(palette, dtype=np.int32)
+    cells = np.arange(64, dtype=np.int32) * 4
+    table = np.zeros((64, 64, 64), dtype=np.uint8)
+    # One red slice at a time, to keep the distance array small
+    for r in range(64):
+        dr = (cells[r] - p[:, 0]) ** 2
+        dg = (cells[:, None] - p[None, :, 1]) ** 2
+        db = (cells[:, None] - p[None, :, 2]) ** 2
+        d = dr[None, None, :] + dg[:, None, :] + db[None, :, :]
+        table[r] = d.argmin(axis=2)
+    return table
+
+
+def color_table_path(palette, match=DEFAULT_MATCH):
+    """ where the lookup table for a palette and match method is kept """
+    key = hashlib.sha1(repr(([tuple(c) for c in palette], match)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(TABLE_CACHE_DIR, "%s-%s.npy" % (match, key))
+
+
+def load_color_table(palette=None, match=DEFAULT_MATCH):
+    """ get the nearest color table for a palette, memory-mapped from the cache file,
+    building and saving it first if there isn't one yet
+    :param palette: list of (r, g, b) tuples, defaulting to PANEL_PALETTE
+    :param match: one of MATCH_METHODS
+    :return: uint8 array shaped (64, 64, 64)
+    """
+    if palette is None:
+        palette = PANEL_PALETTE
+    path = color_table_path(palette, match)
+    try:
+        table = np.load(path, mmap_mode='r')
+        if table.shape == TABLE_SHAPE and table.dtype == np.uint8:
+            return table
+    except (OSError, ValueError):
+        pass
+
+    table = nearest_color_table(palette, match)
+    temp_file = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(TABLE_CACHE_DIR, exist_ok=True)
+        with open(temp_file, 'wb') as f:
+            np.save(f, table)
+        os.replace(temp_file, path)
+    except OSError as e:
+        # Not fatal, the table will just be built again next time
+        logger.debug("Could not save color table %s: %s" % (path, e))
+    return table
+
+
+def map_to_palette(pixels, palette=None, match=DEFAULT_MATCH):
+    """ find the nearest palette color for every pixel, without dithering
+    :param pixels: uint8 array shaped (height, width, 3)
+    :return: uint8 array of palette indexes shaped (height, width)
+    """
+    flat_table = np.ascontiguousarray(load_color_table(palette, match)).reshape(-1)
+    # One flat index per pixel is quicker to gather with than three separate ones
+    cells = pixels >> 2
+    index = (cells[..., 0].astype(np.uint32) << 12) | (cells[..., 1].astype(np.uint32) << 6) | cells[..., 2]
+    return flat_table.take(index)
+
+
+def _diffuse(pixels, palette, kernel, table):
+    """ dither an RGB array, walking anti-diagonal wavefronts
+    :param pixels: uint8 array shaped (height, width, 3)
+    :param palette: list of (r, g, b) tuples
+    :param kernel: name of a kernel in KERNELS
+    :param table: nearest color table from nearest_color_table
+    :return: uint8 array of palette indexes shaped (height, width)
+    """
+    height, width, _ = pixels.shape
+    divisor, taps = KERNELS[kernel]
+    p = np.array(palette, dtype=np.int32)
+
+    # Slope of the wavefront, steep enough that every source pixel comes earlier.
+    slope = 1
+    for dx, dy, _ in taps:
+        if dy > 0:
+            slope = max(slope, (-dx) // dy + 1)
+
+    # Errors are stored with a margin of zeros around them, so neighbor lookups
+    # near the edges never need bounds checks.
+    margin = max(max(abs(dx), dy) for dx, dy, _ in taps)
+    stride = width + 2 * margin
+    errors = np.zeros(((height + margin) * stride, 3), dtype=np.int32)
+    # Flat offset of each source pixel relative to the destination (pull form)
+    offsets = np.array([dy * stride + dx for dx, dy, _ in taps], dtype=np.int64)
+    weights = np.array([w for _, _, w in taps], dtype=np.int32)
+
+    source = pixels.reshape(-1, 3).astype(np.int32)
+    output = np.zeros(height * width, dtype=np.uint8)
+    flat_table = table.reshape(-1)
+    # Turns a color >> 2 into a position in flat_table
+    cell_weights = np.array([64 * 64, 64, 1], dtype=np.int32)
+
+    # PIL stores the error for the last column of each row in an odd way:  The
+    # slot for it gets the blue channel's values in all three channels.  To match
+    # it we track that pixel separately.
+    fs_quirk = (kernel == 'floyd-steinberg')
+
+    all_rows = np.arange(height, dtype=np.int64)
+    for t in range(width + slope * (height - 1)):
+        # Rows that have a pixel on this wavefront
+        y_lo = max(0, -((width - 1 - t) // slope))
+        y_hi = min(height - 1, t // slope)
+        if y_lo > y_hi:
+            continue
+        ys = all_rows[y_lo:y_hi + 1]
+        xs = t - slope * ys
+
+        dest = (ys + margin) * stride + xs + margin
+        gathered = errors[dest[:, None] - offsets[None, :]]
+        acc = np.einsum('t,ntc->nc', weights, gathered)
+
+        if fs_quirk and xs[0] == width - 1 and ys[0] > 0:
+            # xs is largest for the first row, so only xs[0] can be the last column.
+            above = (ys[0] - 1 + margin) * stride + width - 1 + margin
+            eb = errors[above, 2]
+            ebl = errors[above - 1, 2]
+            acc[0] = errors[above + stride - 1] * 7 + np.array([5 * eb + ebl, eb, eb], dtype=np.int32)
+
+        flat = ys * width + xs
+        # Casting to int truncates toward zero, like C integer division
+        value = source[flat] + (acc / divisor).astype(np.int32)
+        np.clip(value, 0, 255, out=value)
+        index = flat_table[(value >> 2) @ cell_weights]
+        output[flat] = index
+        errors[dest] = value - p[index]
+
+    return output.reshape(height, width)
+
+
+def dither_array(pixels, palette=None, kernel=DEFAULT_KERNEL, match=DEFAULT_MATCH):
+    """ dither an RGB array to a palette
+    :param pixels: uint8 array shaped (height, width, 3)
+    :param palette: list of (r, g, b) tuples, defaulting to PANEL_PALETTE
+    :param kernel: name of a kernel in KERNELS
+    :param match: how nearest colors are found, one of MATCH_METHODS
+    :return: uint8 array of palette indexes shaped (height, width)
+    """
+    if palette is None:
+        palette = PANEL_PALETTE
+    if kernel not in KERNELS:
+        raise ValueError("Unknown dithering kernel '%s'" % kernel)
+    return _diffuse(pixels, palette, kernel, load_color_table(palette, match))
+
+
+def uses_pil_dither(palette=None, kernel=DEFAULT_KERNEL, match=DEFAULT_MATCH):
+    """ True if PIL's own quantize gives the same result.  It's many times faster,
+    so this engine is only worth using for the settings PIL doesn't have.
+    """
+    return (palette is None or list(palette) == PANEL_PALETTE) and kernel == 'floyd-steinberg' and match == 'rgb'
+
+
+def dither_image(img, palette=None, kernel=DEFAULT_KERNEL, match=DEFAULT_MATCH):
+    """ dither a PIL image to the panel colors
+    :param img: PIL image in 'RGB' mode
+    :param palette: list of (r, g, b) tuples used for matching and error, in
+        PANEL_PALETTE order.  Pass the panel's measured colors here to dither
+        against what it really shows.
+    :param kernel: name of a kernel in KERNELS
+    :param match: how nearest colors are found, one of MATCH_METHODS
+    :return: PIL image in 'P' mode, using the nominal PANEL_PALETTE colors
+    """
+    from PIL import Image
+
+    if palette is not None and len(palette) != len(PANEL_PALETTE):
+        raise ValueError("Palette must have %i colors, got %i" % (len(PANEL_PALETTE), len(palette)))
+    if uses_pil_dither(palette, kernel, match):
+        return img.quantize(palette=panel_palette_image(), dither=Image.FLOYDSTEINBERG)
+    indexes = dither_array(np.asarray(img), palette, kernel, match)
+    dithered = Image.fromarray(indexes, mode='P')
+    dithered.putpalette([c for rgb in PANEL_PALETTE for c in rgb], rawmode='RGB')
+    return dithered
+
+
+def panel_palette_image():
+    """ a 'P' image carrying PANEL_PALETTE, for PIL's quantize """
+    from PIL import Image
+
+    palette_img = Image.new("P", (1, 1))
+    palette_img.putpalette([c for rgb in PANEL_PALETTE for c in rgb], rawmode='RGB')
+    return palette_img
+
+
+def benchmark(input_file=None, kernel=DEFAULT_KERNEL, repeat=3, match=DEFAULT_MATCH):
+    """ compare this engine with PIL's quantize at full panel resolution """
+    from PIL import Image
+
+    if input_file is not None:
+        img = Image.open(input_file).convert("RGB").resize((1600, 1200), Image.LANCZOS)
+    else:
+        # A smooth gradient with some noise, which is a fair workout for error diffusion
+        rng = np.random.default_rng(0)
+        y, x = np.mgrid[0:1200, 0:1600]
+        pixels = np.stack([x * 255 / 1599, y * 255 / 1199, (x + y) * 255 / 2798], axis=-1)
+        pixels = np.clip(pixels + rng.normal(0, 12, pixels.shape), 0, 255).astype(np.uint8)
+        img = Image.fromarray(pixels, mode='RGB')
+
+    palette_img = panel_palette_image()
+
+    def best_of(fn):
+        best = None
+        result = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    build_time, _ = best_of(lambda: nearest_color_table(PANEL_PALETTE, match))
+    load_color_table(PANEL_PALETTE, match)
+    load_time, _ = best_of(lambda: load_color_table(PANEL_PALETTE, match))
+    logger.info("Color table (%s): built in %.4f s, memory-mapped from cache in %.4f s" % (match, build_time, load_time))
+
+    pixels = np.asarray(img)
+    pil_map_time, pil_map = best_of(lambda: img.quantize(palette=palette_img, dither=Image.Dither.NONE))
+    map_time, mapped = best_of(lambda: map_to_palette(pixels, None, match))
+    logger.info("Nearest colors, no dithering:  PIL quantize %.3f s, table gather %.3f s" % (pil_map_time, map_time))
+    if match == 'rgb':
+        logger.info("Pixels differing from PIL: %i of %i" % (int((np.asarray(pil_map) != mapped).sum()), mapped.size))
+
+    pil_time, pil_result = best_of(lambda: img.quantize(palette=palette_img, dither=Image.FLOYDSTEINBERG))
+    ours_time, ours_result = best_of(lambda: dither_array(pixels, None, kernel, match))
+
+    logger.info("PIL quantize (Floyd-Steinberg): %.3f s" % pil_time)
+    logger.info("NumPy %s: %.3f s" % (kernel, ours_time))
+    if kernel == 'floyd-steinberg' and match == 'rgb':
+        differing = int((np.asarray(pil_result) != ours_result).sum())
+        logger.info("Pixels differing from PIL: %i of %i" % (differing, ours_result.size))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Benchmark the dithering engine against PIL at 1600x1200")
+    args.add_argument('--in', type=str, default=None, dest='input_file',
+                      help='Image to use instead of a synthetic one', required=False)
+    args.add_argument('--kernel', choices=sorted(KERNELS), default=DEFAULT_KERNEL,
+                      help='Error diffusion kernel')
+    args.add_argument('--repeat', type=int, default=3,
+                      help='Runs of each method, the best is reported')
+    args.add_argument('--match', choices=MATCH_METHODS, default=DEFAULT_MATCH,
+                      help='How nearest colors are found')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    benchmark(
+        input_file=args.input_file,
+        kernel=args.kernel,
+        repeat=args.repeat,
+        match=args.match
+    )
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# fake_smbus.py - an in-memory stand-in for the I2C bus, emulating the PiSugar 3 register map,
+# so the battery code can be exercised and its bus traffic counted without hardware.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+
+import argparse, sys, logging
+from datetime import *
+from time import monotonic
+from common_utils import *
+from pisugar_battery import *
+
+
+# Largest transfer the SMBus block calls allow
+SMBUS_BLOCK_MAX = 32
+
+# Standard-mode I2C, as the Pi runs it by default
+BUS_HZ = 100000
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class FakeSMBus:
+    """ Emulates the PiSugar 3 at address 0x57, with the same method names as smbus.SMBus.
+
+    The real time clock runs from the given start time, the alarm registers only accept
+    writes while write protection is off, and every transaction is counted along with
+    the bytes it would put on the wire.
+    """
+
+    def __init__(self, bus=1, charging=False, capacity=80, clock_start=None, block_transfers=True, auto_increment=True):
+        self.registers = [0] * 256
+        self.registers[REG_STATUS] = 0x80 if charging else 0x00
+        self.registers[REG_CAPACITY] = capacity
+        self.registers[REG_WRITE_PROTECT] = WRITE_PROTECT_ON
+        self.clock_start = clock_start or datetime.now(UTC).replace(microsecond=0)
+        self.started = monotonic()
+        self.block_transfers = block_transfers
+        # Without this, a block write puts every byte into the first register
+        self.auto_increment = auto_increment
+        self.reset_counts()
+
+
+    def reset_counts(self):
+        self.transactions = 0
+        self.wire_bytes = 0
+        self.rejected_writes = 0
+
+
+    def _check_address(self, addr):
+        if addr != PiSugar3_Addr:
+            raise OSError(121, 'Remote I/O error')
+
+
+    def _clock_registers(self):
+        now = self.clock_start + timedelta(seconds=int(monotonic() - self.started))
+        # Every field is in decimal-looking hex, e.g. 0x36 for 36 minutes.
+        return {
+            REG_RTC_YEAR: decAsHex(now.year - 2000),
+            REG_RTC_MONTH: decAsHex(now.month),
+            REG_RTC_DAY: decAsHex(now.day),
+            0x34: now.isoweekday() % 7,
+            REG_RTC_HOUR: decAsHex(now.hour),
+            REG_RTC_MINUTE: decAsHex(now.minute),
+            REG_RTC_SECOND: decAsHex(now.second),
+        }
+
+
+    def _read(self, reg):
+        clock = self._clock_registers()
+        if reg in clock:
+            return clock[reg]
+        return self.registers[reg]
+
+
+    def _write(self, reg, value):
+        if reg != REG_WRITE_PROTECT and self.registers[REG_WRITE_PROTECT] != WRITE_PROTECT_OFF:
+            self.rejected_writes += 1
+            return
+        self.registers[reg] = value & 0xFF
+
+
+    def read_byte_data(self, addr, reg):
+        self._check_address(addr)
+        self.transactions += 1
+        # address+write, register, address+read, data
+        self.wire_bytes += 4
+        return self._read(reg)
+
+
+    def write_byte_data(self, addr, reg, value):
+        self._check_address(addr)
+        self.transactions += 1
+        self.wire_bytes += 3
+        self._write(reg, value)
+
+
+    def read_i2c_block_data(self, addr, reg, length=SMBUS_BLOCK_MAX):
+        self._check_address(addr)
+        if not self.block_transfers:
+            raise OSError(95, 'Operation not supported')
+        if length > SMBUS_BLOCK_MAX:
+            raise OSError(22, 'Invalid argument')
+        self.transactions += 1
+        self.wire_bytes += 3 + length
+        return [self._read((reg + i) & 0xFF) for i in range(length)]
+
+
+    def write_i2c_block_data(self, addr, reg, values):
+        self._check_address(addr)
+        if not self.block_transfers:
+            raise OSError(95, 'Operation not supported')
+        if len(values) > SMBUS_BLOCK_MAX:
+            raise OSError(22, 'Invalid argument')
+        self.transactions += 1
+        self.wire_bytes += 2 + len(values)
+        for i, v in enumerate(values):
+            self._write((reg + i) & 0xFF if self.auto_increment else reg, v)
+
+
+# So this module can stand in for smbus itself
+SMBus = FakeSMBus
+
+
+def wake_bus_traffic(bus):
+    """ make the same battery calls cycle_image makes in one wake
+    :return: (transactions, wire bytes)
+    """
+    bus.reset_counts()
+    battery = PiSugarBattery(bus)
+    if battery.charging_status() is not None:
+        battery.refine_capacity()
+    battery.get_real_time_clock()
+    battery.get_alarm_timer()
+    battery.set_alarm_for_seconds_from_now(86200)
+    return bus.transactions, bus.wire_bytes
+
+
+def per_register_bus_traffic(bus):
+    """ the register-at-a-time access pattern PiSugarBattery used to have, for comparison
+    :return: (transactions, wire bytes)
+    """
+    bus.reset_counts()
+    read = lambda reg: bus.read_byte_data(PiSugar3_Addr, reg)
+    write = lambda reg, value: bus.write_byte_data(PiSugar3_Addr, reg, value)
+    read(REG_STATUS)                                        # charging_status
+    read(REG_CAPACITY)                                      # refine_capacity
+    for reg in [REG_RTC_YEAR, REG_RTC_MONTH, REG_RTC_DAY, REG_RTC_HOUR, REG_RTC_MINUTE, REG_RTC_SECOND]:
+        read(reg)                                           # get_real_time_clock
+    for reg in [REG_ALARM_HOUR, REG_ALARM_MINUTE, REG_ALARM_SECOND]:
+        read(reg)                                           # get_alarm_timer
+    read(REG_CAPACITY)                                      # second refine_capacity
+    for reg in [REG_RTC_HOUR, REG_RTC_MINUTE, REG_RTC_SECOND]:
+        read(reg)                                           # set_alarm_for_seconds_from_now
+    write(REG_WRITE_PROTECT, WRITE_PROTECT_OFF)
+    for reg in [REG_ALARM_HOUR, REG_ALARM_MINUTE, REG_ALARM_SECOND]:
+        write(reg, 0)
+    write(REG_WRITE_PROTECT, WRITE_PROTECT_ON)
+    return bus.transactions, bus.wire_bytes
+
+
+def benchmark_bus_traffic():
+    """ log the bus traffic of one wake, one register at a time versus batched """
+    results = [
+        ('one register at a time', per_register_bus_traffic(FakeSMBus())),
+        ('snapshot and block write', wake_bus_traffic(FakeSMBus())),
+        ('snapshot, no block support', wake_bus_traffic(FakeSMBus(block_transfers=False))),
+        ('block write not incrementing', wake_bus_traffic(FakeSMBus(auto_increment=False))),
+    ]
+    for name, (transactions, wire_bytes) in results:
+        # Each byte is 8 bits plus an acknowledge, and each transaction has a start and stop
+        bus_ms = (wire_bytes * 9 + transactions * 2) * 1000.0 / BUS_HZ
+        logger.info("%-28s %3s transactions, %4s bytes, %.2f ms on a %s kHz bus" % (name, transactions, wire_bytes, bus_ms, BUS_HZ // 1000))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Count the PiSugar bus traffic of one wake, using a fake bus")
+    args = args.parse_args()
+
+    set_up_logger()
+
+    benchmark_bus_traffic()
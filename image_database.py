@@ -26,36 +26,123 @@
 # Copyright (c) 2025 Garrett Birkel
 
 from datetime import *
+from collections import namedtuple
+import os
 import calendar
+import random
 import sqlite3
 import logging
 from sqlite3 import Error
 
 
+# Settings applied to every connection.  'default' is SQLite's own, kept for comparison.
+# 'sdcard' is for a database on a flash card that is read far more than it's written:
+#   - The journal is truncated after each commit instead of deleted, so it isn't created,
+#     synced into its directory, and unlinked again on every wake.
+#   - Synchronous NORMAL syncs the journal once per commit instead of twice.  A power cut
+#     just after a commit can roll that commit back, but can't corrupt the database.
+#   - Pages the size of a filesystem block, so writing one never touches two blocks.
+#     (This only takes effect when the database is created.)
+#   - Reads come straight out of the page cache through mmap, without a copy.
+#   - Sorts and temporary indexes stay in memory instead of going to a file on the card.
+STORAGE_PROFILES = {
+    'default': [],
+    'sdcard': [
+        ('page_size', 4096),
+        ('journal_mode', 'TRUNCATE'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 64 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+DEFAULT_STORAGE_PROFILE = 'sdcard'
+
+# How long to wait for another process to finish writing, before giving up with
+# sqlite3.OperationalError.  While charging, the frame, the web server, and a library
+# sync can all be writing, though none of them should hold the database for long.
+BUSY_TIMEOUT_SECONDS = 30
+
+
 logger = logging.getLogger("epaper_frame")
 
-def connect_to_local_db(db_file):
+
+# A compact, read-only image record, returned by the selection functions
+ImageRow = namedtuple('ImageRow', [
+    'id',
+    'group_id',
+    'group_name',
+    'filename',
+    'size',
+    'file_modified_time',
+    'last_display',
+    'display_count'
+])
+
+
+def image_row_factory(cursor, row):
+    return ImageRow(*row)
+
+def connect_to_local_db(db_file, read_only=False, profile=DEFAULT_STORAGE_PROFILE):
     """ create a database connection to the SQLite database
         specified by the db_file
     :param db_file: database file
+    :param read_only: open it without write access.  That's only possible if the schema is
+        up to date and there's no interrupted write to roll back, so check for None and open
+        it for writing instead.
+    :param profile: key into STORAGE_PROFILES
     :return: Connection object or None
     """
     conn = None
     logger.info('Opening local database: %s' % db_file)
     try:
-        conn = sqlite3.connect(db_file)
+        if read_only:
+            # (Only these characters mean something in a file: URI's path.  urllib is slow to import.)
+            path = os.path.abspath(db_file).replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+            conn = sqlite3.connect('file:%s?mode=ro' % (path), uri=True, timeout=BUSY_TIMEOUT_SECONDS)
+            # The first read would fail here if there was a journal to roll back
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                logger.debug('Database is at schema version %s, not %s' % (version, SCHEMA_VERSION))
+                conn.close()
+                return None
+            conn.execute("PRAGMA query_only = ON")
+        else:
+            conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT_SECONDS)
+        for name, value in STORAGE_PROFILES[profile]:
+            conn.execute("PRAGMA %s = %s" % (name, value))
     except Error as e:
-        logger.error(e)
+        if read_only:
+            logger.debug(e)
+        else:
+            logger.error(e)
+        if conn is not None:
+            conn.close()
+        conn = None
 
     return conn
 
 
-def create_tables_if_missing(conn):
-    """ create needed database tables if missing
+def connection_is_read_only(conn):
+    """ True if the connection was opened with read_only """
+    return conn.execute("PRAGMA query_only").fetchone()[0] == 1
+
+
+def add_column_if_missing(conn, table, column, definition):
+    """ add a column to a table made by an older version of this code
     :param conn: database connection
     """
-    logger.debug('Creating tables if needed')
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % (table))]
+    if column not in columns:
+        logger.debug('Adding column %s to table %s' % (column, table))
+        conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition))
 
+
+def migrate_to_version_1(conn):
+    """ create needed database tables if missing.  Databases made before the schema had
+    a version can be at any stage of it, so everything here checks before creating.
+    :param conn: database connection
+    """
     conn.execute("""
         CREATE TABLE IF NOT EXISTS status (
             last_sync REAL,
@@ -96,6 +183,12 @@ def create_tables_if_missing(conn):
             ON "images" (display_count);
         """)
 
+    # Leads with removed, so it also covers counting the images still in the library
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS images_selection
+            ON "images" (removed, display_count, last_display);
+        """)
+
     conn.execute("""
         CREATE TABLE IF NOT EXISTS image_display_history (
             id INTEGER PRIMARY KEY NOT NULL,
@@ -110,6 +203,210 @@ def create_tables_if_missing(conn):
             ON "image_display_history" (display_time);
         """)
 
+    # How long each phase of a wake took, linked to the history entry for that wake
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wake_phase_timings (
+            id INTEGER PRIMARY KEY NOT NULL,
+            history_id INTEGER NOT NULL,
+            phase TEXT NOT NULL,
+            seconds REAL NOT NULL
+        )""")
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS wake_phase_timings_history_id
+            ON "wake_phase_timings" (history_id);
+        """)
+
+    # The image chosen ahead of time for the next wake
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS staged_image (
+            image_id INTEGER NOT NULL,
+            staged_time REAL NOT NULL
+        )""")
+
+    # Perceptual hash of each image, NULL until computed, and the image it was found to be
+    # a near-duplicate of, if any.  Both are maintained by perceptual_hash.py.
+    add_column_if_missing(conn, 'images', 'perceptual_hash', 'INTEGER')
+    add_column_if_missing(conn, 'images', 'duplicate_of', 'INTEGER')
+
+    # Hash of the file's bytes, so a file that's moved or renamed can be matched to its old row
+    add_column_if_missing(conn, 'images', 'content_hash', 'TEXT')
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS images_content_hash
+            ON "images" (content_hash);
+        """)
+
+    # Perceptual hashes split into 16-bit bands, for multi-index near-duplicate lookup
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_hash_bands (
+            band INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            image_id INTEGER NOT NULL
+        )""")
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS image_hash_bands_value
+            ON "image_hash_bands" (band, value);
+        """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS image_hash_bands_image_id
+            ON "image_hash_bands" (image_id);
+        """)
+
+    # The order images will be shown in for the rest of this pass through the library.
+    # Positions are REAL so new images can be slotted in between existing entries.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS selection_queue (
+            position REAL NOT NULL,
+            image_id INTEGER NOT NULL
+        )""")
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS selection_queue_position
+            ON "selection_queue" (position);
+        """)
+
+    # Files fetched by library_sync, with what's needed to ask the server whether they've changed.
+    # The manifest itself has a row too, with no group or filename.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS synced_files (
+            url TEXT PRIMARY KEY NOT NULL,
+            group_name TEXT,
+            filename TEXT,
+            version TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            size INTEGER
+        )""")
+
+    # Running state of the battery drain model, so each wake only has to fold in its own history entry
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS battery_model (
+            last_history_id INTEGER NOT NULL,
+            last_time REAL,
+            last_level INTEGER,
+            last_charging BOOLEAN,
+            unplugged_time REAL,
+            weight REAL NOT NULL,
+            sum_hours REAL NOT NULL,
+            sum_hours_squared REAL NOT NULL,
+            sum_drop REAL NOT NULL,
+            sum_hours_drop REAL NOT NULL
+        )""")
+
+    # Display history rolled up by day, by group, and by image.  These are kept up to date
+    # by report_image_as_displayed, so raw history older than <historydays> can be dropped
+    # and stats never have to scan it.  A database from before these existed gets them
+    # built from the raw history the first time through.
+    rollups_missing = conn.execute("""
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name IN ('history_daily', 'history_by_group', 'history_by_image')
+        """).fetchone()[0] < 3
+
+    # Days are UTC days since the epoch, display_time // 86400
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_daily (
+            day INTEGER PRIMARY KEY NOT NULL,
+            displays INTEGER NOT NULL,
+            on_battery INTEGER NOT NULL,
+            charge_count INTEGER NOT NULL,
+            charge_sum INTEGER NOT NULL,
+            charge_min INTEGER,
+            charge_max INTEGER
+        )""")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_by_group (
+            group_id INTEGER PRIMARY KEY NOT NULL,
+            displays INTEGER NOT NULL,
+            first_display REAL,
+            last_display REAL
+        )""")
+
+    # Gaps are the seconds between one showing of an image and the next
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_by_image (
+            image_id INTEGER PRIMARY KEY NOT NULL,
+            displays INTEGER NOT NULL,
+            first_display REAL,
+            last_display REAL,
+            gap_count INTEGER NOT NULL,
+            gap_sum REAL NOT NULL,
+            max_gap REAL
+        )""")
+
+    if rollups_missing:
+        cur = conn.cursor()
+        rebuild_history_rollups(cur)
+        cur.close()
+
+
+def migrate_to_version_2(conn):
+    """ drop the indexes on images.last_display and images.display_count.  Nothing looks
+    images up by either one alone (images_selection has both, after removed), and
+    keeping them up to date cost four page writes on every wake.
+    :param conn: database connection
+    """
+    conn.execute("DROP INDEX IF EXISTS images_last_display")
+    conn.execute("DROP INDEX IF EXISTS images_display_count")
+
+
+def migrate_to_version_3(conn):
+    """ replace images_selection with an index on removed alone.  Images are chosen from
+    selection_queue now, so only counting the images still in the library used it, and
+    since it held display_count and last_display it was rewritten on every wake.
+    :param conn: database connection
+    """
+    conn.execute("DROP INDEX IF EXISTS images_selection")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS images_removed
+            ON "images" (removed);
+        """)
+
+
+# SCHEMA_MIGRATIONS[n] takes a database from schema version n to n + 1.
+# The version is kept in the database's user_version, which starts at 0.
+SCHEMA_MIGRATIONS = [
+    migrate_to_version_1,
+    migrate_to_version_2,
+    migrate_to_version_3,
+]
+
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+
+def create_tables_if_missing(conn):
+    """ create the database tables, or bring them up to date.  On a database that's
+    already up to date this only reads the schema version from the file header.
+    :param conn: database connection
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        logger.warning('Database schema version %s is newer than this code (%s)' % (version, SCHEMA_VERSION))
+        return
+    for from_version in range(version, SCHEMA_VERSION):
+        logger.info('Migrating database to schema version %s' % (from_version + 1))
+        # Each step commits along with its new version number, so if it's interrupted it starts over
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        SCHEMA_MIGRATIONS[from_version](conn)
+        conn.execute("PRAGMA user_version = %d" % (from_version + 1))
+        conn.commit()
+
+
+def get_status(cur):
+    """ get values from the current status record, without creating one
+    :param cur: database cursor
+    :return: status record, or None if there isn't one yet
+    """
+    cur.execute("SELECT last_sync, last_display FROM status")
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {"last_sync": row[0], "last_display": row[1]}
+
 
 def get_status_or_defaults(cur, last_sync, last_display):
     """ get values from the current status record, or create a new one if missing
@@ -117,14 +414,10 @@ def get_status_or_defaults(cur, last_sync, last_display):
     :param last_sync: default last_sync value
     :param last_display: default last_display value
     """
-    cur.execute("SELECT last_sync, last_display FROM status")
-    row = cur.fetchone()
-    if not row:
+    status = get_status(cur)
+    if status is None:
         cur.execute("INSERT INTO status (last_sync, last_display) VALUES (?, ?)", (last_sync, last_display))
-    else:
-        last_sync = row[0]
-        last_display = row[1]
-    status = {"last_sync": last_sync, "last_display": last_display}
+        status = {"last_sync": last_sync, "last_display": last_display}
     return status
 
 
@@ -136,6 +429,113 @@ def set_status(cur, status):
     cur.execute("UPDATE status SET last_sync = ?, last_display = ?", (status['last_sync'], status['last_display']))
 
 
+def set_last_sync(cur, last_sync):
+    """ record the time of the last complete library sync, leaving the rest of the status alone
+    :param cur: database cursor
+    :param last_sync: time of the sync
+    """
+    get_status_or_defaults(cur, last_sync, None)
+    cur.execute("UPDATE status SET last_sync = ?", (last_sync,))
+
+
+SYNCED_FILE_COLUMNS = [
+    'url',
+    'group_name',
+    'filename',
+    'version',
+    'etag',
+    'last_modified',
+    'size'
+]
+
+
+def get_synced_files(cur):
+    """ get the records of everything fetched by library_sync
+    :param cur: database cursor
+    :return: dictionary mapping url to a dictionary keyed by SYNCED_FILE_COLUMNS
+    """
+    cur.execute("SELECT " + ", ".join(SYNCED_FILE_COLUMNS) + " FROM synced_files")
+    return dict((row[0], dict(zip(SYNCED_FILE_COLUMNS, row))) for row in cur.fetchall())
+
+
+def set_synced_file(cur, record):
+    """ add or replace the record of one fetched file
+    :param cur: database cursor
+    :param record: dictionary keyed by SYNCED_FILE_COLUMNS
+    """
+    cur.execute("INSERT OR REPLACE INTO synced_files (" + ", ".join(SYNCED_FILE_COLUMNS) + ") VALUES (" +
+                ", ".join("?" * len(SYNCED_FILE_COLUMNS)) + ")",
+                [record.get(c) for c in SYNCED_FILE_COLUMNS])
+
+
+def remove_synced_files(cur, urls):
+    """ forget fetched files that are no longer in the manifest
+    :param cur: database cursor
+    :param urls: list of urls
+    """
+    cur.executemany("DELETE FROM synced_files WHERE url = ?", [(u,) for u in urls])
+
+
+BATTERY_MODEL_COLUMNS = [
+    'last_history_id',
+    'last_time',
+    'last_level',
+    'last_charging',
+    'unplugged_time',
+    'weight',
+    'sum_hours',
+    'sum_hours_squared',
+    'sum_drop',
+    'sum_hours_drop'
+]
+
+
+def empty_battery_model_state():
+    state = dict((c, 0.0) for c in BATTERY_MODEL_COLUMNS)
+    state.update({'last_history_id': 0, 'last_time': None, 'last_level': None,
+                  'last_charging': None, 'unplugged_time': None})
+    return state
+
+
+def get_battery_model_state_or_defaults(cur):
+    """ get the battery drain model state, or create an empty one if missing
+    :param cur: database cursor
+    :return: dictionary keyed by BATTERY_MODEL_COLUMNS
+    """
+    cur.execute("SELECT " + ", ".join(BATTERY_MODEL_COLUMNS) + " FROM battery_model")
+    row = cur.fetchone()
+    if not row:
+        state = empty_battery_model_state()
+        cur.execute("INSERT INTO battery_model (" + ", ".join(BATTERY_MODEL_COLUMNS) + ") VALUES (" +
+                    ", ".join("?" * len(BATTERY_MODEL_COLUMNS)) + ")",
+                    [state[c] for c in BATTERY_MODEL_COLUMNS])
+        return state
+    return dict(zip(BATTERY_MODEL_COLUMNS, row))
+
+
+def set_battery_model_state(cur, state):
+    """ set values in the battery drain model state
+    :param cur: database cursor
+    :param state: dictionary keyed by BATTERY_MODEL_COLUMNS
+    """
+    cur.execute("UPDATE battery_model SET " + ", ".join(c + " = ?" for c in BATTERY_MODEL_COLUMNS),
+                [state[c] for c in BATTERY_MODEL_COLUMNS])
+
+
+def get_display_history_since(cur, history_id):
+    """ get display history entries newer than the given one
+    :param cur: database cursor
+    :param history_id: id of the last entry already seen, or 0 for all of them
+    :return: list of (id, display_time, charging, charge_level), oldest first
+    """
+    cur.execute("""
+        SELECT id, display_time, charging, charge_level
+        FROM image_display_history
+        WHERE id > ?
+        ORDER BY id""", (history_id,))
+    return cur.fetchall()
+
+
 def get_or_insert_image_group(cur, name):
     """ fetch or insert the record for an image group
     :param cur: database cursor
@@ -158,7 +558,9 @@ def get_or_insert_image_group(cur, name):
 
 
 def insert_or_update_image(cur, image):
-    """ insert a new image or update any preexisting one with a matching group id and name
+    """ insert a new image or update any preexisting one with a matching group id and name.
+    png_inventory inserts in bulk now, so this is only used by its benchmark, to
+    compare against the old one-file-at-a-time scan.
     :param cur: database cursor
     :param image: image record
     :return: True if the image id did not already exist
@@ -213,6 +615,170 @@ def insert_or_update_image(cur, image):
         return False
 
 
+def get_image_file_map(cur):
+    """ get the file details of every image in one query, for incremental inventory
+    :param cur: database cursor
+    :return: dictionary mapping (group_id, filename) to (id, size, file_modified_time, removed, content_hash)
+    """
+    logger.debug('Fetching file details of all images from database')
+    cur.execute("SELECT id, group_id, filename, size, file_modified_time, removed, content_hash FROM images")
+    file_map = {}
+    for row in cur.fetchall():
+        file_map[(row[1], row[2])] = (row[0], row[3], row[4], row[5], row[6])
+    return file_map
+
+
+def insert_images(cur, images):
+    """ insert many new images at once
+    :param cur: database cursor
+    :param images: list of image records with group_id, filename, size, and file_modified_time,
+    and optionally content_hash
+    """
+    if len(images) == 0:
+        return
+    creation_time = calendar.timegm(datetime.now(UTC).utctimetuple())
+    for image in images:
+        image['creation_time'] = creation_time
+        image.setdefault('content_hash', None)
+    cur.execute("SELECT MAX(id) FROM images")
+    last_id = cur.fetchone()[0] or 0
+    cur.executemany("""
+        INSERT INTO images (
+            group_id,
+            filename,
+            size,
+            file_modified_time,
+            content_hash,
+
+            last_display, display_count,
+            creation_time,
+            removed
+        ) VALUES (
+            :group_id,
+            :filename,
+            :size,
+            :file_modified_time,
+            :content_hash,
+
+            NULL, 0,
+            :creation_time,
+            FALSE
+        )""", images)
+    # New images join the current pass, rather than waiting for the next one
+    cur.execute("SELECT id FROM images WHERE id > ?", (last_id,))
+    splice_into_selection_queue(cur, [row[0] for row in cur.fetchall()])
+
+
+def update_image_files(cur, images):
+    """ record new file details for many existing images at once,
+    leaving their display history alone
+    :param cur: database cursor
+    :param images: list of image records with id, size, and file_modified_time,
+    and optionally content_hash
+    """
+    for image in images:
+        image.setdefault('content_hash', None)
+    cur.executemany("""
+        UPDATE images SET
+            size = :size,
+            file_modified_time = :file_modified_time,
+            content_hash = :content_hash,
+            perceptual_hash = NULL,
+            removed = FALSE
+        WHERE id = :id""", images)
+
+
+def move_image_files(cur, images):
+    """ give existing images a new group or filename, for files that were moved or renamed.
+    Their display history and perceptual hash stay as they are, since the contents are the same.
+    :param cur: database cursor
+    :param images: list of image records with id, group_id, filename, size, and file_modified_time
+    """
+    cur.executemany("""
+        UPDATE images SET
+            group_id = :group_id,
+            filename = :filename,
+            size = :size,
+            file_modified_time = :file_modified_time,
+            removed = FALSE
+        WHERE id = :id""", images)
+
+
+def set_content_hashes(cur, hashes):
+    """ fill in content hashes for images whose files haven't changed
+    :param cur: database cursor
+    :param hashes: list of (image id, content hash)
+    """
+    cur.executemany("UPDATE images SET content_hash = ? WHERE id = ?", [(h, i) for i, h in hashes])
+
+
+def find_removed_image_by_content_hash(cur, content_hash, filename=None):
+    """ find a removed image with the given contents, which a new file may be a moved or renamed copy of
+    :param cur: database cursor
+    :param filename: if given, an image with this filename is preferred
+    :return: image id, or None
+    """
+    cur.execute("""
+        SELECT id FROM images WHERE content_hash = ? AND removed = TRUE
+        ORDER BY filename = ? DESC, id LIMIT 1""", (content_hash, filename))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def mark_images_removed(cur, image_ids):
+    """ flag images whose files have disappeared
+    :param cur: database cursor
+    :param image_ids: list of image ids
+    """
+    cur.executemany("UPDATE images SET removed = TRUE WHERE id = ?", [(i,) for i in image_ids])
+
+
+def register_image_file(cur, group_name, filename, size, file_modified_time, content_hash=None):
+    """ add one image to the library, or record new file details for it if it's already there,
+    without scanning the rest of the library.  A new file with the same contents as a removed
+    image takes over that image's row, keeping its display history.
+    :param cur: database cursor
+    :param group_name: name of the group folder the file is in
+    :param filename: name of the file
+    :param content_hash: hash of the file's contents, if known
+    :return: id of the image
+    """
+    group = get_or_insert_image_group(cur, group_name)
+    image = {
+        'group_id': group['id'],
+        'filename': filename,
+        'size': size,
+        'file_modified_time': file_modified_time,
+        'content_hash': content_hash
+    }
+    cur.execute("SELECT id FROM images WHERE group_id = :group_id AND filename = :filename", image)
+    row = cur.fetchone()
+    if row:
+        image['id'] = row[0]
+        update_image_files(cur, [image])
+        return row[0]
+    if content_hash is not None:
+        moved_id = find_removed_image_by_content_hash(cur, content_hash, filename)
+        if moved_id is not None:
+            image['id'] = moved_id
+            move_image_files(cur, [image])
+            return moved_id
+    insert_images(cur, [image])
+    cur.execute("SELECT id FROM images WHERE group_id = :group_id AND filename = :filename", image)
+    return cur.fetchone()[0]
+
+
+def mark_image_file_removed(cur, group_name, filename):
+    """ flag one image whose file has disappeared, found by name
+    :param cur: database cursor
+    :param group_name: name of the group folder the file was in
+    :param filename: name of the file
+    """
+    cur.execute("""
+        UPDATE images SET removed = TRUE
+        WHERE filename = ? AND group_id = (SELECT id FROM image_groups WHERE name = ?)""", (filename, group_name))
+
+
 def get_image_group_dictionaries(cur):
     """ get all the image groups and build dictonaries
     for mapping id to name and name to id.
@@ -271,12 +837,340 @@ def get_all_images(cur):
     return records
 
 
+# Columns for ImageRow, selected from images joined with image_groups
+IMAGE_ROW_COLUMNS = """
+    images.id,
+    images.group_id,
+    image_groups.name,
+    images.filename,
+    images.size,
+    images.file_modified_time,
+    images.last_display,
+    images.display_count"""
+
+
+def get_image_by_id(cur, image_id):
+    """ get one image that is still in the library
+    :param cur: database cursor
+    :param image_id: id of image
+    :return: an ImageRow, or None if there is no such image or it was removed
+    """
+    cur.row_factory = image_row_factory
+    cur.execute("""
+        SELECT""" + IMAGE_ROW_COLUMNS + """
+        FROM images JOIN image_groups ON image_groups.id = images.group_id
+        WHERE images.id = ? AND images.removed = FALSE""", (image_id,))
+    row = cur.fetchone()
+    cur.row_factory = None
+    return row
+
+
+def selection_options(config):
+    """ read the selection settings from config.xml
+    :return: keyword arguments for choose_image_to_display and fill_selection_queue
+    """
+    return {
+        'spread_groups': config.get('spreadgroups', '1') != '0',
+        'skip_duplicates': config.get('skipduplicates', '0') != '0'
+    }
+
+
+def fill_selection_queue(cur, spread_groups=True, skip_duplicates=False):
+    """ start a new pass through the library, queueing every image in a shuffled order
+    :param cur: database cursor
+    :param spread_groups: space each group's images evenly through the pass, rather than
+    letting them clump together the way a plain shuffle sometimes does
+    :param skip_duplicates: leave out images found to be near-duplicates of another
+    :return: number of images queued
+    """
+    duplicate_filter = "AND duplicate_of IS NULL" if skip_duplicates else ""
+    cur.execute("SELECT id, group_id FROM images WHERE removed = FALSE " + duplicate_filter)
+    rows = cur.fetchall()
+    if spread_groups:
+        # Shuffle within each group, then give the k images of a group one position
+        # at random inside each of k equal slices of the pass.
+        by_group = {}
+        for image_id, group_id in rows:
+            by_group.setdefault(group_id, []).append(image_id)
+        entries = []
+        for image_ids in by_group.values():
+            random.shuffle(image_ids)
+            k = len(image_ids)
+            entries.extend(((j + random.random()) / k, image_id) for j, image_id in enumerate(image_ids))
+    else:
+        entries = [(random.random(), image_id) for image_id, _ in rows]
+    cur.execute("DELETE FROM selection_queue")
+    cur.executemany("INSERT INTO selection_queue (position, image_id) VALUES (?, ?)", entries)
+    logger.debug('Queued %s images for a new pass through the library' % (len(entries)))
+    return len(entries)
+
+
+def splice_into_selection_queue(cur, image_ids):
+    """ add images to the current pass, at random places among the images still to come
+    :param cur: database cursor
+    :param image_ids: list of image ids
+    """
+    cur.execute("SELECT MIN(position), MAX(position) FROM selection_queue")
+    low, high = cur.fetchone()
+    if low is None:
+        # Nothing queued, so the next pass will include them anyway
+        return
+    if high <= low:
+        high = low + 1.0
+    cur.executemany("INSERT INTO selection_queue (position, image_id) VALUES (?, ?)",
+                    [(random.uniform(low, high), image_id) for image_id in image_ids])
+
+
+def count_queued_images(cur):
+    """ count the entries left in the current pass through the library
+    :param cur: database cursor
+    """
+    cur.execute("SELECT COUNT(*) FROM selection_queue")
+    return cur.fetchone()[0]
+
+
+def get_images_needing_perceptual_hash(cur):
+    """ get the images still in the library whose perceptual hash is unknown or out of date
+    :param cur: database cursor
+    :return: list of ImageRow
+    """
+    cur.row_factory = image_row_factory
+    cur.execute("""
+        SELECT""" + IMAGE_ROW_COLUMNS + """
+        FROM images JOIN image_groups ON image_groups.id = images.group_id
+        WHERE images.removed = FALSE AND images.perceptual_hash IS NULL""")
+    rows = cur.fetchall()
+    cur.row_factory = None
+    return rows
+
+
+def set_perceptual_hashes(cur, hashes, bands):
+    """ store perceptual hashes, replacing the lookup bands of the images
+    :param cur: database cursor
+    :param hashes: list of (image id, hash as a signed 64-bit integer)
+    :param bands: list of (band, value, image id)
+    """
+    cur.executemany("UPDATE images SET perceptual_hash = ? WHERE id = ?", [(h, i) for i, h in hashes])
+    cur.executemany("DELETE FROM image_hash_bands WHERE image_id = ?", [(i,) for i, _ in hashes])
+    cur.executemany("INSERT INTO image_hash_bands (band, value, image_id) VALUES (?, ?, ?)", bands)
+
+
+def get_perceptual_hashes(cur):
+    """ get the perceptual hash of every image still in the library that has one
+    :param cur: database cursor
+    :return: list of (image id, hash as a signed 64-bit integer)
+    """
+    cur.execute("SELECT id, perceptual_hash FROM images WHERE removed = FALSE AND perceptual_hash IS NOT NULL")
+    return cur.fetchall()
+
+
+def get_images_in_hash_bands(cur, band_values):
+    """ find the images with any of the given band values, for near-duplicate lookup
+    :param cur: database cursor
+    :param band_values: list of (band, list of values)
+    :return: list of (image id, hash as a signed 64-bit integer)
+    """
+    results = {}
+    for band, values in band_values:
+        cur.execute("""
+            SELECT images.id, images.perceptual_hash
+            FROM image_hash_bands JOIN images ON images.id = image_hash_bands.image_id
+            WHERE image_hash_bands.band = ? AND image_hash_bands.value IN (""" + ", ".join("?" * len(values)) + """)
+                AND images.removed = FALSE""", [band] + list(values))
+        for image_id, h in cur.fetchall():
+            results[image_id] = h
+    return list(results.items())
+
+
+def set_duplicate_clusters(cur, clusters):
+    """ record which images are near-duplicates of which, replacing what was recorded before
+    :param cur: database cursor
+    :param clusters: list of lists of image ids.  The first id in each list is kept
+    as the one to show, and the rest are marked as its duplicates.
+    """
+    cur.execute("UPDATE images SET duplicate_of = NULL WHERE duplicate_of IS NOT NULL")
+    cur.executemany("UPDATE images SET duplicate_of = ? WHERE id = ?",
+                    [(cluster[0], image_id) for cluster in clusters for image_id in cluster[1:]])
+
+
+def get_duplicate_clusters(cur):
+    """ get the recorded near-duplicate clusters
+    :param cur: database cursor
+    :return: dictionary mapping the id of the image kept to a list of ImageRow, kept image first
+    """
+    cur.execute("""
+        SELECT""" + IMAGE_ROW_COLUMNS + """, images.duplicate_of
+        FROM images JOIN image_groups ON image_groups.id = images.group_id
+        WHERE images.removed = FALSE AND (images.duplicate_of IS NOT NULL OR images.id IN (
+            SELECT duplicate_of FROM images WHERE duplicate_of IS NOT NULL))
+        ORDER BY images.id""")
+    clusters = {}
+    for row in cur.fetchall():
+        image = ImageRow(*row[:-1])
+        clusters.setdefault(row[-1] or image.id, []).append(image)
+    return clusters
+
+
+def get_queued_images(cur, limit):
+    """ get the images that will be shown next, in order, without taking them off the queue
+    :param cur: database cursor
+    :param limit: most images to return
+    :return: list of ImageRow
+    """
+    cur.row_factory = image_row_factory
+    cur.execute("""
+        SELECT""" + IMAGE_ROW_COLUMNS + """
+        FROM selection_queue
+        JOIN images ON images.id = selection_queue.image_id
+        JOIN image_groups ON image_groups.id = images.group_id
+        WHERE images.removed = FALSE
+        ORDER BY selection_queue.position
+        LIMIT ?""", (limit,))
+    rows = cur.fetchall()
+    cur.row_factory = None
+    return rows
+
+
+def choose_image_to_display(cur, specific_id=None, spread_groups=True, skip_duplicates=False):
+    """ take the next image off the selection queue.  Every image in the library
+    is shown once before any is shown again.  When the queue runs out, a new pass
+    through the library is shuffled and queued.
+    :param cur: database cursor
+    :param specific_id: if given, choose this image instead
+    :param spread_groups: passed on to fill_selection_queue
+    :param skip_duplicates: passed on to fill_selection_queue
+    :return: an ImageRow, or None if there is nothing to show
+    """
+    if specific_id is not None:
+        return get_image_by_id(cur, specific_id)
+
+    refilled = False
+    while True:
+        cur.execute("SELECT rowid, image_id FROM selection_queue ORDER BY position LIMIT 1")
+        row = cur.fetchone()
+        if not row:
+            if refilled or fill_selection_queue(cur, spread_groups, skip_duplicates) == 0:
+                return None
+            refilled = True
+            continue
+        cur.execute("DELETE FROM selection_queue WHERE rowid = ?", (row[0],))
+        # Skips over images removed since they were queued
+        image = get_image_by_id(cur, row[1])
+        if image is not None:
+            return image
+
+
+def get_staged_image(cur):
+    """ get the image chosen ahead of time for this wake, if it's still in the library
+    :param cur: database cursor
+    :return: an ImageRow, or None
+    """
+    cur.execute("SELECT image_id FROM staged_image")
+    row = cur.fetchone()
+    if not row:
+        return None
+    return get_image_by_id(cur, row[0])
+
+
+def set_staged_image(cur, image_id):
+    """ record the image chosen ahead of time for the next wake
+    :param cur: database cursor
+    :param image_id: id of image
+    """
+    current_date = calendar.timegm(datetime.now(UTC).utctimetuple())
+    cur.execute("DELETE FROM staged_image")
+    cur.execute("INSERT INTO staged_image (image_id, staged_time) VALUES (?, ?)", (image_id, current_date))
+
+
+def clear_staged_image(cur, image_id):
+    """ forget the image chosen ahead of time, if it's this one
+    :param cur: database cursor
+    :param image_id: id of image
+    """
+    cur.execute("DELETE FROM staged_image WHERE image_id = ?", (image_id,))
+
+
+def count_displayable_images(cur):
+    """ count the images that are still in the library
+    :param cur: database cursor
+    """
+    cur.execute("SELECT COUNT(*) FROM images WHERE removed = FALSE")
+    return cur.fetchone()[0]
+
+
+def get_image_groups_with_counts(cur):
+    """ get every image group, with the number of its images still in the library
+    :param cur: database cursor
+    :return: list of (id, name, image count), by name
+    """
+    cur.execute("""
+        SELECT image_groups.id, image_groups.name, COUNT(images.id)
+        FROM image_groups LEFT JOIN images
+            ON images.group_id = image_groups.id AND images.removed = FALSE
+        GROUP BY image_groups.id
+        ORDER BY image_groups.name""")
+    return cur.fetchall()
+
+
+def get_images_page(cur, after_id=0, limit=50, group_id=None):
+    """ get one page of the images still in the library, in id order.
+    Pages pick up from the last id seen rather than skipping an offset,
+    so a page deep into a large library costs the same as the first one.
+    :param cur: database cursor
+    :param after_id: id of the last image on the previous page, or 0 for the first page
+    :param limit: most images to return
+    :param group_id: if given, only images in this group
+    :return: list of ImageRow
+    """
+    group_filter = "AND images.group_id = :group_id" if group_id is not None else ""
+    cur.row_factory = image_row_factory
+    cur.execute("""
+        SELECT""" + IMAGE_ROW_COLUMNS + """
+        FROM images JOIN image_groups ON image_groups.id = images.group_id
+        WHERE images.id > :after_id AND images.removed = FALSE """ + group_filter + """
+        ORDER BY images.id
+        LIMIT :limit""", {'after_id': after_id, 'limit': limit, 'group_id': group_id})
+    rows = cur.fetchall()
+    cur.row_factory = None
+    return rows
+
+
+def get_display_history_page(cur, before_id=None, limit=50):
+    """ get one page of the display history, newest first
+    :param cur: database cursor
+    :param before_id: id of the last entry on the previous page, or None for the first page
+    :param limit: most entries to return
+    :return: list of (id, image_id, group name, filename, display_time, charging, charge_level)
+    """
+    cur.execute("""
+        SELECT
+            image_display_history.id,
+            image_display_history.image_id,
+            image_groups.name,
+            images.filename,
+            image_display_history.display_time,
+            image_display_history.charging,
+            image_display_history.charge_level
+        FROM image_display_history
+        JOIN images ON images.id = image_display_history.image_id
+        JOIN image_groups ON image_groups.id = images.group_id
+        WHERE image_display_history.id < :before_id
+        ORDER BY image_display_history.id DESC
+        LIMIT :limit""", {'before_id': before_id if before_id is not None else 2**63 - 1, 'limit': limit})
+    return cur.fetchall()
+
+
 def report_image_as_displayed(cur, image_id, charging, charge_level):
     """ update the record for an image showing that it was the one most recently displayed,
     and make a history entry for the event as well.
     :param cur: database cursor
     :param image_id: id of image
+    :param charging: True, False, or None if it couldn't be read.  The history has no room
+        for an unknown state, so that's recorded as not charging, which is how the battery
+        model and the rollups would count it anyway.
+    :return: id of the new history entry
     """
+    charging = bool(charging)
     current_date = calendar.timegm(datetime.now(UTC).utctimetuple())
     data = {
         "id": image_id,
@@ -286,6 +1180,179 @@ def report_image_as_displayed(cur, image_id, charging, charge_level):
     cur.execute("""INSERT INTO image_display_history
         (image_id, display_time, charging, charge_level)
         VALUES (?, ?, ?, ?)""", (image_id, current_date, charging, charge_level))
+    history_id = cur.lastrowid
+    add_to_history_rollups(cur, image_id, current_date, charging, charge_level)
+    return history_id
+
+
+def add_to_history_rollups(cur, image_id, display_time, charging, charge_level):
+    """ fold one display into the daily, per group, and per image rollups
+    :param cur: database cursor
+    :param image_id: id of image
+    :param display_time: when it was displayed
+    """
+    data = {
+        "id": image_id,
+        "day": int(display_time // 86400),
+        "time": display_time,
+        "on_battery": 0 if charging else 1,
+        "charge_level": charge_level
+    }
+    # In an upsert, the columns on the right of each SET are the values from before the update
+    cur.execute("""INSERT INTO history_daily
+        (day, displays, on_battery, charge_count, charge_sum, charge_min, charge_max)
+        VALUES (:day, 1, :on_battery, :charge_level IS NOT NULL, COALESCE(:charge_level, 0), :charge_level, :charge_level)
+        ON CONFLICT (day) DO UPDATE SET
+            displays = displays + 1,
+            on_battery = on_battery + excluded.on_battery,
+            charge_count = charge_count + excluded.charge_count,
+            charge_sum = charge_sum + excluded.charge_sum,
+            charge_min = MIN(COALESCE(charge_min, excluded.charge_min), COALESCE(excluded.charge_min, charge_min)),
+            charge_max = MAX(COALESCE(charge_max, excluded.charge_max), COALESCE(excluded.charge_max, charge_max))""", data)
+    cur.execute("""INSERT INTO history_by_group
+        (group_id, displays, first_display, last_display)
+        SELECT group_id, 1, :time, :time FROM images WHERE id = :id
+        ON CONFLICT (group_id) DO UPDATE SET
+            displays = displays + 1,
+            last_display = excluded.last_display""", data)
+    cur.execute("""INSERT INTO history_by_image
+        (image_id, displays, first_display, last_display, gap_count, gap_sum, max_gap)
+        VALUES (:id, 1, :time, :time, 0, 0, NULL)
+        ON CONFLICT (image_id) DO UPDATE SET
+            displays = displays + 1,
+            last_display = excluded.last_display,
+            gap_count = gap_count + 1,
+            gap_sum = gap_sum + (excluded.last_display - last_display),
+            max_gap = MAX(COALESCE(max_gap, 0), excluded.last_display - last_display)""", data)
+
+
+def rebuild_history_rollups(cur):
+    """ discard the history rollups and rebuild them from the raw display history.
+    Anything already compacted out of the raw history would be lost, so this is only
+    meant for a database that has never had rollups.
+    :param cur: database cursor
+    """
+    logger.info('Building display history rollups')
+    cur.execute("DELETE FROM history_daily")
+    cur.execute("DELETE FROM history_by_group")
+    cur.execute("DELETE FROM history_by_image")
+    cur.execute("""INSERT INTO history_daily
+        (day, displays, on_battery, charge_count, charge_sum, charge_min, charge_max)
+        SELECT CAST(display_time / 86400 AS INTEGER), COUNT(*), SUM(NOT COALESCE(charging, 0)),
+            COUNT(charge_level), COALESCE(SUM(charge_level), 0), MIN(charge_level), MAX(charge_level)
+        FROM image_display_history
+        WHERE display_time IS NOT NULL
+        GROUP BY 1""")
+    cur.execute("""INSERT INTO history_by_group
+        (group_id, displays, first_display, last_display)
+        SELECT images.group_id, COUNT(*), MIN(display_time), MAX(display_time)
+        FROM image_display_history JOIN images ON images.id = image_display_history.image_id
+        WHERE display_time IS NOT NULL
+        GROUP BY images.group_id""")
+    cur.execute("""INSERT INTO history_by_image
+        (image_id, displays, first_display, last_display, gap_count, gap_sum, max_gap)
+        SELECT image_id, COUNT(*), MIN(display_time), MAX(display_time),
+            COUNT(gap), COALESCE(SUM(gap), 0), MAX(gap)
+        FROM (
+            SELECT image_id, display_time,
+                display_time - LAG(display_time) OVER (PARTITION BY image_id ORDER BY id) AS gap
+            FROM image_display_history
+            WHERE display_time IS NOT NULL)
+        GROUP BY image_id""")
+
+
+def compact_display_history(cur, before_time):
+    """ delete raw display history older than the given time, along with its phase timings.
+    Every entry is already counted in the rollups, so nothing is lost from them.
+    Entries the battery drain model hasn't folded in yet are kept regardless.
+    :param cur: database cursor
+    :param before_time: entries displayed before this are deleted
+    :return: number of history entries deleted
+    """
+    data = {"before": before_time}
+    old_entries = """
+        SELECT id FROM image_display_history
+        WHERE display_time < :before
+            AND id <= (SELECT COALESCE(MAX(last_history_id), 0) FROM battery_model)"""
+    cur.execute("DELETE FROM wake_phase_timings WHERE history_id IN (" + old_entries + ")", data)
+    cur.execute("DELETE FROM image_display_history WHERE id IN (" + old_entries + ")", data)
+    return cur.rowcount
+
+
+def get_daily_rollups(cur, first_day, last_day):
+    """ get the daily display history rollups for a range of days
+    :param cur: database cursor
+    :param first_day: first day, in days since the epoch (UTC)
+    :param last_day: last day, inclusive
+    :return: list of (day, displays, displays on battery, lowest charge, highest charge, average charge), oldest first
+    """
+    cur.execute("""
+        SELECT day, displays, on_battery, charge_min, charge_max,
+            CASE WHEN charge_count > 0 THEN CAST(charge_sum AS REAL) / charge_count END
+        FROM history_daily
+        WHERE day BETWEEN ? AND ?
+        ORDER BY day""", (first_day, last_day))
+    return cur.fetchall()
+
+
+def get_group_rollups(cur):
+    """ get the display history rolled up for each image group
+    :param cur: database cursor
+    :return: list of (group id, group name, displays, first display time, last display time), by name
+    """
+    cur.execute("""
+        SELECT image_groups.id, image_groups.name, COALESCE(history_by_group.displays, 0),
+            history_by_group.first_display, history_by_group.last_display
+        FROM image_groups LEFT JOIN history_by_group ON history_by_group.group_id = image_groups.id
+        ORDER BY image_groups.name""")
+    return cur.fetchall()
+
+
+def get_image_rollup(cur, image_id):
+    """ get the display history rolled up for one image
+    :param cur: database cursor
+    :param image_id: id of image
+    :return: (displays, first display time, last display time, average gap, longest gap) or None if never displayed
+    """
+    cur.execute("""
+        SELECT displays, first_display, last_display,
+            CASE WHEN gap_count > 0 THEN gap_sum / gap_count END, max_gap
+        FROM history_by_image
+        WHERE image_id = ?""", (image_id,))
+    return cur.fetchone()
+
+
+def record_wake_phases(cur, history_id, phases):
+    """ store the phase timings for one wake
+    :param cur: database cursor
+    :param history_id: id of the image_display_history entry for the wake
+    :param phases: list of (phase name, seconds)
+    """
+    cur.executemany("""INSERT INTO wake_phase_timings
+        (history_id, phase, seconds)
+        VALUES (?, ?, ?)""", [(history_id, phase, seconds) for phase, seconds in phases])
+
+
+def get_recent_wake_phases(cur, wake_count, on_battery_only=False):
+    """ get the phase timings for the most recent wakes that recorded any
+    :param cur: database cursor
+    :param wake_count: how many wakes to go back
+    :param on_battery_only: skip wakes that happened while charging
+    :return: list of (history_id, phase, seconds), oldest wake first
+    """
+    charging_filter = "WHERE image_display_history.charging = FALSE" if on_battery_only else ""
+    cur.execute("""
+        SELECT wake_phase_timings.history_id, wake_phase_timings.phase, wake_phase_timings.seconds
+        FROM wake_phase_timings
+        WHERE wake_phase_timings.history_id IN (
+            SELECT DISTINCT wake_phase_timings.history_id
+            FROM wake_phase_timings
+            JOIN image_display_history ON image_display_history.id = wake_phase_timings.history_id
+            """ + charging_filter + """
+            ORDER BY wake_phase_timings.history_id DESC
+            LIMIT ?)
+        ORDER BY wake_phase_timings.history_id, wake_phase_timings.id""", (wake_count,))
+    return cur.fetchall()
 
 
 def finish_with_database(conn, cur):
@@ -0,0 +1,623 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# library_sync.py - fetch new and changed images from a web location into the library,
+# using as little radio time as possible: unchanged files cost no requests at all
+# (or one small conditional request), and interrupted downloads pick up where they left off.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+# The manifest is a JSON file like this, at the URL given by <syncurl> in config.xml:
+#
+# {
+#     "images": [
+#         {"group": "vacation", "filename": "beach.png", "path": "vacation/beach.png", "size": 545663, "version": "3f2a9c"},
+#         ...
+#     ]
+# }
+#
+# "path" is relative to the manifest, and defaults to group/filename.  "size" and "version" are
+# optional.  "version" is anything that changes when the file does (a hash, say), and when it's
+# given, a file whose version hasn't changed is skipped without asking the server.  Otherwise
+# the server is asked with a conditional request, using the ETag or Last-Modified it sent last time.
+#
+# Images should already be prepared for the frame, as PNG or BMP files.  Files the sync fetched
+# are deleted again if they drop out of the manifest.  Anything else in the library is left alone.
+
+import argparse, os, re, sys, json, logging
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlsplit, quote
+from common_utils import *
+from image_database import *
+from png_inventory import inventory_changed_files
+from time import monotonic
+
+
+# Number of downloads at once, used when config.xml doesn't set <syncconnections>.
+# Each keeps its own connection open for the whole sync.
+DEFAULT_CONNECTIONS = 3
+
+# Downloads are read and written in pieces this big
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+# Give up on a server that stops answering for this long
+TIMEOUT_SECONDS = 30
+
+# The last copy of the manifest, kept in installpath so a "not modified" reply is enough
+MANIFEST_CACHE_NAME = 'sync_manifest.json'
+
+# Manifest names become file and folder names in the library, so keep them tame
+SAFE_NAME = re.compile(r'^[^./\\\x00][^/\\\x00]*$')
+
+LIBRARY_EXTENSIONS = ('.png', '.bmp')
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class SyncError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """ Each worker thread keeps one persistent connection per server, so a sync of many
+    files pays for a handful of connection setups rather than one per file.
+    Also counts requests, connections, and bytes received.
+    """
+
+    def __init__(self, timeout=TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.all_connections = []
+        self.requests = 0
+        self.connections = 0
+        self.bytes_received = 0
+
+
+    def count(self, requests=0, connections=0, bytes_received=0):
+        with self.lock:
+            self.requests += requests
+            self.connections += connections
+            self.bytes_received += bytes_received
+
+
+    def _connection(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault('connections', {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == 'http':
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise SyncError("Can't fetch %s URLs" % (scheme))
+            connections[(scheme, netloc)] = conn
+            with self.lock:
+                self.all_connections.append(conn)
+        return conn
+
+
+    def get(self, url, headers):
+        """ send a GET request, retrying once on a fresh connection if the old one was dropped
+        :return: http.client.HTTPResponse, which must be read to the end before the next request
+        """
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        for attempt in range(2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            if conn.sock is None:
+                # Not connected yet, or the server closed it, so this request opens one
+                self.count(connections=1)
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+                self.count(requests=1)
+                return response
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                del self.local.connections[(parts.scheme, parts.netloc)]
+                if attempt == 1:
+                    raise
+
+
+    def read(self, response):
+        body = response.read()
+        self.count(bytes_received=len(body))
+        return body
+
+
+    def close(self):
+        with self.lock:
+            for conn in self.all_connections:
+                conn.close()
+            self.all_connections = []
+
+
+def validator_headers(record):
+    """ headers asking the server to skip a file we already have """
+    headers = {}
+    if record is None:
+        return headers
+    if record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+    if record.get('last_modified'):
+        headers['If-Modified-Since'] = record['last_modified']
+    return headers
+
+
+def partial_paths(output_file):
+    """ where an unfinished download, and what the server called its version, are kept.
+    Hidden, so inventory ignores them.
+    """
+    folder, filename = os.path.split(output_file)
+    partial = os.path.join(folder, '.' + filename + '.part')
+    return (partial, partial + 'info')
+
+
+def download_file(pool, job):
+    """ fetch one file into the library, resuming an earlier partial download if there is one.
+    Runs in a worker thread.
+    :param job: dictionary with url, output_file, size, and record (what we knew last time, or None)
+    :return: the job, with 'state' set to 'unchanged' or 'downloaded', and etag and last_modified
+    """
+    output_file = job['output_file']
+    partial, partial_info = partial_paths(output_file)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    offset = 0
+    headers = {}
+    if os.path.exists(partial) and os.path.exists(partial_info):
+        with open(partial_info, 'r') as f:
+            validator = f.read().strip()
+        offset = os.path.getsize(partial)
+        if validator and offset > 0:
+            # If-Range makes the server send the whole file instead if it has changed since
+            headers['Range'] = 'bytes=%d-' % (offset)
+            headers['If-Range'] = validator
+        else:
+            offset = 0
+    elif os.path.exists(output_file):
+        headers = validator_headers(job['record'])
+
+    response = pool.get(job['url'], headers)
+    if response.status == 304:
+        pool.read(response)
+        job['state'] = 'unchanged'
+        job['etag'] = job['record']['etag']
+        job['last_modified'] = job['record']['last_modified']
+        return job
+    if response.status == 416:
+        # The partial file doesn't fit what's on the server now.  Start over next time.
+        pool.read(response)
+        remove_quietly(partial)
+        remove_quietly(partial_info)
+        raise SyncError("Server refused to resume %s" % (job['url']))
+    if response.status == 206:
+        content_range = response.getheader('Content-Range', '')
+        m = re.match(r'bytes (\d+)-', content_range)
+        if not m or int(m.group(1)) != offset:
+            pool.read(response)
+            raise SyncError("Unexpected range %s from %s" % (content_range, job['url']))
+        mode = 'ab'
+    elif response.status == 200:
+        offset = 0
+        mode = 'wb'
+    else:
+        pool.read(response)
+        raise SyncError("Got %s %s for %s" % (response.status, response.reason, job['url']))
+
+    job['etag'] = response.getheader('ETag')
+    job['last_modified'] = response.getheader('Last-Modified')
+    if mode == 'wb':
+        with open(partial_info, 'w') as f:
+            f.write(job['etag'] or job['last_modified'] or '')
+
+    with open(partial, mode) as f:
+        while True:
+            chunk = response.read(DOWNLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            pool.count(bytes_received=len(chunk))
+            f.write(chunk)
+
+    size = os.path.getsize(partial)
+    if response.length not in (None, 0) or (job['size'] is not None and size != job['size']):
+        # Cut off partway.  Whatever arrived is kept, to be resumed next time.
+        raise SyncError("Download of %s stopped at %d bytes" % (job['url'], size))
+
+    os.replace(partial, output_file)
+    remove_quietly(partial_info)
+    job['state'] = 'downloaded'
+    return job
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def fetch_manifest(pool, cur, manifest_url, manifest_cache):
+    """ fetch the manifest, or use the cached copy if the server says it hasn't changed
+    :return: (manifest, True if it changed since last time)
+    """
+    synced = get_synced_files(cur)
+    record = synced.get(manifest_url) if os.path.exists(manifest_cache) else None
+    response = pool.get(manifest_url, validator_headers(record))
+    body = pool.read(response)
+    if response.status == 304:
+        with open(manifest_cache, 'r') as f:
+            return (json.load(f), False)
+    if response.status != 200:
+        raise SyncError("Got %s %s for the manifest" % (response.status, response.reason))
+    manifest = json.loads(body)
+    temp_file = manifest_cache + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(body)
+    os.replace(temp_file, manifest_cache)
+    set_synced_file(cur, {
+        'url': manifest_url,
+        'etag': response.getheader('ETag'),
+        'last_modified': response.getheader('Last-Modified')
+    })
+    return (manifest, True)
+
+
+def plan_sync(manifest, manifest_url, synced, library_path):
+    """ work out what needs fetching and what needs deleting
+    :return: (list of download jobs, list of synced file records to remove, count of files skipped)
+    """
+    jobs = []
+    wanted = set([manifest_url])
+    skipped = 0
+    for entry in manifest.get('images', []):
+        group_name = entry.get('group')
+        filename = entry.get('filename')
+        if not (isinstance(group_name, str) and isinstance(filename, str) and
+                SAFE_NAME.match(group_name) and SAFE_NAME.match(filename) and
+                filename.lower().endswith(LIBRARY_EXTENSIONS)):
+            logger.error("Skipping manifest entry with a bad group or filename: %s" % (entry))
+            continue
+        url = urljoin(manifest_url, quote(entry.get('path', group_name + '/' + filename)))
+        wanted.add(url)
+        output_file = os.path.join(library_path, group_name, filename)
+        record = synced.get(url)
+        version = entry.get('version')
+        if record is not None and os.path.exists(output_file) and record['group_name'] == group_name and record['filename'] == filename:
+            if version is not None and record['version'] == str(version):
+                skipped += 1
+                continue
+        else:
+            record = None
+        jobs.append({
+            'url': url,
+            'group_name': group_name,
+            'filename': filename,
+            'output_file': output_file,
+            'version': None if version is None else str(version),
+            'size': entry.get('size'),
+            'record': record
+        })
+    removed = [record for url, record in synced.items() if url not in wanted]
+    return (jobs, removed, skipped)
+
+
+def sync_library(verbose=False, config=None, connections=None):
+    """ bring the library up to date with the manifest at <syncurl>
+    :return: dictionary of counts and transfer statistics, or None if there's no <syncurl>
+    """
+    manifest_url = config.get('syncurl')
+    if not manifest_url:
+        logger.error("No <syncurl> in config.xml, nothing to sync with.")
+        return None
+    if connections is None:
+        connections = int(config.get('syncconnections', DEFAULT_CONNECTIONS))
+    library_path = config['library']
+    manifest_cache = os.path.join(config['installpath'], MANIFEST_CACHE_NAME)
+
+    conn = connect_to_local_db(os.path.join(config['installpath'], 'images.db'))
+    if not conn:
+        logger.error("Database could not be opened")
+        os._exit(os.EX_IOERR)
+    create_tables_if_missing(conn)
+    cur = conn.cursor()
+
+    start = monotonic()
+    pool = ConnectionPool()
+    results = {'downloaded': 0, 'unchanged': 0, 'skipped': 0, 'removed': 0, 'failed': 0}
+    try:
+        manifest, changed = fetch_manifest(pool, cur, manifest_url, manifest_cache)
+        conn.commit()
+        jobs, removed, skipped = plan_sync(manifest, manifest_url, get_synced_files(cur), library_path)
+        results['skipped'] = skipped
+        if verbose:
+            logger.info("Manifest %s, %d files to check, %d known to be current." % (
+                "changed" if changed else "unchanged", len(jobs), skipped))
+
+        removed_files = []
+        for record in removed:
+            if record['group_name'] is not None:
+                remove_quietly(os.path.join(library_path, record['group_name'], record['filename']))
+                removed_files.append((record['group_name'], record['filename']))
+        inventory_changed_files(cur, library_path, removed_files)
+        remove_synced_files(cur, [r['url'] for r in removed])
+        conn.commit()
+        results['removed'] = len(removed_files)
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(download_file, pool, job) for job in jobs]
+            for future in as_completed(futures):
+                try:
+                    job = future.result()
+                except (SyncError, http.client.HTTPException, OSError) as e:
+                    logger.error("Sync: %s" % (e))
+                    results['failed'] += 1
+                    continue
+                # Each file is added to the library and recorded as synced in a transaction of
+                # its own, so the frame and the web server aren't kept waiting on the downloads,
+                # and a sync that's cut off never leaves a file recorded but not in the library.
+                try:
+                    if job['state'] == 'downloaded':
+                        inventory_changed_files(cur, library_path, [(job['group_name'], job['filename'])])
+                    set_synced_file(cur, {
+                        'url': job['url'],
+                        'group_name': job['group_name'],
+                        'filename': job['filename'],
+                        'version': job['version'],
+                        'etag': job['etag'],
+                        'last_modified': job['last_modified'],
+                        'size': os.path.getsize(job['output_file'])
+                    })
+                    conn.commit()
+                except sqlite3.OperationalError as e:
+                    conn.rollback()
+                    logger.error("Sync: could not record %s/%s: %s" % (job['group_name'], job['filename'], e))
+                    results['failed'] += 1
+                    continue
+                results[job['state']] += 1
+                if job['state'] == 'downloaded' and verbose:
+                    logger.info("Fetched %s/%s" % (job['group_name'], job['filename']))
+
+        # Only a sync that got everything counts as one
+        if results['failed'] == 0:
+            set_last_sync(cur, calendar.timegm(datetime.now(UTC).utctimetuple()))
+    except sqlite3.OperationalError as e:
+        # Something else held the database for longer than the busy timeout.  What's
+        # already recorded is kept, and the next sync picks up the rest.
+        conn.rollback()
+        logger.error("Sync: database is busy: %s" % (e))
+        results['failed'] += 1
+    finally:
+        pool.close()
+        finish_with_database(conn, cur)
+
+    results['requests'] = pool.requests
+    results['connections'] = pool.connections
+    results['bytes_received'] = pool.bytes_received
+    results['seconds'] = monotonic() - start
+    logger.info("Sync: %(downloaded)d fetched, %(unchanged)d unchanged, %(skipped)d skipped, %(removed)d removed, "
+                "%(failed)d failed.  %(requests)d requests on %(connections)d connections, "
+                "%(bytes_received)d bytes, %(seconds).2f seconds." % results)
+    return results
+
+
+#
+# A local stand-in for the web location, for trying out the sync
+#
+
+
+def make_stand_in_handler():
+    """ build a request handler serving files with ETags and ranges, over keep-alive
+    connections, that can be told to cut a download off partway
+    """
+    import email.utils
+    from http.server import SimpleHTTPRequestHandler
+
+    class StandInHandler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Bytes to send of the next file download before dropping the connection
+        cut_off = None
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path = self.translate_path(self.path)
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            st = os.stat(path)
+            etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+            last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start = 0
+            m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if m and self.headers.get('If-Range') in (etag, last_modified):
+                start = int(m.group(1))
+                if start >= st.st_size:
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, st.st_size - 1, st.st_size))
+            else:
+                self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Content-Length', str(st.st_size - start))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                f.seek(start)
+                body = f.read()
+            cut_off = StandInHandler.cut_off
+            if cut_off is not None and not path.endswith('.json'):
+                StandInHandler.cut_off = None
+                self.wfile.write(body[:cut_off])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    return StandInHandler
+
+
+def write_stand_in_manifest(remote_path, versioned):
+    images = []
+    for group_name in sorted(os.listdir(remote_path)):
+        group_path = os.path.join(remote_path, group_name)
+        if not os.path.isdir(group_path):
+            continue
+        for filename in sorted(os.listdir(group_path)):
+            st = os.stat(os.path.join(group_path, filename))
+            entry = {'group': group_name, 'filename': filename, 'size': st.st_size}
+            if versioned:
+                entry['version'] = '%x' % (st.st_mtime_ns)
+            images.append(entry)
+    with open(os.path.join(remote_path, 'manifest.json'), 'w') as f:
+        json.dump({'images': images}, f)
+
+
+def test_sync(file_count=24, file_bytes=500000, versioned=True):
+    """ sync against a local stand-in server through a series of changes, checking
+    the library matches each time and reporting what each sync cost on the wire
+    """
+    import shutil, tempfile
+    from http.server import ThreadingHTTPServer
+    from functools import partial
+
+    root = tempfile.mkdtemp(prefix='epaper_sync_')
+    remote = os.path.join(root, 'remote')
+    handler = make_stand_in_handler()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=remote))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    config = {
+        'installpath': root,
+        'library': os.path.join(root, 'library'),
+        'syncurl': 'http://127.0.0.1:%d/manifest.json' % (server.server_address[1])
+    }
+    ok = True
+
+    def remote_file(i):
+        return os.path.join(remote, 'group%d' % (i % 3), 'image%03d.png' % (i))
+
+    def write_remote(i, seed):
+        os.makedirs(os.path.dirname(remote_file(i)), exist_ok=True)
+        with open(remote_file(i), 'wb') as f:
+            f.write(bytes([(i * 7 + seed) % 256]) * file_bytes)
+
+    def check(label, expected_fetches):
+        nonlocal ok
+        results = sync_library(False, config)
+        library_files = set()
+        for dirpath, _, filenames in os.walk(config['library']):
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    library_files.add(os.path.relpath(os.path.join(dirpath, filename), config['library']))
+        remote_files = set()
+        for dirpath, _, filenames in os.walk(remote):
+            for filename in filenames:
+                if filename != 'manifest.json':
+                    remote_files.add(os.path.relpath(os.path.join(dirpath, filename), remote))
+        matches = library_files == remote_files and all(
+            open(os.path.join(config['library'], f), 'rb').read() == open(os.path.join(remote, f), 'rb').read()
+            for f in remote_files)
+        conn = connect_to_local_db(os.path.join(root, 'images.db'))
+        images = count_displayable_images(conn.cursor()) if conn else 0
+        conn.close()
+        good = matches and images == len(remote_files) and results['downloaded'] == expected_fetches
+        ok = ok and good
+        logger.info("%-34s %3d fetched %4d requests %3d connections %9d bytes %6.2f s  %s" % (
+            label, results['downloaded'], results['requests'], results['connections'],
+            results['bytes_received'], results['seconds'], "ok" if good else "MISMATCH"))
+
+    logger.setLevel("INFO")
+    try:
+        for i in range(file_count):
+            write_remote(i, 0)
+        write_stand_in_manifest(remote, versioned)
+        check("First sync", file_count)
+        check("Nothing changed", 0)
+
+        # Change two files, add one, remove one
+        write_remote(1, 1)
+        write_remote(2, 1)
+        write_remote(file_count, 0)
+        os.remove(remote_file(3))
+        write_stand_in_manifest(remote, versioned)
+        check("Two changed, one added, one gone", 3)
+
+        # A download cut off partway, then resumed
+        write_remote(4, 1)
+        write_stand_in_manifest(remote, versioned)
+        handler.cut_off = file_bytes // 3
+        logger.setLevel("CRITICAL")
+        sync_library(False, config)
+        logger.setLevel("INFO")
+        check("Resumed after being cut off", 1)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    return ok
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Fetch new and changed images from the web location in config.xml")
+    args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
+                      help="reduce log output")
+    args.add_argument('--connections', type=int, default=None,
+                      help='Number of downloads at once (default from <syncconnections> in config.xml, or %d)' % (DEFAULT_CONNECTIONS))
+    args.add_argument('--test', action='store_true',
+                      help='Sync against a local stand-in server through a series of changes, and report what each cost')
+    args.add_argument('--unversioned', action='store_false', dest='versioned',
+                      help='In the test, leave versions out of the manifest so every file needs a conditional request')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    if args.test:
+        sys.exit(0 if test_sync(versioned=args.versioned) else 1)
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    results = sync_library(
+        verbose=args.verbose,
+        config=config,
+        connections=args.connections
+    )
+    if results is None or results['failed'] > 0:
+        sys.exit(1)
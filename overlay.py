@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# overlay.py - draw text and boxes over a packed display buffer, touching only the
+# bytes they cover, so a cached frame can get its overlay without being rendered again.
+# render_cache.py - a size-bounded on-disk cache of packed display buffers,
+# so a wake on battery can send a library image to the panel without decoding it.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, re, sys, logging
+from time import perf_counter
+from common_utils import *
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The font the C utility draws its message with
+FONT_FILE = os.path.join(HERE, 'EPD_13in3e_Utility', 'lib', 'Fonts', 'font24.c')
+
+# Panel memory layout and color codes, as in panel_frame.py.
+# (Repeated here so the wake path doesn't need numpy.)
+PANEL_WIDTH = 1200
+PANEL_HEIGHT = 1600
+ROW_BYTES = PANEL_WIDTH // 2
+PANEL_BLACK = 0x0
+PANEL_WHITE = 0x1
+PANEL_YELLOW = 0x2
+PANEL_RED = 0x3
+PANEL_BLUE = 0x5
+PANEL_GREEN = 0x6
+
+# Where the C utility draws its message
+MESSAGE_X = 10
+MESSAGE_Y = 10
+
+# Turns a pixel code into the high nibble of a packed byte
+HIGH_NIBBLE = bytes((i << 4) & 0xFF for i in range(256))
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class Font:
+    """ A fixed-width bitmap font, in the format of the fonts in EPD_13in3e_Utility/lib/Fonts:
+    one row of bits after another, each row padded to a whole byte, first character ' '.
+    Glyphs are rasterized to rows of pixel codes the first time they're drawn in each
+    pair of colors, and kept.
+    """
+
+    _loaded = {}
+
+    def __init__(self, table, width, height):
+        self.table = table
+        self.width = width
+        self.height = height
+        self.row_bytes = (width + 7) // 8
+        self.glyphs = {}
+
+
+    @classmethod
+    def from_c_source(cls, path=FONT_FILE):
+        """ read a font from its C source, once per process """
+        if path not in cls._loaded:
+            with open(path, 'r') as f:
+                source = f.read()
+            start = source.index('{', source.index('_Table'))
+            end = source.index('};', start)
+            # Every byte is written as 0x.., with a comma.  The comments after each row never are.
+            table = bytes.fromhex(''.join(re.findall(r'0x([0-9A-Fa-f]{2}),', source[start:end])))
+            size = re.search(r'sFONT\s+\w+\s*=\s*\{\s*\w+,\s*(\d+),[^,]*?(\d+),', source[end:])
+            cls._loaded[path] = cls(table, int(size.group(1)), int(size.group(2)))
+        return cls._loaded[path]
+
+
+    def glyph(self, char, foreground, background):
+        """ get a character as rows of pixel codes
+        :return: tuple of bytes objects, one per row, each one byte per pixel
+        """
+        key = (char, foreground, background)
+        rows = self.glyphs.get(key)
+        if rows is None:
+            index = ord(char) - ord(' ')
+            if index < 0 or (index + 1) * self.height * self.row_bytes > len(self.table):
+                index = ord('?') - ord(' ')
+            offset = index * self.height * self.row_bytes
+            rows = []
+            for row in range(self.height):
+                bits = self.table[offset + row * self.row_bytes:offset + (row + 1) * self.row_bytes]
+                rows.append(bytes(
+                    foreground if bits[column // 8] & (0x80 >> (column % 8)) else background
+                    for column in range(self.width)))
+            rows = tuple(rows)
+            self.glyphs[key] = rows
+        return rows
+
+
+def pack_codes(codes):
+    """ pack an even number of pixel codes two to a byte, high nibble first """
+    high = codes[0::2].translate(HIGH_NIBBLE)
+    low = codes[1::2]
+    return (int.from_bytes(high, 'big') | int.from_bytes(low, 'big')).to_bytes(len(high), 'big')
+
+
+def write_codes(frame, x, y, codes):
+    """ write a run of pixel codes into one row of a packed display buffer,
+    clipped to the panel, keeping the pixels that share a byte with either end
+    :param frame: bytearray of a packed display buffer
+    :param codes: bytes of pixel codes, one per pixel
+    """
+    if y < 0 or y >= PANEL_HEIGHT:
+        return
+    if x < 0:
+        codes = codes[-x:]
+        x = 0
+    codes = codes[:PANEL_WIDTH - x]
+    if not codes:
+        return
+    start = y * ROW_BYTES
+    if x % 2:
+        codes = bytes([frame[start + x // 2] >> 4]) + codes
+        x -= 1
+    if len(codes) % 2:
+        codes = codes + bytes([frame[start + (x + len(codes)) // 2] & 0x0F])
+    first = start + x // 2
+    frame[first:first + len(codes) // 2] = pack_codes(codes)
+
+
+class Overlay:
+    """ Text and boxes to draw over a frame.  Only the rectangles they cover are written,
+    so the cost depends on the size of the overlay, not the frame.
+    """
+
+    def __init__(self, font=None):
+        self.font = font
+        self.items = []
+
+
+    def add_text(self, x, y, text, foreground=PANEL_BLACK, background=PANEL_WHITE):
+        """ draw text the way Paint_DrawString_EN does, wrapping at the right edge
+        of the panel and starting again at the top if it runs off the bottom
+        :param x: left edge, in panel memory pixels
+        :param y: top edge, in panel memory pixels
+        """
+        self.items.append(('text', x, y, text, foreground, background))
+        return self
+
+
+    def add_box(self, x, y, width, height, color):
+        """ fill a rectangle with one color, e.g. for a battery gauge """
+        self.items.append(('box', x, y, width, height, color))
+        return self
+
+
+    def text_runs(self, x, y, text):
+        """ lay text out into lines the way Paint_DrawString_EN does
+        :return: list of (x, y, characters) for each run of characters on one line
+        """
+        font = self.font
+        runs = []
+        line_x, line_y, line = x, y, ''
+        for char in text:
+            if line_x + (len(line) + 1) * font.width > PANEL_WIDTH:
+                runs.append((line_x, line_y, line))
+                line_x, line_y, line = x, line_y + font.height, ''
+            if line_y + font.height > PANEL_HEIGHT:
+                runs.append((line_x, line_y, line))
+                line_x, line_y, line = x, y, ''
+            line += char
+        runs.append((line_x, line_y, line))
+        return [run for run in runs if run[2]]
+
+
+    def apply(self, frame):
+        """ draw everything onto a frame, in the order it was added
+        :param frame: bytearray of a packed display buffer, changed in place
+        :return: list of (x, y, width, height) rectangles that were written
+        """
+        dirty = []
+        for item in self.items:
+            if item[0] == 'box':
+                _, x, y, width, height, color = item
+                row = bytes([color]) * width
+                for line in range(y, y + height):
+                    write_codes(frame, x, line, row)
+                dirty.append((x, y, width, height))
+                continue
+            _, x, y, text, foreground, background = item
+            if self.font is None:
+                self.font = Font.from_c_source()
+            font = self.font
+            for run_x, run_y, chars in self.text_runs(x, y, text):
+                glyphs = [font.glyph(c, foreground, background) for c in chars]
+                for row in range(font.height):
+                    write_codes(frame, run_x, run_y + row, b''.join(g[row] for g in glyphs))
+                dirty.append((run_x, run_y, len(chars) * font.width, font.height))
+        return dirty
+
+
+def battery_message(capacity):
+    """ the overlay text for a battery reading, as it has always been shown """
+    return "%2i%%" % capacity
+
+
+def benchmark_overlay(frame_file, text, repeat=1000):
+    """ time drawing an overlay onto a copy of a cached frame """
+    with open(frame_file, 'rb') as f:
+        clean = f.read()
+
+    start = perf_counter()
+    font = Font.from_c_source()
+    load_time = perf_counter() - start
+
+    overlay = Overlay(font).add_text(MESSAGE_X, MESSAGE_Y, text)
+    overlay.apply(bytearray(clean))
+
+    start = perf_counter()
+    for _ in range(repeat):
+        frame = bytearray(clean)
+    copy_time = (perf_counter() - start) / repeat
+
+    start = perf_counter()
+    for _ in range(repeat):
+        dirty = overlay.apply(frame)
+    apply_time = (perf_counter() - start) / repeat
+
+    logger.info("Reading font24.c: %.2f ms, once per process" % (load_time * 1000))
+    logger.info("Copying the cached frame: %.1f microseconds" % (copy_time * 1e6))
+    logger.info("Drawing %r: %.1f microseconds, %i rectangle(s) written" % (text, apply_time * 1e6, len(dirty)))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Draw overlay text onto a packed display buffer")
+    args.add_argument('--in', type=str, dest='input_file', required=True,
+                      help='Packed .frame file')
+    args.add_argument('--out', type=str, dest='output_file', default=None,
+                      help='Where to write the frame with the overlay')
+    args.add_argument('--text', type=str, default=' 80%',
+                      help='Text to draw where the C utility draws its message')
+    args.add_argument('--benchmark', type=int, default=None, metavar='COUNT',
+                      help='Time drawing the text COUNT times instead')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    if args.benchmark:
+        benchmark_overlay(args.input_file, args.text, args.benchmark)
+        sys.exit()
+
+    with open(args.input_file, 'rb') as f:
+        frame = bytearray(f.read())
+    Overlay().add_text(MESSAGE_X, MESSAGE_Y, args.text).apply(frame)
+    with open(args.output_file or args.input_file, 'wb') as f:
+        f.write(frame)
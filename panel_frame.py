@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# panel_frame.py - convert images into the packed 4-bit framebuffer the display consumes.
+# The output matches what the C utility builds in memory with GUI_ReadBmp before it
+# calls EPD_13IN3E_Display, so a stored frame can be handed to the panel as-is.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, sys, logging
+import numpy as np
+from PIL import Image
+from common_utils import *
+
+
+# Panel memory layout, from EPD_13in3e.h.  The panel is addressed in portrait
+# orientation, two pixels per byte, high nibble first.
+PANEL_WIDTH = 1200
+PANEL_HEIGHT = 1600
+FRAME_BYTES = (PANEL_WIDTH // 2) * PANEL_HEIGHT
+
+# Color codes understood by the panel controller
+PANEL_BLACK = 0x0
+PANEL_WHITE = 0x1
+PANEL_YELLOW = 0x2
+PANEL_RED = 0x3
+PANEL_BLUE = 0x5
+PANEL_GREEN = 0x6
+
+# The C utility calls Paint_Clear(WHITE) before drawing, and GUI_Paint's WHITE is 0xFF,
+# so any area not covered by the image ends up with every nibble set.
+PANEL_CLEAR = 0xF
+
+
+# Map an RGB value to a panel color code, using the same thresholds as
+# DrawMatrix in GUI_BMPfile.c.  Anything that doesn't match defaults to black.
+def panel_color_for_rgb(r, g, b):
+    if b > 128 and g > 128 and r > 128:
+        return PANEL_WHITE
+    elif b < 128 and g > 128 and r > 128:
+        return PANEL_YELLOW
+    elif b < 128 and g < 128 and r > 128:
+        return PANEL_RED
+    elif b > 128 and g < 128 and r < 128:
+        return PANEL_BLUE
+    elif b < 128 and g > 128 and r < 128:
+        return PANEL_GREEN
+    return PANEL_BLACK
+
+
+def codes_to_frame(codes):
+    """ rotate and pack a 2D array of panel color codes into a display buffer
+    :param codes: uint8 array of panel color codes, shaped (height, width) like the source image
+    :return: bytes object of length FRAME_BYTES
+    """
+    height, width = codes.shape
+    panel = np.full((PANEL_HEIGHT, PANEL_WIDTH), PANEL_CLEAR, dtype=np.uint8)
+
+    # DrawMatrix lays landscape images on their side and flips everything vertically.
+    if width > height:
+        w = min(width, PANEL_HEIGHT)
+        h = min(height, PANEL_WIDTH)
+        panel[PANEL_HEIGHT - w:, :h] = codes[:h, :w].T[::-1]
+    else:
+        w = min(width, PANEL_WIDTH)
+        h = min(height, PANEL_HEIGHT)
+        panel[PANEL_HEIGHT - h:, :w] = codes[:h, :w][::-1]
+
+    packed = (panel[:, 0::2] << 4) | panel[:, 1::2]
+    return packed.tobytes()
+
+
+def paletted_image_to_frame(img):
+    """ convert a 'P' mode image into a display buffer
+    :param img: PIL image in 'P' mode
+    :return: bytes object of length FRAME_BYTES
+    """
+    palette = img.getpalette() or []
+    palette = palette + [0] * (768 - len(palette))
+    index_to_code = np.array(
+        [panel_color_for_rgb(palette[i*3], palette[i*3+1], palette[i*3+2]) for i in range(256)],
+        dtype=np.uint8)
+    return codes_to_frame(index_to_code[np.asarray(img)])
+
+
+def render_frame(input_file):
+    """ render a prepared PNG into a display buffer, the same way
+    png_to_bmp followed by the C utility would
+    :param input_file: path or file object of the input image
+    :return: bytes object of length FRAME_BYTES
+    """
+    img = Image.open(input_file)
+    if not is_six_color_paletted(img):
+        img = img.quantize(colors=6, method=Image.FASTOCTREE)
+    return paletted_image_to_frame(img)
+
+
+def is_six_color_paletted(img):
+    """ True for images that already use at most six palette colors, like the ones
+    prepare_image makes.  Those can have their palette mapped straight to panel colors,
+    without quantizing them again.
+    """
+    return img.mode == 'P' and img.getcolors(6) is not None
+
+
+def write_frame(output_file, frame):
+    """ atomically write a display buffer to disk
+    :param output_file: destination path
+    :param frame: bytes object of length FRAME_BYTES
+    """
+    temp_file = output_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(frame)
+    os.replace(temp_file, output_file)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Convert a PNG to a packed display buffer")
+    args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
+                      help="reduce log output")
+    args.add_argument('--in', type=str, dest='input_file',
+                      help='Input PNG file', required=True)
+    args.add_argument('--out', type=str, dest='output_file',
+                      help='Output frame file', required=True)
+    args = args.parse_args()
+
+    set_up_logger()
+
+    write_frame(args.output_file, render_frame(args.input_file))
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# perceptual_hash.py - find pictures that appear more than once in the library,
+# in different groups or at slightly different crops, using a perceptual hash (dHash).
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, sys, logging
+from itertools import combinations
+import numpy as np
+from PIL import Image
+from common_utils import *
+from image_database import *
+from time import monotonic
+
+
+# Hashes further apart than this many bits (out of 64) are different pictures.
+# Rescaled, re-dithered, or lightly cropped copies of a picture usually come in under.
+# Anything up to 7 keeps lookups to one flipped bit per band, which is much faster than 8 or more.
+DEFAULT_DISTANCE = 7
+
+# The hash is split into this many 16-bit bands for lookup.  Two hashes within
+# distance d must match to within d // HASH_BANDS bits in at least one band.
+HASH_BANDS = 4
+BAND_BITS = 64 // HASH_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+# Images decoded and hashed together
+BATCH_SIZE = 64
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+def reduced_image(path):
+    """ decode an image down to the 9x8 grayscale grid the hash compares """
+    img = Image.open(path)
+    # Lets JPEG decoding skip most of the work.  No effect on PNG.
+    img.draft('L', (9 * 8, 8 * 8))
+    return np.asarray(img.convert('L').resize((9, 8), Image.BOX), dtype=np.int16)
+
+
+def dhash_grids(grids):
+    """ hash a batch of 9x8 grids all at once.  Each bit says whether a cell is
+    brighter than its neighbor to the right.
+    :param grids: array shaped (n, 8, 9)
+    :return: list of hashes as signed 64-bit integers, the way SQLite stores them
+    """
+    bits = (grids[:, :, 1:] > grids[:, :, :-1]).reshape(len(grids), 64)
+    packed = np.packbits(bits, axis=1)
+    return packed.view('>i8').ravel().tolist()
+
+
+def unsigned(h):
+    return h & 0xFFFFFFFFFFFFFFFF
+
+
+def hash_bands(h):
+    """ split a hash into its lookup bands
+    :return: list of band values, first band first
+    """
+    h = unsigned(h)
+    return [(h >> (band * BAND_BITS)) & BAND_MASK for band in range(HASH_BANDS)]
+
+
+def flip_masks(radius):
+    """ every way of flipping up to radius bits of a band value, as XOR masks """
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), r):
+            mask = 0
+            for bit in bits:
+                mask |= 1 << bit
+            masks.append(mask)
+    return masks
+
+
+def hamming_distance(a, b):
+    return bin(unsigned(a) ^ unsigned(b)).count('1')
+
+
+def popcounts(x):
+    """ count the set bits in each element of a uint64 array """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def update_perceptual_hashes(cur, library_path, recluster=False, max_distance=DEFAULT_DISTANCE, verbose=False):
+    """ hash any images that are new or have changed since they were last hashed,
+    then find the near-duplicate clusters again if anything changed.
+    :param cur: database cursor
+    :param library_path: path to the library, containing one folder per group
+    :param recluster: find the clusters again even if nothing needed hashing,
+    e.g. because images were removed
+    :return: number of images hashed
+    """
+    images = get_images_needing_perceptual_hash(cur)
+    start = monotonic()
+    hashed = 0
+    for batch_start in range(0, len(images), BATCH_SIZE):
+        batch = images[batch_start:batch_start + BATCH_SIZE]
+        grids = []
+        ids = []
+        for image in batch:
+            try:
+                grids.append(reduced_image(os.path.join(library_path, image.group_name, image.filename)))
+                ids.append(image.id)
+            except OSError as e:
+                logger.error('Could not hash %s/%s: %s' % (image.group_name, image.filename, e))
+        if len(grids) == 0:
+            continue
+        hashes = list(zip(ids, dhash_grids(np.stack(grids))))
+        bands = [(band, value, image_id) for image_id, h in hashes for band, value in enumerate(hash_bands(h))]
+        set_perceptual_hashes(cur, hashes, bands)
+        hashed += len(hashes)
+        if verbose:
+            logger.info("Hashed %d of %d images." % (hashed, len(images)))
+    if hashed:
+        logger.info("Computed %d perceptual hashes in %.2f seconds." % (hashed, monotonic() - start))
+
+    if hashed or recluster:
+        clusters = find_clusters(get_perceptual_hashes(cur), max_distance)
+        set_duplicate_clusters(cur, clusters)
+        logger.info("%d near-duplicate clusters, covering %d images." % (len(clusters), sum(len(c) for c in clusters)))
+    return hashed
+
+
+def find_close_pairs(hashes, max_distance=DEFAULT_DISTANCE):
+    """ find every pair of hashes within max_distance of each other, with a multi-index
+    over the hash bands: each band is sorted once, then looked up with every value within
+    max_distance // HASH_BANDS bits of each image's own, all images at once.  So each image
+    is only compared with the few that share a nearby band value, never with the whole library.
+    :param hashes: list of (image id, hash)
+    :return: set of (image id, image id) pairs, lower id first
+    """
+    if len(hashes) < 2:
+        return set()
+    ids = np.array([image_id for image_id, _ in hashes], dtype=np.int64)
+    values = np.array([unsigned(h) for _, h in hashes], dtype=np.uint64)
+    everything = np.arange(len(values))
+    masks = flip_masks(max_distance // HASH_BANDS)
+    pairs = set()
+    for band in range(HASH_BANDS):
+        band_values = ((values >> np.uint64(band * BAND_BITS)) & np.uint64(BAND_MASK)).astype(np.int64)
+        order = np.argsort(band_values, kind='stable')
+        sorted_values = band_values[order]
+        for mask in masks:
+            probes = band_values ^ mask
+            low = np.searchsorted(sorted_values, probes, 'left')
+            counts = np.searchsorted(sorted_values, probes, 'right') - low
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            # Every (image, image with a matching band value) combination
+            starts = np.cumsum(counts) - counts
+            first = np.repeat(everything, counts)
+            second = order[np.repeat(low, counts) + (np.arange(total) - np.repeat(starts, counts))]
+            keep = first < second
+            first = first[keep]
+            second = second[keep]
+            close = popcounts(values[first] ^ values[second]) <= max_distance
+            for a, b in zip(ids[first[close]].tolist(), ids[second[close]].tolist()):
+                pairs.add((min(a, b), max(a, b)))
+    return pairs
+
+
+def find_clusters(hashes, max_distance=DEFAULT_DISTANCE):
+    """ group images whose hashes are within max_distance of each other, directly or
+    through a chain of others
+    :param hashes: list of (image id, hash)
+    :return: list of clusters of two or more image ids, each sorted, lowest id first
+    """
+    parent = {}
+
+    def find(x):
+        while parent.get(x, x) != x:
+            parent[x] = parent.get(parent[x], parent[x])
+            x = parent[x]
+        return x
+
+    for a, b in find_close_pairs(hashes, max_distance):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    clusters = {}
+    for image_id in list(parent.keys()):
+        clusters.setdefault(find(image_id), set()).add(image_id)
+    for root, members in clusters.items():
+        members.add(root)
+    return sorted(sorted(members) for members in clusters.values())
+
+
+def find_near_duplicates(cur, image_hash, max_distance=DEFAULT_DISTANCE):
+    """ find the images within max_distance of a hash, using the band index in the database
+    :param cur: database cursor
+    :param image_hash: hash to look for
+    :return: list of (image id, distance), closest first
+    """
+    masks = flip_masks(max_distance // HASH_BANDS)
+    candidates = get_images_in_hash_bands(cur, [
+        (band, [value ^ mask for mask in masks]) for band, value in enumerate(hash_bands(image_hash))])
+    matches = [(image_id, hamming_distance(image_hash, h)) for image_id, h in candidates]
+    return sorted([m for m in matches if m[1] <= max_distance], key=lambda m: m[1])
+
+
+def report_duplicates(cur, skip_duplicates):
+    clusters = get_duplicate_clusters(cur)
+    if len(clusters) == 0:
+        logger.info("No near-duplicates found.")
+        return
+    hidden = 0
+    for kept_id, images in sorted(clusters.items()):
+        logger.info("Cluster of %d:" % (len(images)))
+        for image in images:
+            hidden += image.id != kept_id
+            logger.info("  %6d %s/%s%s" % (image.id, image.group_name, image.filename,
+                                           "  (shown)" if image.id == kept_id else ""))
+    logger.info("%d clusters.  %d images are near-duplicates of another%s." % (
+        len(clusters), hidden, ", and are skipped" if skip_duplicates else
+        ".  Add <skipduplicates>1</skipduplicates> to config.xml to skip them"))
+
+
+def benchmark_clustering(image_count, max_distance=DEFAULT_DISTANCE):
+    """ compare clustering with the band index against comparing every pair,
+    on random hashes with some near-duplicates mixed in
+    """
+    rng = np.random.default_rng(1)
+    raw = rng.integers(0, 2**63, size=image_count, dtype=np.int64) * 2 + rng.integers(0, 2, size=image_count)
+    hashes = [(i, int(h)) for i, h in enumerate(raw.tolist())]
+    # Every tenth image is a copy of the one before, with a few bits flipped
+    for i in range(1, image_count, 10):
+        flipped = hashes[i - 1][1]
+        for bit in rng.choice(64, size=int(rng.integers(0, max_distance + 1)), replace=False):
+            flipped ^= 1 << int(bit)
+        hashes[i] = (i, flipped - (1 << 64) if flipped >= 1 << 63 else flipped)
+
+    start = monotonic()
+    pairs = find_close_pairs(hashes, max_distance)
+    indexed = monotonic() - start
+    logger.info("%7d hashes, band index: %d close pairs in %.2f seconds." % (image_count, len(pairs), indexed))
+
+    if image_count <= 20000:
+        start = monotonic()
+        values = np.array([unsigned(h) for _, h in hashes], dtype=np.uint64)
+        brute_pairs = 0
+        for i in range(image_count - 1):
+            brute_pairs += int((popcounts(values[i + 1:] ^ values[i]) <= max_distance).sum())
+        brute = monotonic() - start
+        logger.info("%7d hashes, every pair: %d close pairs in %.2f seconds." % (image_count, brute_pairs, brute))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Find near-duplicate images in the library")
+    args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
+                      help="reduce log output")
+    args.add_argument('--distance', type=int, default=DEFAULT_DISTANCE,
+                      help='Most bits two hashes can differ by and still count as the same picture')
+    args.add_argument('--recluster', action='store_true',
+                      help='Find the clusters again even if no images need hashing, e.g. after changing --distance')
+    args.add_argument('--like', type=int, default=None, metavar='ID',
+                      help='List the images that look like the one with this id')
+    args.add_argument('--benchmark', type=int, nargs='+', default=None, metavar='COUNT',
+                      help='Time clustering on the given numbers of random hashes instead')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    if args.benchmark:
+        for count in args.benchmark:
+            benchmark_clustering(count, args.distance)
+        sys.exit()
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    database_file = os.path.join(config['installpath'], 'images.db')
+    conn = connect_to_local_db(database_file)
+    if not conn:
+        logger.error("Database could not be opened")
+        os._exit(os.EX_IOERR)
+    create_tables_if_missing(conn)
+    cur = conn.cursor()
+    update_perceptual_hashes(cur, config['library'], args.recluster, args.distance, args.verbose)
+    if args.like is not None:
+        cur.execute("SELECT perceptual_hash FROM images WHERE id = ?", (args.like,))
+        row = cur.fetchone()
+        if row is None or row[0] is None:
+            logger.error("No hashed image with id %s." % (args.like))
+        else:
+            for image_id, distance in find_near_duplicates(cur, row[0], args.distance):
+                image = get_image_by_id(cur, image_id)
+                logger.info("  %6d %s/%s, %d bits different" % (image_id, image.group_name, image.filename, distance))
+    else:
+        report_duplicates(cur, selection_options(config)['skip_duplicates'])
+    finish_with_database(conn, cur)
@@ -22,13 +22,38 @@
 # 2. Altered source versions must be plainly marked as such, and must not be
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
-import struct
 from datetime import *
+from time import monotonic
 from common_utils import *
 
 
 PiSugar3_Addr = 0x57
 
+# Registers we use.  See https://github.com/PiSugar/PiSugar/wiki/PiSugar-3-I2C-Datasheet
+REG_STATUS = 0x02
+REG_WRITE_PROTECT = 0x0B
+REG_CAPACITY = 0x2A
+REG_RTC_YEAR = 0x31
+REG_RTC_MONTH = 0x32
+REG_RTC_DAY = 0x33
+REG_RTC_HOUR = 0x35
+REG_RTC_MINUTE = 0x36
+REG_RTC_SECOND = 0x37
+REG_ALARM_HOUR = 0x45
+REG_ALARM_MINUTE = 0x46
+REG_ALARM_SECOND = 0x47
+
+WRITE_PROTECT_OFF = 0x29
+WRITE_PROTECT_ON = 0xFF
+
+# Everything but the status register lies in one run that fits in a single
+# SMBus block transfer (32 bytes at most), from the capacity to the alarm registers.
+SNAPSHOT_START = REG_CAPACITY
+SNAPSHOT_LENGTH = REG_ALARM_SECOND - REG_CAPACITY + 1
+SNAPSHOT_REGISTERS = [REG_CAPACITY, REG_RTC_YEAR, REG_RTC_MONTH, REG_RTC_DAY, REG_RTC_HOUR, REG_RTC_MINUTE,
+                      REG_RTC_SECOND, REG_ALARM_HOUR, REG_ALARM_MINUTE, REG_ALARM_SECOND]
+
+
 # Parse a hexadecimal value mocked to look a decimal into the actual decimal value.
 # e.g. 0x36 becomes 36, not 54.
 def hexAsDec(v):
@@ -44,40 +69,73 @@ def decAsHex(v):
 
 class PiSugarBattery:
 
-    def __init__(self):
-        import smbus
-        self._bus = smbus.SMBus(1)
+    # bus can be any object with the smbus interface, e.g. fake_smbus.FakeSMBus.
+    # By default it's the real I2C bus 1.
+    def __init__(self, bus=None):
+        if bus is None:
+            import smbus
+            bus = smbus.SMBus(1)
+        self._bus = bus
         self.sample_size = 25
         self.battery_readings = []
+        self._registers = None
+        self._snapshot_time = None
 
 
-    def capacity(self):
-        battery_level = 0
+    # Read all the registers we need in two bus transactions, and keep them
+    # for the rest of the wake.  Called automatically on first use.
+    def snapshot(self):
+        self._registers = {}
+        self._snapshot_time = monotonic()
         try:
-            battery_level = self._bus.read_byte_data(PiSugar3_Addr, 0x2a)
+            self._registers[REG_STATUS] = self._bus.read_byte_data(PiSugar3_Addr, REG_STATUS)
         except:
             pass
+        try:
+            values = self._bus.read_i2c_block_data(PiSugar3_Addr, SNAPSHOT_START, SNAPSHOT_LENGTH)
+            for i, v in enumerate(values):
+                self._registers[SNAPSHOT_START + i] = v
+        except:
+            # Not every bus driver can do block transfers.  Fall back to the registers we use.
+            for reg in SNAPSHOT_REGISTERS:
+                try:
+                    self._registers[reg] = self._bus.read_byte_data(PiSugar3_Addr, reg)
+                except:
+                    pass
+        return self._registers
+
+
+    def _register(self, reg):
+        if self._registers is None:
+            self.snapshot()
+        return self._registers.get(reg)
+
+
+    def capacity(self):
+        battery_level = self._register(REG_CAPACITY)
+        if battery_level is None:
+            return 0
         return battery_level
 
 
-    # Returns the current alarm timer setting, expressed in seconds
-    # starting from midnight (12:00am).
+    # Returns the real time clock as a datetime, as of the snapshot.
     def get_real_time_clock(self):
-        try:
-            yrRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x31)
-            mon = self._bus.read_byte_data(PiSugar3_Addr, 0x32)
-            dayRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x33)
-            h = self._bus.read_byte_data(PiSugar3_Addr, 0x35)
-            minRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x36)
-            secRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x37)
-        except:
+        yrRaw = self._register(REG_RTC_YEAR)
+        monRaw = self._register(REG_RTC_MONTH)
+        dayRaw = self._register(REG_RTC_DAY)
+        hRaw = self._register(REG_RTC_HOUR)
+        minRaw = self._register(REG_RTC_MINUTE)
+        secRaw = self._register(REG_RTC_SECOND)
+        if None in (yrRaw, monRaw, dayRaw, hRaw, minRaw, secRaw):
             return None
         clock_as_datetime = None
         try:
             # These are hexadecimal values mocked to look like decimals,
             # e.g. 0x36 is actually 36 minutes, not 54 minutes.
             yr = hexAsDec(yrRaw)
+            mon = hexAsDec(monRaw)
             day = hexAsDec(dayRaw)
+            h = hexAsDec(hRaw)
             min = hexAsDec(minRaw)
             sec = hexAsDec(secRaw)
             clock_as_datetime = datetime(yr + 2000, mon, day, hour=h, minute=min, second=sec, tzinfo=timezone.utc)
@@ -89,11 +147,10 @@ class PiSugarBattery:
     # Returns the current alarm timer setting, expressed in seconds
     # starting from midnight (12:00am).
     def get_alarm_timer(self):
-        try:
-            hourRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x45)
-            minRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x46)
-            secRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x47)
-        except:
+        hourRaw = self._register(REG_ALARM_HOUR)
+        minRaw = self._register(REG_ALARM_MINUTE)
+        secRaw = self._register(REG_ALARM_SECOND)
+        if None in (hourRaw, minRaw, secRaw):
             return None
         hour = hexAsDec(hourRaw)
         min = hexAsDec(minRaw)
@@ -101,6 +158,11 @@ class PiSugarBattery:
         return (((hour * 60) + min) * 60) + sec
 
 
+    # Reads the alarm registers straight from the bus, one at a time, bypassing the snapshot.
+    def _read_alarm_registers(self):
+        return [self._bus.read_byte_data(PiSugar3_Addr, reg) for reg in (REG_ALARM_HOUR, REG_ALARM_MINUTE, REG_ALARM_SECOND)]
+
+
     # Sets the alarm timer setting, with the given h=hours, m=minutes, s=seconds
     # but does not check to see if the timer is actually enabled.
     def set_alarm_timer(self, hour, min, sec):
@@ -108,34 +170,51 @@ class PiSugarBattery:
         hourHex = decAsHex(hour)
         minHex = decAsHex(min)
         secHex = decAsHex(sec)
+        alarm = [hourHex, minHex, secHex]
         try:
             # Turn off write protection
-            self._bus.write_byte_data(PiSugar3_Addr, 0x0B, 0x29)
-            # Write in the new time
-            self._bus.write_byte_data(PiSugar3_Addr, 0x45, hourHex)
-            self._bus.write_byte_data(PiSugar3_Addr, 0x46, minHex)
-            self._bus.write_byte_data(PiSugar3_Addr, 0x47, secHex)
-            # Turn on write protection
-            self._bus.write_byte_data(PiSugar3_Addr, 0x0B, 0xFF)
+            self._bus.write_byte_data(PiSugar3_Addr, REG_WRITE_PROTECT, WRITE_PROTECT_OFF)
+            try:
+                # Write in the new time, all three registers at once if the bus allows it.
+                # If the firmware doesn't step to the next register during a block write,
+                # the write still succeeds but leaves the alarm wrong, so read it back.
+                try:
+                    self._bus.write_i2c_block_data(PiSugar3_Addr, REG_ALARM_HOUR, alarm)
+                    written = self._read_alarm_registers() == alarm
+                except:
+                    written = False
+                if not written:
+                    self._bus.write_byte_data(PiSugar3_Addr, REG_ALARM_HOUR, hourHex)
+                    self._bus.write_byte_data(PiSugar3_Addr, REG_ALARM_MINUTE, minHex)
+                    self._bus.write_byte_data(PiSugar3_Addr, REG_ALARM_SECOND, secHex)
+                    if self._read_alarm_registers() != alarm:
+                        return False
+            finally:
+                # Turn on write protection
+                self._bus.write_byte_data(PiSugar3_Addr, REG_WRITE_PROTECT, WRITE_PROTECT_ON)
         except:
             return False
+        if self._registers is not None:
+            self._registers[REG_ALARM_HOUR] = hourHex
+            self._registers[REG_ALARM_MINUTE] = minHex
+            self._registers[REG_ALARM_SECOND] = secHex
         return True
 
 
-    # Sets the alarm timer for the given seconds after the current time
-    # (as read from the real time clock)
+    # Sets the alarm timer for the given seconds after the current time.
+    # The current time is the real time clock from the snapshot, plus however
+    # long it's been since the snapshot was taken, so the bus isn't read again.
     def set_alarm_for_seconds_from_now(self, seconds_later):
-        # Read out the current hours, minutes, and seconds time
-        try:
-            hourRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x35)
-            minRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x36)
-            secRaw = self._bus.read_byte_data(PiSugar3_Addr, 0x37)
-        except:
+        hourRaw = self._register(REG_RTC_HOUR)
+        minRaw = self._register(REG_RTC_MINUTE)
+        secRaw = self._register(REG_RTC_SECOND)
+        if None in (hourRaw, minRaw, secRaw):
             return False
         hour = hexAsDec(hourRaw)
         min = hexAsDec(minRaw)
         sec = hexAsDec(secRaw)
-        current_total_seconds = (((hour*60) + min) * 60) + sec
+        elapsed = int(round(monotonic() - self._snapshot_time))
+        current_total_seconds = (((hour*60) + min) * 60) + sec + elapsed
         target_total_seconds = (current_total_seconds + seconds_later) % (60 * 60 * 24) # Confine to 24 hours
         newHour = int(target_total_seconds / (60*60))
         newMin = int(target_total_seconds / 60) - (newHour*60)
@@ -144,11 +223,7 @@ class PiSugarBattery:
 
 
     def charging_status(self):
-        # Try to read the bus, if it fails, return None.
-        try:
-            stat02 = self._bus.read_byte_data(PiSugar3_Addr, 0x02)
-        except:
-            return None
+        stat02 = self._register(REG_STATUS)
         if stat02 == None:
             return None
         if stat02 & 0x80:
@@ -156,6 +231,8 @@ class PiSugarBattery:
         return False
 
 
+    # Averages the readings taken so far.  Every reading in a wake comes from the
+    # same snapshot; call snapshot() first to take a fresh one.
     def refine_capacity(self):
         if len(self.battery_readings) >= self.sample_size:
             self.battery_readings.pop(0)
@@ -25,11 +25,47 @@
 #
 # Copyright (c) 2025 Garrett Birkel
 
-import argparse, os, re, sys, logging
+import argparse, os, re, sys, shutil, tempfile, logging
+import hashlib
+from time import monotonic
 from common_utils import *
 from image_database import *
 
 
+# Files are hashed in pieces this big, so a large file is never all in memory at once
+CONTENT_HASH_CHUNK_BYTES = 1024 * 1024
+
+
+# Return True if a directory entry looks like an image we can display
+def is_image_entry(entry):
+    if entry.name.startswith( '.' ):
+        return False
+    lowered = entry.name.lower()
+    if not (lowered.endswith( '.png' ) or lowered.endswith( '.bmp' )):
+        return False
+    return entry.is_file()
+
+
+def file_content_hash(path):
+    """ hash the contents of a file, reading it in pieces
+    :param path: path to the file
+    :return: hex digest, or None if the file could not be read
+    """
+    h = hashlib.blake2b(digest_size=16)
+    buffer = bytearray(CONTENT_HASH_CHUNK_BYTES)
+    view = memoryview(buffer)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                h.update(view[:n])
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
 def png_inventory(verbose=False, library_path=None, database_file=None):
 
     conn = None
@@ -42,71 +78,266 @@ def png_inventory(verbose=False, library_path=None, database_file=None):
     if not conn:
         logger.error("Database could not be opened")
         os._exit(os.EX_IOERR)
-    create_tables_if_missing(connect_to_local_db)
+    create_tables_if_missing(conn)
     cur = conn.cursor()
 
+    start = monotonic()
+    counts = inventory_library(cur, library_path, verbose)
+
+    logger.info("%s images total, %s new, %s changed, %s moved, %s removed as of this scan (%.2f seconds)." % (
+        counts['total'], counts['new'], counts['changed'], counts['moved'], counts['removed'], monotonic() - start))
+
+    # Hash new and changed images, for finding near-duplicates.
+    # Imported here since it needs PIL and NumPy.
+    from perceptual_hash import update_perceptual_hashes
+    update_perceptual_hashes(cur, library_path, recluster=counts['removed'] > 0, verbose=verbose)
+
+    finish_with_database(conn, cur)
+
+
+def inventory_library(cur, library_path, verbose=False):
+    """ scan the library and bring the images table up to date in one pass.
+    Existing file details are loaded with a single query, each file is stat'ed once,
+    and only rows that actually changed are written, in bulk.  Everything happens in
+    the caller's transaction.
+    Files are only read to hash their contents when they're new or their size or
+    modification time has changed.  A new file with the same contents as one that has
+    disappeared is taken to be that file, moved or renamed, and keeps its row and history.
+    :param cur: database cursor
+    :param library_path: path to the library, containing one folder per group
+    :return: dictionary of counts: total, new, changed, moved, removed
+    """
+    logger = logging.getLogger("epaper_frame")
+
     groups = get_image_group_dictionaries(cur)
     group_dirs = []
+    with os.scandir( library_path ) as it:
+        for entry in it:
+            if entry.is_dir() and not entry.name.startswith( '.' ):
+                group_dirs.append(entry.name)
+    added_group = False
+    for dirname in group_dirs:
+        if dirname not in groups['name_to_id']:
+            get_or_insert_image_group(cur, dirname)
+            added_group = True
+    if added_group:
+        groups = get_image_group_dictionaries(cur)
+
+    known = get_image_file_map(cur)
+    seen = set()
+    new_images = []
+    changed_images = []
+    # Unchanged images that don't have a content hash yet, from before they were kept
+    unhashed_images = []
+
+    for group_name in group_dirs:
+        group_id = groups['name_to_id'][group_name]
+        if verbose:
+            logger.info('Group: %s (%s)' % (group_name, group_id))
+        with os.scandir( os.path.join( library_path, group_name ) ) as it:
+            for entry in it:
+                if not is_image_entry(entry):
+                    continue
+                st = entry.stat()
+                key = (group_id, entry.name)
+                seen.add(key)
+                existing = known.get(key)
+                if existing is None:
+                    new_images.append({
+                        'group_id': group_id,
+                        'filename': entry.name,
+                        'size': st.st_size,
+                        'file_modified_time': st.st_mtime,
+                        'content_hash': file_content_hash(entry.path)
+                    })
+                elif existing[1] != st.st_size or existing[2] != st.st_mtime or existing[3]:
+                    changed_images.append({
+                        'id': existing[0],
+                        'size': st.st_size,
+                        'file_modified_time': st.st_mtime,
+                        'content_hash': file_content_hash(entry.path)
+                    })
+                elif existing[4] is None:
+                    unhashed_images.append((existing[0], file_content_hash(entry.path)))
+
+    # Rows that a moved or renamed file could belong to: every image whose file wasn't found,
+    # whether it disappeared in this scan or earlier, grouped by contents.
+    missing_by_hash = {}
+    for key, existing in known.items():
+        if key not in seen and existing[4] is not None:
+            missing_by_hash.setdefault(existing[4], []).append((key[1], existing[0], existing[3]))
+
+    moved_images = []
+    moved_ids = set()
+    added_images = []
+    for image in new_images:
+        candidates = missing_by_hash.get(image['content_hash'])
+        if not candidates:
+            added_images.append(image)
+            continue
+        # Prefer a row whose file disappeared in this scan, then one with the same filename,
+        # so a moved file isn't mixed up with an identical copy that went away earlier
+        match = min(candidates, key=lambda c: (c[2], c[0] != image['filename'], c[1]))
+        candidates.remove(match)
+        image['id'] = match[1]
+        moved_images.append(image)
+        moved_ids.add(match[1])
+
+    removed_ids = [v[0] for k, v in known.items() if k not in seen and not v[3] and v[0] not in moved_ids]
+
+    if verbose:
+        for image in added_images:
+            logger.debug('Adding new image %s/%s' % (groups['id_to_name'][image['group_id']], image['filename']))
+        for image in moved_images:
+            logger.debug('Image %s was moved to %s/%s' % (image['id'], groups['id_to_name'][image['group_id']], image['filename']))
+    insert_images(cur, added_images)
+    update_image_files(cur, changed_images)
+    move_image_files(cur, moved_images)
+    set_content_hashes(cur, unhashed_images)
+    mark_images_removed(cur, removed_ids)
+
+    return {
+        'total': len(seen),
+        'new': len(added_images),
+        'changed': len(changed_images),
+        'moved': len(moved_images),
+        'removed': len(removed_ids)
+    }
+
+
+def inventory_changed_files(cur, library_path, files):
+    """ bring the images table up to date for just the given files, without scanning
+    the rest of the library.  For when the caller knows exactly what changed, e.g. after a sync.
+    :param cur: database cursor
+    :param library_path: path to the library, containing one folder per group
+    :param files: list of (group name, filename)
+    :return: dictionary of counts: updated, removed
+    """
+    updated = 0
+    removed = 0
+    present = []
+    for group_name, filename in files:
+        path = os.path.join(library_path, group_name, filename)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            mark_image_file_removed(cur, group_name, filename)
+            removed += 1
+            continue
+        present.append((group_name, filename, path, st))
+    # After all the removals, so a file that was moved or renamed can take over its old row
+    for group_name, filename, path, st in present:
+        register_image_file(cur, group_name, filename, st.st_size, st.st_mtime, file_content_hash(path))
+        updated += 1
+    return {
+        'updated': updated,
+        'removed': removed
+    }
+
+
+# The way inventory used to be done, one file and several queries at a time.
+# Kept for comparison in the benchmark.
+def _per_file_inventory(cur, library_path):
+    groups = get_image_group_dictionaries(cur)
     for _, subdirs, _ in os.walk( library_path ):
         for dirname in subdirs:
             if dirname not in groups['name_to_id']:
                 get_or_insert_image_group(cur, dirname)
-
+        break
     groups = get_image_group_dictionaries(cur)
-    new_images = 0
-
     for group_name in groups['name_to_id']:
-        logger.info('Group: %s (%s)' % (group_name, groups['name_to_id'][group_name]))
         path = os.path.join( library_path, group_name )
         for _, _, filenames in os.walk( path ):
             for filename in filenames:
-                lowered = filename.lower()
-                if lowered.endswith( '.png' ) or lowered.endswith( '.bmp' ):
-                    if not filename.startswith( '.' ):
-                        file_pathname = os.path.join( path, filename )
-                        file_modified_time = os.path.getmtime(file_pathname)
-                        file_size = os.path.getsize(file_pathname)
-                        one_record = {
-                            'id': None,
-                            'group_id': groups['name_to_id'][group_name],
-                            'group_name': group_name,
-                            'filename': filename,
-                            'size': file_size,
-                            'file_modified_time': file_modified_time,
-                            'last_display': None,
-                            'display_count': 0,
-                            'creation_time': None,
-                            'removed': False
-                        }
-                        inserted = insert_or_update_image(cur, one_record)
-                        if inserted:
-                            new_images += 1
-
-    images = get_all_images(cur)
-
-    logger.info("%s images total, %s new as of this scan." % (len(images), new_images))
+                file_pathname = os.path.join( path, filename )
+                one_record = {
+                    'id': None,
+                    'group_id': groups['name_to_id'][group_name],
+                    'group_name': group_name,
+                    'filename': filename,
+                    'size': os.path.getsize(file_pathname),
+                    'file_modified_time': os.path.getmtime(file_pathname),
+                    'last_display': None,
+                    'display_count': 0,
+                    'creation_time': None,
+                    'removed': False
+                }
+                insert_or_update_image(cur, one_record)
 
-    finish_with_database(conn, cur)
 
+def benchmark_inventory(file_counts):
+    """ time the per-file and bulk inventory on synthetic libraries of tiny stand-in PNG files """
+    logger = logging.getLogger("epaper_frame")
+    # The per-file path logs every image, which would swamp the timings
+    logger.setLevel("INFO")
+
+    for file_count in file_counts:
+        work_dir = tempfile.mkdtemp(prefix='inventory_bench_')
+        try:
+            library_path = os.path.join(work_dir, 'library')
+            group_count = max(1, file_count // 500)
+            for g in range(group_count):
+                os.makedirs(os.path.join(library_path, 'group%04d' % g))
+            for i in range(file_count):
+                with open(os.path.join(library_path, 'group%04d' % (i % group_count), 'image%06d.png' % i), 'w') as f:
+                    f.write(str(i))
 
-if __name__ == "__main__":
-    config = read_config()
-    if config is None:
-        logger.error('Error reading your config.xml file!')
-        sys.exit(2)
+            def timed(label, database_name, fn):
+                conn = connect_to_local_db(os.path.join(work_dir, database_name))
+                create_tables_if_missing(conn)
+                cur = conn.cursor()
+                start = monotonic()
+                fn(cur)
+                conn.commit()
+                elapsed = monotonic() - start
+                conn.close()
+                logger.info("%7i files, %-28s %8.2f seconds" % (file_count, label, elapsed))
 
+            timed('per-file, first scan', 'per_file.db', lambda cur: _per_file_inventory(cur, library_path))
+            timed('per-file, rescan', 'per_file.db', lambda cur: _per_file_inventory(cur, library_path))
+            timed('bulk, first scan', 'bulk.db', lambda cur: inventory_library(cur, library_path))
+            timed('bulk, rescan', 'bulk.db', lambda cur: inventory_library(cur, library_path))
+
+            # Touch one percent of the files and delete another percent
+            for i in range(0, file_count - 1, 100):
+                os.utime(os.path.join(library_path, 'group%04d' % (i % group_count), 'image%06d.png' % i), (1, 1))
+                os.remove(os.path.join(library_path, 'group%04d' % ((i + 1) % group_count), 'image%06d.png' % (i + 1)))
+            timed('bulk, rescan 2% changed', 'bulk.db', lambda cur: inventory_library(cur, library_path))
+
+            # Move another percent of the files to a new group, under new names
+            os.makedirs(os.path.join(library_path, 'moved'))
+            for i in range(2, file_count, 100):
+                os.rename(os.path.join(library_path, 'group%04d' % (i % group_count), 'image%06d.png' % i),
+                          os.path.join(library_path, 'moved', 'renamed%06d.png' % i))
+            timed('bulk, rescan 1% moved', 'bulk.db', lambda cur: inventory_library(cur, library_path))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
     args = argparse.ArgumentParser(description="Make an inventory of PNG files in the image library")
     args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
                       help="reduce log output")
-    args.add_argument('--path', type=str, default=config['library'], dest='library_path',
+    args.add_argument('--path', type=str, default=None, dest='library_path',
                       help='Path to library', required=False)
+    args.add_argument('--benchmark', type=int, nargs='+', default=None, metavar='COUNT',
+                      help='Time inventory on synthetic libraries of the given sizes instead', required=False)
     args = args.parse_args()
 
-    set_up_logger()
+    logger = set_up_logger()
+
+    if args.benchmark:
+        benchmark_inventory(args.benchmark)
+        sys.exit()
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
 
     database_file = os.path.join(config['installpath'], 'images.db')
     png_inventory(
         verbose=args.verbose,
-        library_path=args.library_path,
+        library_path=args.library_path or config['library'],
         database_file=database_file
-    )
\ No newline at end of file
+    )
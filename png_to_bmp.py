@@ -42,8 +42,9 @@ def png_to_bmp(verbose=False, input_file=None, output_file=None):
 
     # Reduce the number of colors to 6
     # The image should already be prepared with the required 6 color palette,
-    # but this forces it for compression purposes.
-    img = img.quantize(colors=6, method=Image.FASTOCTREE)
+    # in which case it's left alone.  Otherwise this forces it for compression purposes.
+    if not (img.mode == 'P' and img.getcolors(6) is not None):
+        img = img.quantize(colors=6, method=Image.FASTOCTREE)
     
     # Save the image as BMP
     img.save(output_file, format='BMP')
@@ -25,24 +25,135 @@
 #
 # Copyright (c) 2025 Garrett Birkel
 
-import argparse, os, re, sys, logging
+import argparse, os, re, sys, time, json, logging
+import math
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 from common_utils import *
+from dither import dither_image, parse_palette, KERNELS, DEFAULT_KERNEL, MATCH_METHODS, DEFAULT_MATCH
 
 
-def prepare_image(verbose=False, input_file=None, output_file=None):
+# File types batch mode will try to prepare
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
 
-    TARGET_X = 1600
-    TARGET_Y = 1200
+# Batch mode records finished work here, in the library folder, so an interrupted run can resume
+MANIFEST_NAME = '.prepare_manifest.jsonl'
+
+TARGET_X = 1600
+TARGET_Y = 1200
+
+# The output is resampled this many rows at a time, so only a strip of the
+# source is ever converted to RGB at once.
+BAND_ROWS = 100
+
+# Sources more than this many times the target size are first shrunk by whole-pixel
+# averaging, then resampled with LANCZOS.  Same as Pillow's reducing_gap; at 3 the
+# result is hard to tell from a full LANCZOS resample.
+REDUCING_GAP = 3.0
+
+# LANCZOS looks this many pixels either side, at the output scale
+LANCZOS_SUPPORT = 3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a child process by the benchmark, so each load gets its own peak RSS
+LOAD_RUNNER = """
+import sys, time
+sys.path.insert(0, %(here)r)
+import prepare_image
+from PIL import Image
+start = time.monotonic()
+if %(method)r == 'banded':
+    prepare_image.load_for_target(%(input_file)r)
+elif %(method)r == 'full size':
+    prepare_image._full_size_load(%(input_file)r)
+else:
+    Image.open(%(input_file)r)
+print(time.monotonic() - start)
+"""
+
+
+def target_crop_box(width, height):
+    """ work out the centered part of an image with the target's aspect ratio
+    :return: (left, top, right, bottom) in source pixels, possibly fractional
+    """
     target_ratio = TARGET_X / TARGET_Y
+    if width / height < target_ratio:
+        crop_height = width / target_ratio
+        top = (height - crop_height) / 2
+        return (0, top, width, top + crop_height)
+    crop_width = height * target_ratio
+    left = (width - crop_width) / 2
+    return (left, 0, left + crop_width, height)
+
 
+def load_for_target(input_file):
+    """ open an image and scale and crop it to the target size, without ever holding
+    a full-size RGB copy.  JPEGs are decoded at a reduced scale where that still leaves
+    enough pixels, and the rest of the work is done in bands of output rows.
+    :param input_file: path or file object of the source image
+    :return: (RGB image of TARGET_X by TARGET_Y, original source size)
+    """
     logger = logging.getLogger("epaper_frame")
 
-    # Open the input image
-    img = Image.open(input_file).convert("RGB")
+    img = Image.open(input_file)
+    source_size = img.size
+    box = target_crop_box(img.width, img.height)
+
+    # Let the decoder do the first part of the shrinking.  Only JPEG does anything with
+    # this: it can decode at 1/2, 1/4, or 1/8 scale, and picks the smallest that's still
+    # at least the requested size.
+    scale = max(TARGET_X / (box[2] - box[0]), TARGET_Y / (box[3] - box[1]))
+    if scale < 1:
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        if img.size != source_size:
+            x_scale = img.width / source_size[0]
+            y_scale = img.height / source_size[1]
+            box = (box[0] * x_scale, box[1] * y_scale, box[2] * x_scale, box[3] * y_scale)
+            logger.debug("Decoded at reduced size %i x %i." % (img.width, img.height))
+
+    x_step = (box[2] - box[0]) / TARGET_X
+    y_step = (box[3] - box[1]) / TARGET_Y
+    reduce_factor = max(1, int(min(x_step, y_step) / REDUCING_GAP))
+    # Source pixels either side of a band that the filter can reach
+    x_margin = LANCZOS_SUPPORT * max(x_step, 1) + reduce_factor
+    y_margin = LANCZOS_SUPPORT * max(y_step, 1) + reduce_factor
 
+    def aligned_down(v):
+        return max(0, int(v) // reduce_factor * reduce_factor)
+
+    left = aligned_down(box[0] - x_margin)
+    right = min(img.width, math.ceil(box[2] + x_margin))
+
+    result = Image.new('RGB', (TARGET_X, TARGET_Y))
+    for out_top in range(0, TARGET_Y, BAND_ROWS):
+        out_rows = min(BAND_ROWS, TARGET_Y - out_top)
+        band_top = box[1] + out_top * y_step
+        band_bottom = band_top + out_rows * y_step
+        top = aligned_down(band_top - y_margin)
+        bottom = min(img.height, math.ceil(band_bottom + y_margin))
+        band = img.crop((left, top, right, bottom))
+        if band.mode != 'RGB':
+            band = band.convert('RGB')
+        if reduce_factor > 1:
+            band = band.reduce(reduce_factor)
+        band_box = (
+            (box[0] - left) / reduce_factor, (band_top - top) / reduce_factor,
+            (box[2] - left) / reduce_factor, (band_bottom - top) / reduce_factor)
+        result.paste(band.resize((TARGET_X, out_rows), Image.LANCZOS, box=band_box), (0, out_top))
+    return (result, source_size)
+
+
+# The way images used to be scaled, converting the whole source to RGB first.
+# Kept for comparison in the benchmark.
+def _full_size_load(input_file):
+    logger = logging.getLogger("epaper_frame")
+    target_ratio = TARGET_X / TARGET_Y
+
+    img = Image.open(input_file).convert("RGB")
+    source_size = img.size
     ratio = img.width / img.height
-    logger.info("Input image size: %i x %i, ratio %.2f.  Target ratio is %.2f." % (img.width, img.height, ratio, target_ratio))
 
     if ratio < target_ratio:
         img = img.resize((TARGET_X, int(TARGET_X / ratio)), Image.LANCZOS)
@@ -62,37 +173,245 @@ def prepare_image(verbose=False, input_file=None, output_file=None):
         img = img.crop((left_crop, 0, left_crop + TARGET_X, img.height))
         logger.debug("Cropped image to %i x %i." % (img.width, img.height))
 
-    # Define a 6-color palette (black, white, red, green, blue, yellow)
-    flat_palette = [0,0,0, 255,255,255, 255,0,0, 0,255,0, 0,0,255, 255,255,0]
+    return (img, source_size)
 
-    palette_img = Image.new("P", (1, 1))
-    palette_img.putpalette(flat_palette, rawmode='RGB')
 
-    logger.debug("Dithering to fixed 6-color palette")
-    # Convert image to use the palette with Floyd–Steinberg dithering
-    dithered = img.quantize(
-        palette=palette_img,
-        dither=Image.FLOYDSTEINBERG
-    )
+def prepare_image(verbose=False, input_file=None, output_file=None, palette=None, kernel=DEFAULT_KERNEL, match=DEFAULT_MATCH):
+
+    logger = logging.getLogger("epaper_frame")
+
+    img, source_size = load_for_target(input_file)
+    logger.info("Input image size: %i x %i, ratio %.2f.  Target ratio is %.2f." % (
+        source_size[0], source_size[1], source_size[0] / source_size[1], TARGET_X / TARGET_Y))
+
+    logger.debug("Dithering to fixed 6-color palette (%s)" % (kernel))
+    # Convert image to use the panel's palette with error diffusion dithering.
+    # The default settings go straight to PIL's Floyd–Steinberg quantize.
+    dithered = dither_image(img, palette=palette, kernel=kernel, match=match)
     # Save the image as PNG
     logger.debug("Saving prepared image")
     dithered.save(output_file, format='PNG')
 
 
+def benchmark_load(input_files):
+    """ compare the time and peak memory of scaling images to the target size the old
+    way, converting the whole source first, and the banded way.  Each load runs in its
+    own process.  Peak RSS is given above that of a process that only opens the file.
+    """
+    logger = logging.getLogger("epaper_frame")
+
+    def measure(method, input_file):
+        process = subprocess.Popen([sys.executable, '-c', LOAD_RUNNER % {
+            'here': HERE, 'method': method, 'input_file': input_file}], stdout=subprocess.PIPE)
+        output = process.stdout.read()
+        # wait4 gives the resource usage of this one child
+        _, status, usage = os.wait4(process.pid, 0)
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise RuntimeError("Loading %s the %s way failed" % (input_file, method))
+        return (float(output), usage.ru_maxrss / 1024)
+
+    for input_file in input_files:
+        with Image.open(input_file) as img:
+            logger.info("%s: %i x %i %s" % (os.path.basename(input_file), img.width, img.height, img.format))
+        _, base_rss = measure('none', input_file)
+        for method in ('full size', 'banded'):
+            seconds, rss = measure(method, input_file)
+            logger.info("  %-10s %6.2f seconds, %7.1f MB peak RSS" % (method, seconds, rss - base_rss))
+
+
+def find_batch_jobs(source_path, library_path):
+    """ walk a source tree and work out where each image goes in the library.
+    Each top-level subdirectory of the source becomes a group.  Images in deeper
+    subdirectories are flattened into their group, with the folder names joined
+    onto the filename.  Images directly in the source folder go into a group
+    named after the source folder itself.  If two images would end up with the
+    same name in the library (say x.jpg and x.png), only the first is used.
+    :return: list of (source relative path, source pathname, output pathname)
+    """
+    logger = logging.getLogger("epaper_frame")
+
+    source_path = os.path.abspath(source_path)
+    root_group = os.path.basename(source_path.rstrip(os.sep))
+    jobs = []
+    # Output pathname -> the source that claimed it
+    outputs = {}
+    for dirpath, dirnames, filenames in os.walk(source_path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.') or not filename.lower().endswith(SOURCE_EXTENSIONS):
+                continue
+            source_file = os.path.join(dirpath, filename)
+            relative = os.path.relpath(source_file, source_path)
+            parts = relative.split(os.sep)
+            if len(parts) == 1:
+                group = root_group
+            else:
+                group = parts[0]
+                parts = parts[1:]
+            output_name = os.path.splitext('_'.join(parts))[0] + '.png'
+            output_file = os.path.join(library_path, group, output_name)
+            # Compared without case, for libraries on case-insensitive filesystems
+            key = os.path.normcase(output_file).lower()
+            if key in outputs:
+                logger.warning("Skipping %s, since it would be prepared into the same file as %s (%s)." % (
+                    relative, outputs[key], os.path.join(group, output_name)))
+                continue
+            outputs[key] = relative
+            jobs.append((relative, source_file, output_file))
+    return jobs
+
+
+def _set_up_batch_worker(verbose):
+    logger = logging.getLogger("epaper_frame")
+    logger.setLevel("DEBUG" if verbose else "WARNING")
+
+
+def _prepare_one(job):
+    relative, source_file, output_file, palette, kernel, match = job
+    start = time.monotonic()
+    temp_file = output_file + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        prepare_image(input_file=source_file, output_file=temp_file, palette=palette, kernel=kernel, match=match)
+        os.replace(temp_file, output_file)
+    except Exception as e:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return (relative, False, str(e), time.monotonic() - start)
+    return (relative, True, None, time.monotonic() - start)
+
+
+def prepare_directory(verbose=False, source_path=None, library_path=None, palette=None, kernel=DEFAULT_KERNEL, workers=None, match=DEFAULT_MATCH):
+    """ prepare every image in a source tree, mirroring it into the library layout
+    that png_inventory expects (one group per subdirectory).  Images whose output is
+    already newer than the source, or that the manifest says were done, are skipped.
+    :param workers: number of processes, defaulting to one per CPU core
+    """
+    logger = logging.getLogger("epaper_frame")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    manifest_file = os.path.join(library_path, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Probably a half-written last line from an interrupted run
+                    continue
+                manifest[entry['source']] = entry
+
+    pending = []
+    skipped = 0
+    for relative, source_file, output_file in find_batch_jobs(source_path, library_path):
+        source_stat = os.stat(source_file)
+        try:
+            output_mtime = os.stat(output_file).st_mtime
+        except FileNotFoundError:
+            output_mtime = None
+        entry = manifest.get(relative)
+        if output_mtime is not None:
+            if output_mtime >= source_stat.st_mtime:
+                skipped += 1
+                continue
+            if entry is not None and entry['mtime'] == source_stat.st_mtime and entry['size'] == source_stat.st_size:
+                skipped += 1
+                continue
+        pending.append((relative, source_file, output_file, palette, kernel, match))
+
+    logger.info("%s images to prepare, %s already up to date.  Using %s workers." % (len(pending), skipped, workers))
+    if len(pending) == 0:
+        return
+
+    os.makedirs(library_path, exist_ok=True)
+    done = 0
+    failed = 0
+    start = time.monotonic()
+    with open(manifest_file, 'a') as manifest_out:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_set_up_batch_worker, initargs=(verbose,)) as executor:
+            futures = [executor.submit(_prepare_one, job) for job in pending]
+            for future in as_completed(futures):
+                relative, ok, error, elapsed = future.result()
+                if not ok:
+                    failed += 1
+                    logger.error("Failed to prepare %s: %s" % (relative, error))
+                    continue
+                done += 1
+                source_stat = os.stat(os.path.join(source_path, relative))
+                manifest_out.write(json.dumps({
+                    'source': relative,
+                    'mtime': source_stat.st_mtime,
+                    'size': source_stat.st_size
+                }) + '\n')
+                manifest_out.flush()
+                if verbose:
+                    logger.info("Prepared %s in %.1f seconds (%s of %s)." % (relative, elapsed, done, len(pending)))
+
+    elapsed = time.monotonic() - start
+    logger.info("Prepared %s images in %.1f seconds, %.2f images per second.  %s failed." % (done, elapsed, done / elapsed if elapsed > 0 else 0, failed))
+
+
 if __name__ == "__main__":
     args = argparse.ArgumentParser(description="Prepare a PNG version of an image suitable for display")
     args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
                       help="reduce log output")
-    args.add_argument('--in', type=argparse.FileType('rb'), default=sys.stdin, dest='input_file',
-                      help='Input image file', required=True)
-    args.add_argument('--out', type=argparse.FileType('wb'), default=sys.stdout, dest='output_file',
-                      help='Output PNG file', required=True)
+    args.add_argument('--in', type=argparse.FileType('rb'), default=None, dest='input_file',
+                      help='Input image file', required=False)
+    args.add_argument('--out', type=argparse.FileType('wb'), default=None, dest='output_file',
+                      help='Output PNG file', required=False)
+    args.add_argument('--source', type=str, default=None, dest='source_path',
+                      help='Prepare every image under this folder, one group per subfolder', required=False)
+    args.add_argument('--library', type=str, default=None, dest='library_path',
+                      help='Library folder to write into with --source (defaults to the one in config.xml)', required=False)
+    args.add_argument('--kernel', choices=sorted(KERNELS), default=DEFAULT_KERNEL,
+                      help='Error diffusion kernel')
+    args.add_argument('--match', choices=MATCH_METHODS, default=DEFAULT_MATCH,
+                      help='How nearest colors are found: plain RGB distance, or CIELAB, which is closer to how different colors look')
+    args.add_argument('--palette', type=parse_palette, default=None,
+                      help='Colors the panel really shows, as "r,g,b r,g,b ..." in the order black, white, red, green, blue, yellow')
+    args.add_argument('--workers', type=int, default=None,
+                      help='With --source, the number of images prepared at once (defaults to one per core)')
+    args.add_argument('--benchmark', type=str, nargs='+', default=None, metavar='FILE',
+                      help='Compare the time and memory of scaling the given images the old way and the banded way', required=False)
     args = args.parse_args()
 
-    set_up_logger()
+    logger = set_up_logger()
+
+    if args.benchmark:
+        benchmark_load(args.benchmark)
+        sys.exit()
+
+    if args.source_path is not None:
+        library_path = args.library_path
+        if library_path is None:
+            config = read_config()
+            if config is None:
+                logger.error('Error reading your config.xml file!')
+                sys.exit(2)
+            library_path = config['library']
+        prepare_directory(
+            verbose=args.verbose,
+            source_path=args.source_path,
+            library_path=library_path,
+            palette=args.palette,
+            kernel=args.kernel,
+            workers=args.workers,
+            match=args.match
+        )
+        sys.exit()
+
+    if args.input_file is None or args.output_file is None:
+        logger.error('Either --in and --out, or --source, are required.')
+        sys.exit(2)
 
     prepare_image(
         verbose=args.verbose,
         input_file=args.input_file,
-        output_file=args.output_file
+        output_file=args.output_file,
+        palette=args.palette,
+        kernel=args.kernel,
+        match=args.match
     )
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# render_cache.py - a size-bounded on-disk cache of packed display buffers,
+# so a wake on battery can send a library image to the panel without decoding it.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, sys, logging
+from time import monotonic
+from common_utils import *
+from image_database import *
+
+
+# Size of one packed 1600x1200 frame at 2 pixels per byte.
+# (Same as panel_frame.FRAME_BYTES, repeated here so a cache hit doesn't need numpy.)
+FRAME_BYTES = 960000
+
+# Default upper bound on the cache, used when config.xml doesn't set <rendercachesize>.
+DEFAULT_CACHE_MEGABYTES = 256
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class RenderCache:
+    """ Cache entries are files named for the image id plus the size and modification
+    time recorded in the images table, so an edited image never matches a stale frame.
+
+    When the cache is over its budget, the most recently used entries are evicted first.
+    Every image is shown once before any is shown again, so the frame we just displayed
+    is the one we'll need again furthest in the future.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+
+    @classmethod
+    def from_config(cls, config):
+        cache_dir = os.path.join(config['installpath'], 'render_cache')
+        megabytes = int(config.get('rendercachesize', DEFAULT_CACHE_MEGABYTES))
+        return cls(cache_dir, megabytes * 1024 * 1024)
+
+
+    def entry_name(self, image):
+        return "%d-%d-%d.frame" % (image.id, int(image.size), int(image.file_modified_time * 1000))
+
+
+    def lookup(self, image):
+        """ find the cached frame for an image
+        :param image: ImageRow, or anything with id, size, and file_modified_time
+        :return: path to the frame file, or None on a miss
+        """
+        path = os.path.join(self.cache_dir, self.entry_name(image))
+        try:
+            if os.stat(path).st_size != FRAME_BYTES:
+                return None
+            # Record the use, for the eviction policy
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+
+    def load(self, image):
+        """ read the cached frame for an image
+        :param image: ImageRow, or anything with id, size, and file_modified_time
+        :return: the frame, or None on a miss
+        """
+        path = self.lookup(image)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                frame = f.read()
+        except OSError:
+            return None
+        return frame if len(frame) == FRAME_BYTES else None
+
+
+    def store(self, image, frame):
+        """ add a frame to the cache, replacing any stale frame for the same image
+        :param image: ImageRow, or anything with id, size, and file_modified_time
+        :param frame: packed display buffer
+        :return: path to the frame file, or None if it could not be written
+        """
+        name = self.entry_name(image)
+        path = os.path.join(self.cache_dir, name)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            prefix = "%d-" % image.id
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.startswith(prefix) and entry.name != name:
+                    logger.debug('Removing stale cached frame %s' % (entry.name))
+                    os.remove(entry.path)
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(frame)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.error('Could not write cached frame: %s' % (e))
+            return None
+        self.evict(keep=name)
+        return path
+
+
+    def has_room(self):
+        """ True if one more frame fits in the budget without evicting anything """
+        return sum(e[1] for e in self.entries()) + FRAME_BYTES <= self.max_bytes
+
+
+    def entries(self):
+        """ list cache entries as (name, size, last use time) """
+        results = []
+        try:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.frame'):
+                    st = entry.stat()
+                    results.append((entry.name, st.st_size, st.st_mtime))
+        except FileNotFoundError:
+            pass
+        return results
+
+
+    def evict(self, keep=None):
+        """ delete entries until the cache fits in its budget
+        :param keep: name of an entry that must survive, e.g. the one just stored
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        # Most recently used first
+        entries.sort(key=lambda e: e[2], reverse=True)
+        for name, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            logger.debug('Evicting cached frame %s' % (name))
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            total -= size
+
+
+def frame_for_image(cache, image, image_path):
+    """ get the cached frame for an image, rendering and caching it first if needed
+    :param cache: RenderCache
+    :param image: ImageRow
+    :param image_path: path to the image file in the library
+    :return: path to the frame file, or None if it could not be written
+    """
+    path = cache.lookup(image)
+    if path is None:
+        from panel_frame import render_frame
+        path = cache.store(image, render_frame(image_path))
+    return path
+
+
+def warm_render_cache(verbose=False, config=None):
+    """ render frames for library images into the cache until its budget is used,
+    in the order they'll be shown.  Meant to be run while charging.
+    """
+    from panel_frame import render_frame
+
+    cache = RenderCache.from_config(config)
+    database_file = os.path.join(config['installpath'], 'images.db')
+    conn = connect_to_local_db(database_file)
+    if not conn:
+        logger.error("Database could not be opened")
+        os._exit(os.EX_IOERR)
+    create_tables_if_missing(conn)
+    cur = conn.cursor()
+    # Warm the frames for the images that are coming up next
+    if count_queued_images(cur) == 0:
+        fill_selection_queue(cur, **selection_options(config))
+    images = get_queued_images(cur, cache.max_bytes // FRAME_BYTES)
+    finish_with_database(conn, cur)
+
+    # Stay under the budget, so warming never evicts its own work.
+    used = sum(e[1] for e in cache.entries())
+    rendered = 0
+    start = monotonic()
+    for image in images:
+        if cache.lookup(image) is not None:
+            continue
+        if used + FRAME_BYTES > cache.max_bytes:
+            break
+        image_path = os.path.join(config['library'], image.group_name, image.filename)
+        try:
+            frame = render_frame(image_path)
+        except OSError as e:
+            logger.error('Could not render %s: %s' % (image_path, e))
+            continue
+        if cache.store(image, frame) is None:
+            break
+        used += FRAME_BYTES
+        rendered += 1
+        if verbose:
+            logger.debug('Cached %s/%s' % (image.group_name, image.filename))
+
+    elapsed = monotonic() - start
+    logger.info("Rendered %s frames in %.1f seconds, cache now %.1f MB." % (rendered, elapsed, used / (1024 * 1024)))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Fill the cache of display-ready frames")
+    args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
+                      help="reduce log output")
+    args = args.parse_args()
+
+    set_up_logger()
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    warm_render_cache(
+        verbose=args.verbose,
+        config=config
+    )
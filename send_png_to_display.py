@@ -28,11 +28,29 @@
 
 import argparse, os, re, sys, logging
 import subprocess
-from png_to_bmp import png_to_bmp
+import tempfile
+import threading
+from time import monotonic
 from common_utils import *
+from display_client import clean_message
 
 
 def send_png_to_display(verbose=False, input_file=None, message=None):
+    start_png_display(verbose, input_file, message).finish()
+
+
+# Convert a PNG and start sending it to the panel, without waiting for the refresh.
+# The converted image is handed to the utility through a pipe, never written to disk.
+def start_png_display(verbose=False, input_file=None, message=None, display=None):
+
+    # PIL and NumPy are slow to import, and the wake path usually doesn't need them
+    from panel_frame import render_frame
+
+    return start_frame_data_display(verbose, render_frame(input_file), message, display)
+
+
+# Start sending a packed display buffer held in memory to the panel, without waiting for the refresh.
+def start_frame_data_display(verbose=False, frame=None, message=None, display=None):
 
     logger = logging.getLogger("epaper_frame")
 
@@ -41,35 +59,138 @@ def send_png_to_display(verbose=False, input_file=None, message=None):
         logger.error('Error reading your config.xml file!')
         sys.exit(2)
 
-    png_to_bmp(
-        verbose=verbose,
-        input_file=input_file,
-        output_file="/var/tmp/to_display.bmp"
-    )
+    return start_display_utility_with_frame(verbose, config, frame, message, display)
+
+
+class DisplayRefresh:
+    """ A running invocation of the display utility.  Most of its time is spent
+    waiting for the panel, so other work can be done until finish() is called.
+    """
+
+    def __init__(self, process, feeder=None):
+        self.process = process
+        # Thread writing a frame to the utility's stdin, if it was given one that way
+        self.feeder = feeder
+
+
+    def done(self):
+        return self.process.poll() is not None
+
+
+    def finish(self):
+        """ wait for the panel to finish refreshing
+        :raises subprocess.CalledProcessError: if the utility failed
+        """
+        if self.feeder is not None:
+            self.feeder.join()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+
+
+def _feed_frame(process, frame):
+    try:
+        process.stdin.write(frame)
+        process.stdin.close()
+    except OSError:
+        # The utility went away early.  Its exit status will say why.
+        pass
+
+
+# Start the display utility with a packed display buffer (see panel_frame.py) sent on stdin.
+# display is an optional DisplayClient.  If given, the frame is sent to that
+# already-running helper instead of starting the utility just for this image.
+# The utility is run directly, not through a shell, so the message needs no quoting.
+def start_display_utility_with_frame(verbose, config, frame, message, display=None):
+
+    logger = logging.getLogger("epaper_frame")
+
+    if display is not None:
+        return display.start_frame(frame, message)
 
     command_path = os.path.join( config['installpath'], "EPD_13in3e_Utility/eps13in3eutility" )
-    display_command = command_path + " /var/tmp/to_display.bmp"
+    display_command = [command_path, '-']
     if message is not None:
-        message = message[0:80]
-        message = re.sub(r'"', "'", message)
-        message = re.sub(r'\n', " ", message)
-        message = re.sub(r'\\', "-", message)
-        display_command += ' "' + message + '"'
-    output = subprocess.check_call(display_command, shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT)
+        display_command.append(clean_message(message))
     if verbose:
-        logger.debug(output)
+        logger.debug("Running %s with a frame on stdin" % (" ".join(display_command)))
+    process = subprocess.Popen(display_command, stdin=subprocess.PIPE, stdout=sys.stdout, stderr=subprocess.STDOUT)
+    # The pipe holds much less than a frame, and the utility only reads it once the module
+    # is initialized, so the writing is done in the background.
+    feeder = threading.Thread(target=_feed_frame, args=(process, frame))
+    feeder.start()
+    return DisplayRefresh(process, feeder)
+
+
+def benchmark_handoff(command_path, input_file, refresh_count, temp_dir='/var/tmp'):
+    """ compare ways of getting a converted image to the display utility: a BMP file,
+    a packed frame file, and a packed frame on stdin.  Meant to be run against the mock
+    build (make mock) with EPD_MOCK_NO_DELAY set, so the timings are all hand-off.
+    :param temp_dir: where the file hand-offs write, e.g. on the SD card
+    """
+    logger = logging.getLogger("epaper_frame")
+    from png_to_bmp import png_to_bmp
+    from panel_frame import render_frame, write_frame
+
+    work_dir = tempfile.mkdtemp(prefix='handoff_bench_', dir=temp_dir)
+    bmp_file = os.path.join(work_dir, 'to_display.bmp')
+    frame_file = os.path.join(work_dir, 'to_display.frame')
+
+    def via_bmp():
+        png_to_bmp(input_file=input_file, output_file=bmp_file)
+        subprocess.check_call([command_path, bmp_file, '50%'], stdout=subprocess.DEVNULL)
+        return os.path.getsize(bmp_file)
+
+    def via_frame_file():
+        write_frame(frame_file, render_frame(input_file))
+        subprocess.check_call([command_path, frame_file, '50%'], stdout=subprocess.DEVNULL)
+        return os.path.getsize(frame_file)
+
+    def via_stdin():
+        process = subprocess.Popen([command_path, '-', '50%'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        feeder = threading.Thread(target=_feed_frame, args=(process, render_frame(input_file)))
+        feeder.start()
+        DisplayRefresh(process, feeder).finish()
+        return 0
+
+    try:
+        for label, fn in [('BMP file', via_bmp), ('packed frame file', via_frame_file), ('packed frame on stdin', via_stdin)]:
+            fn()
+            times = []
+            for _ in range(refresh_count):
+                start = monotonic()
+                written = fn()
+                times.append(monotonic() - start)
+            times.sort()
+            logger.info("%-22s %6.3f seconds median, %8i bytes written per wake" % (label, times[len(times) // 2], written))
+    finally:
+        for path in (bmp_file, frame_file, frame_file + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(work_dir)
 
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser(description="Send a PNG to the Waveshare display")
     args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
                       help="reduce log output")
-    args.add_argument('--in', type=argparse.FileType('rb'), default=sys.stdin, dest='input_file',
+    args.add_argument('--in', type=str, dest='input_file',
                       help='Input PNG file', required=True)
+    args.add_argument('--benchmark', type=int, default=None, metavar='COUNT',
+                      help='Time COUNT hand-offs each way to the display utility instead', required=False)
+    args.add_argument('--utility', type=str, dest='command_path',
+                      default='EPD_13in3e_Utility/eps13in3eutility-mock',
+                      help='Display utility to run for the benchmark, e.g. the mock build')
+    args.add_argument('--temp', type=str, dest='temp_dir', default='/var/tmp',
+                      help='Where the benchmark writes its files')
     args = args.parse_args()
 
     set_up_logger()
 
+    if args.benchmark:
+        benchmark_handoff(args.command_path, args.input_file, args.benchmark, args.temp_dir)
+        sys.exit()
+
     send_png_to_display(
         verbose=args.verbose,
         input_file=args.input_file,
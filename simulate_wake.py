@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# simulate_wake.py - run the whole cycle_image wake path against simulated hardware,
+# over synthetic libraries, and report what each wake costs.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+
+import argparse, os, sys, logging
+import shutil
+import subprocess
+import tempfile
+from time import monotonic
+from common_utils import *
+from image_database import *
+
+
+# The 13.3" Spectra 6 panel takes about this long to refresh
+PANEL_REFRESH_SECONDS = 19.0
+
+# Images per group in the synthetic library
+IMAGES_PER_GROUP = 500
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Stands in for the compiled display utility
+DISPLAY_STUB = """#!/bin/sh
+echo "display $*" >> "%(log)s"
+sleep %(seconds)s
+"""
+
+# Stands in for sudo, so shutdown and iwconfig are only recorded
+SUDO_STUB = """#!/bin/sh
+echo "sudo $*" >> "%(log)s"
+"""
+
+# Makes "import smbus" find the fake PiSugar bus
+SMBUS_STUB = "from fake_smbus import *\n"
+
+# Runs cycle_image, then records this process's I/O counters, which are gone once it exits
+WAKE_RUNNER = """
+import atexit, runpy, sys
+def record_io():
+    try:
+        with open('/proc/self/io') as f:
+            counters = f.read()
+    except OSError:
+        counters = ''
+    with open(%(io_file)r, 'w') as f:
+        f.write(counters)
+atexit.register(record_io)
+sys.argv = ['cycle_image.py', '--quiet']
+runpy.run_path(%(script)r, run_name='__main__')
+"""
+
+CONFIG_XML = """<?xml version="1.0"?>
+<epaper>
+    <installpath>%(installpath)s</installpath>
+    <library>%(library)s</library>
+    <interval>86200</interval>
+</epaper>
+"""
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+def write_executable(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.chmod(path, 0o755)
+
+
+def set_up_simulation(root, refresh_seconds):
+    """ lay out an install folder, stubs, and config.xml under root
+    :return: dictionary of paths
+    """
+    paths = {
+        'root': root,
+        'installpath': os.path.join(root, 'install'),
+        'library': os.path.join(root, 'library'),
+        'bin': os.path.join(root, 'bin'),
+        'modules': os.path.join(root, 'modules'),
+        'commands': os.path.join(root, 'commands.log'),
+        'io': os.path.join(root, 'io.txt'),
+    }
+    for key in ['installpath', 'library', 'bin', 'modules']:
+        os.makedirs(paths[key], exist_ok=True)
+    utility_dir = os.path.join(paths['installpath'], 'EPD_13in3e_Utility')
+    os.makedirs(utility_dir, exist_ok=True)
+    write_executable(os.path.join(utility_dir, 'eps13in3eutility'),
+                     DISPLAY_STUB % {'log': paths['commands'], 'seconds': refresh_seconds})
+    write_executable(os.path.join(paths['bin'], 'sudo'), SUDO_STUB % {'log': paths['commands']})
+    with open(os.path.join(paths['modules'], 'smbus.py'), 'w') as f:
+        f.write(SMBUS_STUB)
+    with open(os.path.join(root, 'config.xml'), 'w') as f:
+        f.write(CONFIG_XML % {'installpath': paths['installpath'] + '/', 'library': paths['library'] + '/'})
+    return paths
+
+
+def make_synthetic_library(library_path, image_count):
+    """ fill a library with image_count copies of one full-size picture, in groups.
+    The copies are hard links where possible, so 100k images take no real space.
+    """
+    from PIL import Image, ImageDraw
+
+    template = os.path.join(library_path, '.template.png')
+    img = Image.new('RGB', (1600, 1200), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for i, color in enumerate([(0, 0, 0), (255, 255, 0), (255, 0, 0), (0, 0, 255), (0, 255, 0)]):
+        draw.rectangle([i * 320, 0, i * 320 + 319, 1199], fill=color)
+    img.save(template)
+
+    for i in range(image_count):
+        group_path = os.path.join(library_path, 'group%04d' % (i // IMAGES_PER_GROUP))
+        if i % IMAGES_PER_GROUP == 0:
+            os.makedirs(group_path, exist_ok=True)
+        path = os.path.join(group_path, 'image%06d.png' % i)
+        try:
+            os.link(template, path)
+        except OSError:
+            shutil.copyfile(template, path)
+    os.remove(template)
+
+
+def read_io_counters(io_file):
+    counters = {}
+    try:
+        with open(io_file) as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def run_wake(paths):
+    """ run one wake of cycle_image in a child process
+    :return: dictionary of wall seconds, cpu seconds, peak RSS in KB, and I/O counters
+    """
+    env = dict(os.environ)
+    env['PATH'] = paths['bin'] + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = os.pathsep.join([paths['modules'], HERE] + [p for p in [env.get('PYTHONPATH')] if p])
+    runner = WAKE_RUNNER % {'io_file': paths['io'], 'script': os.path.join(HERE, 'cycle_image.py')}
+
+    start = monotonic()
+    process = subprocess.Popen([sys.executable, '-c', runner], cwd=paths['root'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this one child
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = monotonic() - start
+    if process.returncode != 0:
+        raise RuntimeError("cycle_image exited with status %s" % (process.returncode))
+
+    io = read_io_counters(paths['io'])
+    return {
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'rss_kb': usage.ru_maxrss,
+        'wchar': io.get('wchar', 0),
+        'write_bytes': io.get('write_bytes', 0),
+        'syscw': io.get('syscw', 0),
+    }
+
+
+def simulate(image_count, wake_count, refresh_seconds, keep=False):
+    """ build a synthetic library of image_count images and run wake_count wakes against it
+    :return: list of per-wake result dictionaries
+    """
+    root = tempfile.mkdtemp(prefix='epaper_sim_')
+    try:
+        paths = set_up_simulation(root, refresh_seconds)
+        make_synthetic_library(paths['library'], image_count)
+        subprocess.check_call([sys.executable, os.path.join(HERE, 'png_inventory.py'), '--path', paths['library']],
+                              cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results = [run_wake(paths) for _ in range(wake_count)]
+
+        with open(paths['commands']) as f:
+            commands = f.read().splitlines()
+        if sum(1 for c in commands if c.startswith('display')) != wake_count:
+            raise RuntimeError("Expected %s panel refreshes, saw:\n%s" % (wake_count, "\n".join(commands)))
+        return results
+    finally:
+        if keep:
+            logger.info("Simulation files kept in %s" % (root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def report(image_count, results):
+    first = results[0]
+    later = results[1:] or results
+    logger.info("%7s images: first wake %.2fs wall, %.2fs CPU, %.1f MB RSS, %.1f KB written" % (
+        image_count, first['wall'], first['cpu'], first['rss_kb'] / 1024, first['wchar'] / 1024))
+    logger.info("%7s         later wakes (median of %s): %.2fs wall, %.2fs CPU, %.1f MB RSS, %.1f KB written (%s write calls, %.1f KB to disk)" % (
+        '', len(later), median([r['wall'] for r in later]), median([r['cpu'] for r in later]),
+        median([r['rss_kb'] for r in later]) / 1024, median([r['wchar'] for r in later]) / 1024,
+        median([r['syscw'] for r in later]), median([r['write_bytes'] for r in later]) / 1024))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Benchmark the wake path against simulated hardware and synthetic libraries")
+    args.add_argument('--images', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                      help='Library sizes to simulate')
+    args.add_argument('--wakes', type=int, default=5,
+                      help='Wakes to run for each library size')
+    args.add_argument('--refresh', type=float, default=0.0, dest='refresh_seconds',
+                      help='Seconds the stub display takes, e.g. %s for the real panel' % (PANEL_REFRESH_SECONDS))
+    args.add_argument('--keep', action='store_true',
+                      help='Keep the simulation folders for a look afterwards')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    for image_count in args.images:
+        report(image_count, simulate(image_count, args.wakes, args.refresh_seconds, args.keep))
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# wake_timeline.py - time each phase of a wake cycle, and report on the timings
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+
+import argparse, os, sys, logging
+import math
+from contextlib import contextmanager
+from time import monotonic
+from common_utils import *
+from image_database import *
+
+
+# Phases recorded by cycle_image, in the order they happen.  Used to lay out the report.
+WAKE_PHASES = [
+    'boot',
+    'interpreter_start',
+    'battery_probe',
+    'rtc_read',
+    'config',
+    'db_open',
+    'selection',
+    'render',
+    'overlay',
+    'panel_start',
+    'cache_store',
+    'db_update',
+    'drain_model',
+    'stage_next',
+    'db_commit',
+    'wifi',
+    'alarm',
+    'panel_wait',
+    'stage_wait',
+]
+
+# A phase is flagged as a regression when its median grows by more than this fraction
+# compared to the wakes before, and by at least REGRESSION_MIN_SECONDS.
+DEFAULT_REGRESSION_THRESHOLD = 0.25
+REGRESSION_MIN_SECONDS = 0.05
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+def process_start_phases():
+    """ work out how long the kernel took to start this process after boot, and how long
+    the interpreter took to get from there to here.  Only meaningful on Linux, and only
+    when the process is started at boot, as it is when waking on battery.
+    :return: list of (phase name, seconds), empty if /proc isn't available
+    """
+    try:
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        with open('/proc/self/stat') as f:
+            # The command name can contain spaces, so count fields from after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        start_time = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return []
+    return [('boot', start_time), ('interpreter_start', max(uptime - start_time, 0.0))]
+
+
+class WakeTimeline:
+    """ Collects (phase name, seconds) pairs using the monotonic clock. """
+
+    def __init__(self):
+        self.phases = []
+
+
+    @contextmanager
+    def phase(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, monotonic() - start))
+
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+
+    def log(self):
+        for name, seconds in self.phases:
+            logger.debug("  %-20s %8.3f s" % (name, seconds))
+
+
+def percentile(values, fraction):
+    """ nearest-rank percentile of a list of numbers """
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize_phases(rows):
+    """ group timings by phase, adding a 'total' per wake.  The total leaves out
+    'boot', which is only meaningful when the script was started at boot.
+    :param rows: list of (history_id, phase, seconds)
+    :return: dictionary of phase name -> list of seconds, oldest wake first
+    """
+    by_phase = {}
+    totals = {}
+    for history_id, phase, seconds in rows:
+        by_phase.setdefault(phase, []).append(seconds)
+        if phase != 'boot':
+            totals[history_id] = totals.get(history_id, 0.0) + seconds
+        else:
+            totals.setdefault(history_id, 0.0)
+    by_phase['total'] = [totals[h] for h in sorted(totals)]
+    return by_phase
+
+
+def wake_report(cur, wake_count, threshold=DEFAULT_REGRESSION_THRESHOLD, on_battery_only=False):
+    """ log p50/p95/max for each phase over the last wake_count wakes, and compare
+    the medians with the wake_count wakes before those.
+    :return: list of phases flagged as regressions
+    """
+    rows = get_recent_wake_phases(cur, wake_count * 2, on_battery_only)
+    history_ids = sorted(set(r[0] for r in rows))
+    if not history_ids:
+        logger.info("No wake timings recorded yet.")
+        return []
+
+    recent_ids = set(history_ids[-wake_count:])
+    recent = summarize_phases([r for r in rows if r[0] in recent_ids])
+    earlier = summarize_phases([r for r in rows if r[0] not in recent_ids])
+
+    known = [p for p in WAKE_PHASES if p in recent]
+    others = sorted(p for p in recent if p not in WAKE_PHASES and p != 'total')
+
+    logger.info("Phase timings over the last %s wakes (compared with %s before):" % (len(recent_ids), len(history_ids) - len(recent_ids)))
+    logger.info("  %-20s %8s %8s %8s %10s" % ('phase', 'p50', 'p95', 'max', 'prev p50'))
+    regressions = []
+    for phase in known + others + ['total']:
+        values = recent[phase]
+        p50 = percentile(values, 0.5)
+        previous = earlier.get(phase)
+        flag = ''
+        previous_text = '-'
+        if previous:
+            previous_p50 = percentile(previous, 0.5)
+            previous_text = "%.3f" % previous_p50
+            if p50 > previous_p50 * (1 + threshold) and p50 - previous_p50 >= REGRESSION_MIN_SECONDS:
+                flag = '  REGRESSION'
+                regressions.append(phase)
+        logger.info("  %-20s %8.3f %8.3f %8.3f %10s%s" % (phase, p50, percentile(values, 0.95), max(values), previous_text, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Report how long each phase of recent wakes took")
+    args.add_argument('--wakes', '-n', type=int, default=50,
+                      help='Number of recent wakes to report on')
+    args.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                      help='Fractional growth in a median that counts as a regression')
+    args.add_argument('--battery', action='store_true', dest='on_battery_only',
+                      help='Only include wakes that happened on battery power')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    database_file = os.path.join(config['installpath'], 'images.db')
+    conn = connect_to_local_db(database_file)
+    if not conn:
+        logger.error("Database could not be opened")
+        os._exit(os.EX_IOERR)
+    create_tables_if_missing(conn)
+    cur = conn.cursor()
+    regressions = wake_report(cur, args.wakes, args.threshold, args.on_battery_only)
+    finish_with_database(conn, cur)
+
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,733 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# web_server.py - a small web server for managing the image library while the frame is charging.
+# Uploads are streamed to disk, prepared in a worker process, and added to the database,
+# all without holding up other requests.
+# Garrett Birkel
+# Version 0.1
+#
+# LICENSE
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2025 Garrett Birkel
+
+import argparse, os, re, sys, json, logging
+import asyncio
+import hmac
+import ipaddress
+import multiprocessing
+import signal
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote
+from common_utils import *
+from image_database import *
+from png_inventory import file_content_hash
+from time import monotonic, sleep
+
+
+# Port to listen on, used when config.xml doesn't set <webport>
+DEFAULT_PORT = 8080
+
+# Address to listen on, used when config.xml doesn't set <webhost>.  Only this
+# machine can reach it, so it must be set to manage the library from elsewhere.
+DEFAULT_HOST = '127.0.0.1'
+
+# Largest upload accepted, used when config.xml doesn't set <uploadlimit> (in megabytes)
+DEFAULT_UPLOAD_MEGABYTES = 64
+
+# Uploads are read and written in pieces this big, so at most this much of one is in memory
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+# Uploads received or waiting to be prepared.  Past this, new uploads are turned away
+# until some are done, rather than filling the card with files nobody is working on.
+UPLOAD_QUEUE_LENGTH = 8
+
+# How many finished upload jobs to remember, for clients asking how they went
+JOB_HISTORY_LENGTH = 100
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Days of daily stats returned by /stats, and the most that can be asked for
+DEFAULT_STATS_DAYS = 30
+MAX_STATS_DAYS = 3660
+
+# Give up on a client that stops sending for this long
+CLIENT_TIMEOUT_SECONDS = 30
+
+# Upload names become file and folder names in the library, so keep them tame
+SAFE_NAME = re.compile(r'^[^./\\\x00][^/\\\x00]*$')
+
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>epaper frame</title></head>
+<body>
+<h1>epaper frame</h1>
+<p>Token: <input id="token" type="password"></p>
+<p>Group: <input id="group" value="uploads"> <input id="files" type="file" multiple>
+<button onclick="upload()">Upload</button></p>
+<pre id="log"></pre>
+<p><a href="/groups">Groups</a> | <a href="/images">Images</a> | <a href="/history">History</a> | <a href="/status">Status</a></p>
+<script>
+async function upload() {
+  const group = encodeURIComponent(document.getElementById('group').value);
+  const headers = {'Authorization': 'Bearer ' + document.getElementById('token').value};
+  const log = document.getElementById('log');
+  for (const file of document.getElementById('files').files) {
+    const r = await fetch('/images/' + group + '/' + encodeURIComponent(file.name), {method: 'PUT', body: file, headers: headers});
+    log.textContent += file.name + ': ' + (await r.text()) + '\\n';
+  }
+}
+</script>
+</body></html>
+"""
+
+
+logger = logging.getLogger("epaper_frame")
+
+
+class RequestError(Exception):
+    """ a request that gets an error response instead of being handled """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def _set_up_upload_worker(verbose):
+    logger = logging.getLogger("epaper_frame")
+    logger.setLevel("DEBUG" if verbose else "WARNING")
+
+
+def prepare_upload(source_file, output_file):
+    """ prepare an uploaded image for the library.  Runs in a worker process.
+    :return: (True if it worked, error message, seconds taken)
+    """
+    # Imported here so the server itself doesn't carry PIL and NumPy around
+    from prepare_image import _prepare_one
+    from dither import DEFAULT_KERNEL, DEFAULT_MATCH
+    _, ok, error, seconds = _prepare_one((os.path.basename(output_file), source_file, output_file, None, DEFAULT_KERNEL, DEFAULT_MATCH))
+    return (ok, error, seconds)
+
+
+def register_upload(cur, group_name, output_file):
+    """ add a prepared upload to the database """
+    st = os.stat(output_file)
+    return register_image_file(cur, group_name, os.path.basename(output_file), st.st_size, st.st_mtime,
+                               file_content_hash(output_file))
+
+
+def is_loopback(host):
+    """ True if an address to listen on can only be reached from this machine """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def image_row_to_dictionary(image):
+    return {
+        'id': image.id,
+        'group': image.group_name,
+        'filename': image.filename,
+        'size': image.size,
+        'file_modified_time': image.file_modified_time,
+        'last_display': image.last_display,
+        'display_count': image.display_count
+    }
+
+
+def history_row_to_dictionary(row):
+    return {
+        'id': row[0],
+        'image_id': row[1],
+        'group': row[2],
+        'filename': row[3],
+        'display_time': row[4],
+        'charging': bool(row[5]),
+        'charge_level': row[6]
+    }
+
+
+class ManagementServer:
+    """ The request loop only ever waits on the network.  Everything that could take a
+    while happens elsewhere: writing upload chunks and database queries go to threads
+    (one thread for the database, since a SQLite connection belongs to the thread that
+    opened it), and preparing images goes to a small pool of worker processes.
+    """
+
+    def __init__(self, config, verbose=False, workers=1, queue_length=UPLOAD_QUEUE_LENGTH):
+        self.verbose = verbose
+        self.library_path = config['library']
+        self.upload_dir = os.path.join(config['installpath'], 'uploads')
+        self.database_file = os.path.join(config['installpath'], 'images.db')
+        self.max_upload_bytes = int(config.get('uploadlimit', DEFAULT_UPLOAD_MEGABYTES)) * 1024 * 1024
+        # Shared secret that uploads must carry, from <webtoken>
+        self.upload_token = config.get('webtoken')
+        self.host = DEFAULT_HOST
+        self.workers = workers
+        self.queue_length = queue_length
+        self.conn = None
+        self.cur = None
+        self.jobs = OrderedDict()
+        self.next_job_id = 1
+        # Uploads being received, waiting, or being prepared
+        self.outstanding = 0
+        self.queue = None
+        self.pool = None
+        self.database_thread = None
+        self.file_thread = None
+
+
+    def _open_database(self):
+        self.conn = connect_to_local_db(self.database_file)
+        if not self.conn:
+            raise RuntimeError("Database could not be opened")
+        create_tables_if_missing(self.conn)
+        self.cur = self.conn.cursor()
+
+
+    def _run_on_database(self, fn, args):
+        try:
+            result = fn(self.cur, *args)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return result
+
+
+    async def database(self, fn, *args):
+        """ run fn(cur, *args) on the database thread and commit """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.database_thread, self._run_on_database, fn, args)
+
+
+    async def serve(self, port, host=DEFAULT_HOST):
+        """ run until cancelled or stopped by a signal """
+        self.host = host
+        if self.upload_token is None and not is_loopback(host):
+            logger.warning("No <webtoken> in config.xml, so uploads are turned away from the network.")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        # Anything left here is from an earlier run that was cut off
+        for entry in os.scandir(self.upload_dir):
+            os.remove(entry.path)
+
+        self.queue = asyncio.Queue()
+        # Worker processes come from a fork server, so they don't inherit open client
+        # connections, which would then never close from the client's point of view
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'),
+                                        initializer=_set_up_upload_worker, initargs=(self.verbose,))
+        self.database_thread = ThreadPoolExecutor(max_workers=1, initializer=self._open_database)
+        self.file_thread = ThreadPoolExecutor(max_workers=1)
+
+        loop = asyncio.get_running_loop()
+        stopping = loop.create_future()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: stopping.done() or stopping.set_result(None))
+
+        workers = [asyncio.create_task(self.prepare_uploads()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        logger.info("Management server listening on %s port %s." % (host, server.sockets[0].getsockname()[1]))
+        try:
+            async with server:
+                await stopping
+        finally:
+            for task in workers:
+                task.cancel()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.file_thread.shutdown()
+            self.database_thread.submit(lambda: self.conn and self.conn.close())
+            self.database_thread.shutdown()
+            logger.info("Management server stopped.")
+
+
+    async def handle_connection(self, reader, writer):
+        """ handle one request, then close the connection """
+        try:
+            try:
+                method, path, query, headers = await asyncio.wait_for(read_request_head(reader), CLIENT_TIMEOUT_SECONDS)
+                status, body, content_type = await self.route(method, path, query, headers, reader, writer)
+            except RequestError as e:
+                status, body, content_type = e.status, json.dumps({'error': str(e)}), 'application/json'
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                status, body, content_type = HTTPStatus.BAD_REQUEST, json.dumps({'error': 'Bad request'}), 'application/json'
+            except Exception as e:
+                logger.error('Error handling request: %s' % (e))
+                status, body, content_type = HTTPStatus.INTERNAL_SERVER_ERROR, json.dumps({'error': str(e)}), 'application/json'
+            await send_response(writer, status, body, content_type)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def route(self, method, path, query, headers, reader, writer):
+        parts = [unquote(p) for p in path.strip('/').split('/')] if path != '/' else []
+
+        if method == 'PUT' and len(parts) == 3 and parts[0] == 'images':
+            return await self.receive_upload(parts[1], parts[2], headers, reader, writer)
+        if method != 'GET':
+            raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, 'Method not allowed')
+
+        if parts == []:
+            return (HTTPStatus.OK, INDEX_PAGE, 'text/html; charset=utf-8')
+        if parts == ['status']:
+            images = await self.database(count_displayable_images)
+            result = {
+                'images': images,
+                'outstanding_uploads': self.outstanding,
+                'waiting_uploads': self.queue.qsize()
+            }
+        elif parts == ['groups']:
+            rows = await self.database(get_image_groups_with_counts)
+            result = {'groups': [{'id': r[0], 'name': r[1], 'images': r[2]} for r in rows]}
+        elif parts == ['images']:
+            limit = page_size(query)
+            group_id = query_int(query, 'group', None)
+            rows = await self.database(get_images_page, query_int(query, 'after', 0), limit, group_id)
+            result = {
+                'images': [image_row_to_dictionary(r) for r in rows],
+                'next': rows[-1].id if len(rows) == limit else None
+            }
+        elif parts == ['history']:
+            limit = page_size(query)
+            rows = await self.database(get_display_history_page, query_int(query, 'before', None), limit)
+            result = {
+                'history': [history_row_to_dictionary(r) for r in rows],
+                'next': rows[-1][0] if len(rows) == limit else None
+            }
+        elif parts == ['stats']:
+            today = calendar.timegm(datetime.now(UTC).utctimetuple()) // 86400
+            days = max(1, min(query_int(query, 'days', DEFAULT_STATS_DAYS), MAX_STATS_DAYS))
+            daily = await self.database(get_daily_rollups, today - days + 1, today)
+            groups = await self.database(get_group_rollups)
+            result = {
+                'days': [daily_rollup_to_dictionary(r) for r in daily],
+                'groups': [{'id': r[0], 'name': r[1], 'displays': r[2], 'first_display': r[3], 'last_display': r[4]} for r in groups]
+            }
+        elif len(parts) == 3 and parts[:2] == ['stats', 'images'] and parts[2].isdigit():
+            rollup = await self.database(get_image_rollup, int(parts[2]))
+            if rollup is None:
+                raise RequestError(HTTPStatus.NOT_FOUND, 'Never displayed')
+            result = dict(zip(('displays', 'first_display', 'last_display', 'average_gap', 'max_gap'), rollup))
+        elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            job = self.jobs.get(int(parts[1]))
+            if job is None:
+                raise RequestError(HTTPStatus.NOT_FOUND, 'No such job')
+            result = job_to_dictionary(job)
+        else:
+            raise RequestError(HTTPStatus.NOT_FOUND, 'Not found')
+        return (HTTPStatus.OK, json.dumps(result), 'application/json')
+
+
+    def check_upload_token(self, headers):
+        """ turn an upload away unless it carries the token from config.xml.
+        Without a token, uploads are only taken when listening on this machine alone.
+        """
+        if self.upload_token is None:
+            if is_loopback(self.host):
+                return
+            raise RequestError(HTTPStatus.FORBIDDEN, 'Uploads need a <webtoken> in config.xml')
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode('utf-8'), self.upload_token.encode('utf-8')):
+            raise RequestError(HTTPStatus.UNAUTHORIZED, 'Uploads need the token from config.xml')
+
+
+    async def receive_upload(self, group_name, filename, headers, reader, writer):
+        """ stream an upload into a file, then queue it for preparing """
+        self.check_upload_token(headers)
+        if not SAFE_NAME.match(group_name) or not SAFE_NAME.match(filename):
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'Bad group or file name')
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in SOURCE_EXTENSIONS:
+            raise RequestError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, 'Not an image type that can be prepared')
+        if 'content-length' not in headers:
+            raise RequestError(HTTPStatus.LENGTH_REQUIRED, 'Content-Length is required')
+        length = int(headers['content-length'])
+        if length <= 0 or length > self.max_upload_bytes:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Uploads are limited to %d bytes' % (self.max_upload_bytes))
+        # Turn an upload away before it's sent, rather than after
+        if self.outstanding >= self.queue_length:
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, 'Too many uploads waiting, try again shortly')
+
+        self.outstanding += 1
+        job = {
+            'id': self.next_job_id,
+            'group': group_name,
+            'filename': filename,
+            'state': 'receiving',
+            'error': None,
+            'image_id': None,
+            'seconds': None,
+            'temp_file': os.path.join(self.upload_dir, '%d%s' % (self.next_job_id, extension)),
+            'output_file': os.path.join(self.library_path, group_name, os.path.splitext(filename)[0] + '.png')
+        }
+        self.next_job_id += 1
+        self.remember_job(job)
+
+        queued = False
+        try:
+            if headers.get('expect', '').lower() == '100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                await writer.drain()
+            await self.stream_to_file(reader, job['temp_file'], length)
+            job['state'] = 'waiting'
+            self.queue.put_nowait(job)
+            queued = True
+        except BaseException:
+            job['state'] = 'failed'
+            job['error'] = 'Upload was cut off'
+            raise
+        finally:
+            if not queued:
+                self.outstanding -= 1
+                remove_quietly(job['temp_file'])
+        return (HTTPStatus.ACCEPTED, json.dumps(job_to_dictionary(job)), 'application/json')
+
+
+    async def stream_to_file(self, reader, path, length):
+        loop = asyncio.get_running_loop()
+        with open(path, 'wb') as f:
+            remaining = length
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(UPLOAD_CHUNK_BYTES, remaining)), CLIENT_TIMEOUT_SECONDS)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                # A write can stall when the card is busy, so it happens off the request loop
+                await loop.run_in_executor(self.file_thread, f.write, chunk)
+                remaining -= len(chunk)
+
+
+    def remember_job(self, job):
+        self.jobs[job['id']] = job
+        while len(self.jobs) > JOB_HISTORY_LENGTH:
+            oldest = next(iter(self.jobs.values()))
+            if oldest['state'] not in ('done', 'failed'):
+                break
+            self.jobs.popitem(last=False)
+
+
+    async def prepare_uploads(self):
+        """ take uploads off the queue one at a time, prepare them in a worker process,
+        and add them to the database
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job['state'] = 'preparing'
+            try:
+                ok, error, seconds = await loop.run_in_executor(self.pool, prepare_upload, job['temp_file'], job['output_file'])
+                job['seconds'] = seconds
+                if not ok:
+                    job['state'] = 'failed'
+                    job['error'] = error
+                    logger.error('Could not prepare %s/%s: %s' % (job['group'], job['filename'], error))
+                else:
+                    job['image_id'] = await self.database(register_upload, job['group'], job['output_file'])
+                    job['state'] = 'done'
+                    logger.info('Added %s/%s as image %s (%.1f seconds)' % (job['group'], job['filename'], job['image_id'], seconds))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job['state'] = 'failed'
+                job['error'] = str(e)
+                logger.error('Could not add %s/%s: %s' % (job['group'], job['filename'], e))
+            finally:
+                remove_quietly(job['temp_file'])
+                self.outstanding -= 1
+
+
+def daily_rollup_to_dictionary(row):
+    return {
+        'date': datetime.fromtimestamp(row[0] * 86400, UTC).strftime('%Y-%m-%d'),
+        'displays': row[1],
+        'on_battery': row[2],
+        'charge_min': row[3],
+        'charge_max': row[4],
+        'charge_average': row[5]
+    }
+
+
+def job_to_dictionary(job):
+    return dict((k, job[k]) for k in ('id', 'group', 'filename', 'state', 'error', 'image_id', 'seconds'))
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def page_size(query):
+    return max(1, min(query_int(query, 'limit', DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+
+def query_int(query, name, default):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return int(values[0])
+    except ValueError:
+        raise RequestError(HTTPStatus.BAD_REQUEST, 'Bad value for %s' % (name))
+
+
+async def read_request_head(reader):
+    """ read an HTTP request line and headers
+    :return: (method, path, query dictionary, headers dictionary with lowercase names)
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        raise asyncio.IncompleteReadError(b'', None)
+    method, target, _ = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= 100:
+            raise ValueError('Too many headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    path, _, query = target.partition('?')
+    return (method.upper(), path, parse_qs(query), headers)
+
+
+async def send_response(writer, status, body, content_type):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    head = "HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (
+        status, HTTPStatus(status).phrase, content_type, len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+def run_server(verbose=False, config=None, port=None, host=None, workers=1):
+    if port is None:
+        port = int(config.get('webport', DEFAULT_PORT))
+    if host is None:
+        host = config.get('webhost', DEFAULT_HOST)
+    server = ManagementServer(config, verbose=verbose, workers=workers)
+    asyncio.run(server.serve(port, host))
+
+
+#
+# Load test
+#
+
+
+async def http_request(port, method, path, body_file=None, body_length=0):
+    """ make one request to a local server, streaming the body from a file if given
+    :return: (status, parsed JSON reply)
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(("%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" % (method, path, body_length)).encode('latin-1'))
+        if body_file is not None:
+            with open(body_file, 'rb') as f:
+                while True:
+                    chunk = f.read(UPLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+        await writer.drain()
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        reply = await reader.read()
+    finally:
+        writer.close()
+    return (status, json.loads(reply))
+
+
+def make_test_photo(path, width, height):
+    """ write a noisy JPEG about the size a phone camera makes """
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    noise = rng.integers(-40, 40, size=(height, width, 3))
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, quality=92)
+
+
+def peak_memory_kilobytes(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def latency_summary(latencies):
+    ordered = sorted(latencies)
+    if not ordered:
+        return "no requests"
+    return "median %.1f ms, 95th percentile %.1f ms, max %.1f ms over %d requests" % (
+        ordered[len(ordered) // 2] * 1000, ordered[int(len(ordered) * 0.95)] * 1000, ordered[-1] * 1000, len(ordered))
+
+
+async def probe_latency(port, stop, interval=0.02):
+    """ time /status requests back to back until stop is set """
+    latencies = []
+    while not stop.is_set():
+        start = monotonic()
+        await http_request(port, 'GET', '/status')
+        latencies.append(monotonic() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def _load_test(port, photo, upload_count):
+    # Idle baseline
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_latency(port, stop))
+    await asyncio.sleep(1.0)
+    stop.set()
+    idle = await probe
+
+    # Uploads all at once, with requests carrying on alongside them
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_latency(port, stop))
+    size = os.path.getsize(photo)
+    start = monotonic()
+    replies = await asyncio.gather(*[
+        http_request(port, 'PUT', '/images/loadtest/photo%d.jpg' % i, photo, size) for i in range(upload_count)])
+    received = monotonic() - start
+    accepted = [reply['id'] for status, reply in replies if status == HTTPStatus.ACCEPTED]
+    pending = set(accepted)
+    failed = 0
+    while pending:
+        await asyncio.sleep(0.5)
+        for job_id in list(pending):
+            _, job = await http_request(port, 'GET', '/jobs/%d' % job_id)
+            if job['state'] in ('done', 'failed'):
+                pending.discard(job_id)
+                failed += job['state'] == 'failed'
+    prepared = monotonic() - start
+    stop.set()
+    loaded = await probe
+
+    _, page = await http_request(port, 'GET', '/images?limit=%d' % (upload_count))
+    return {
+        'idle': idle,
+        'loaded': loaded,
+        'accepted': len(accepted),
+        'failed': failed,
+        'received_seconds': received,
+        'prepared_seconds': prepared,
+        'listed': len(page['images']),
+        'upload_bytes': size
+    }
+
+
+def load_test(upload_count=6, workers=1, width=4032, height=3024):
+    """ run a server on a scratch library, upload several large photos to it at once,
+    and time a stream of ordinary requests while they're received and prepared
+    """
+    import shutil, socket, subprocess, tempfile
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = tempfile.mkdtemp(prefix='epaper_web_')
+    try:
+        os.makedirs(os.path.join(root, 'library'))
+        with open(os.path.join(root, 'config.xml'), 'w') as f:
+            f.write('<?xml version="1.0"?>\n<epaper>\n    <installpath>%s</installpath>\n'
+                    '    <library>%s</library>\n    <interval>86200</interval>\n</epaper>\n' % (root, os.path.join(root, 'library')))
+        photo = os.path.join(root, 'photo.jpg')
+        make_test_photo(photo, width, height)
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen([sys.executable, os.path.join(here, 'web_server.py'), '--quiet',
+                                   '--port', str(port), '--workers', str(workers)], cwd=root)
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    sleep(0.1)
+            results = asyncio.run(_load_test(port, photo, upload_count))
+            server_memory = peak_memory_kilobytes(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    megabytes = results['upload_bytes'] / (1024 * 1024)
+    logger.info("Uploaded %d photos of %.1f MB each at once, %d accepted, %d failed to prepare." % (
+        upload_count, megabytes, results['accepted'], results['failed']))
+    logger.info("Received in %.1f seconds, all prepared and listed (%d) after %.1f seconds with %d workers." % (
+        results['received_seconds'], results['listed'], results['prepared_seconds'], workers))
+    logger.info("Requests while idle: %s" % (latency_summary(results['idle'])))
+    logger.info("Requests during uploads: %s" % (latency_summary(results['loaded'])))
+    if server_memory is not None:
+        logger.info("Server peak memory %.1f MB, for %.1f MB of uploads (not counting worker processes)." % (
+            server_memory / 1024, megabytes * upload_count))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Run the library management web server")
+    args.add_argument("--quiet", "-q", action='store_false', dest='verbose',
+                      help="reduce log output")
+    args.add_argument('--port', type=int, default=None,
+                      help='Port to listen on (default from <webport> in config.xml, or %d)' % (DEFAULT_PORT))
+    args.add_argument('--host', type=str, default=None,
+                      help='Address to listen on (default from <webhost> in config.xml, or %s)' % (DEFAULT_HOST))
+    args.add_argument('--workers', type=int, default=1,
+                      help='Number of processes preparing uploads at once')
+    args.add_argument('--load-test', action='store_true', dest='load_test',
+                      help='Upload several large photos at once to a scratch server and time other requests meanwhile')
+    args.add_argument('--uploads', type=int, default=6,
+                      help='Number of simultaneous uploads in the load test')
+    args = args.parse_args()
+
+    set_up_logger()
+
+    if args.load_test:
+        load_test(upload_count=args.uploads, workers=args.workers)
+        sys.exit(0)
+
+    config = read_config()
+    if config is None:
+        logger.error('Error reading your config.xml file!')
+        sys.exit(2)
+
+    run_server(
+        verbose=args.verbose,
+        config=config,
+        port=args.port,
+        host=args.host,
+        workers=args.workers
+    )